@@ -3,11 +3,13 @@ import Vuex from 'vuex'
 
 import { getClient, onExpired } from './utils/session'
 
-const POLL_FREQUENCY_BUSY = 10000
-const POLL_FREQUENCY_IDLE = 300000
-
 const DEFAULT_OPERATION = 'viewshed'
 const KEY_IS_LOGGED_IN = 'IS_LOGGED_IN'
+const RESUBSCRIBE_MIN_DELAY = 1000
+const RESUBSCRIBE_MAX_DELAY = 60000
+
+let resubscribeAttempts = 0
+let resubscribeTimer = null
 
 
 Vue.use(Vuex)
@@ -27,8 +29,7 @@ const store = new Vuex.Store({
         analytics: {
             items: [],
             isFetching: false,
-            pollingFrequency: null,
-            pollingRef: null,
+            stream: null,
             subscriptions: [],
         },
 
@@ -53,12 +54,16 @@ const store = new Vuex.Store({
             state.analytics.subscriptions = state.analytics.subscriptions.filter(id => id !== analyticId)
         },
 
-        CHANGE_ANALYTICS_POLLING(state, { frequency, ref }) {
-            state.analytics = {
-                ...state.analytics,
-                pollingFrequency: frequency,
-                pollingRef: ref,
-            }
+        ANALYTICS_CHANGED(state, analytics) {
+            const changed = new Map(analytics.map(a => [a.id, a]))
+            state.analytics.items = [
+                ...state.analytics.items.map(a => changed.get(a.id) || a),
+                ...analytics.filter(a => !state.analytics.items.some(existing => existing.id === a.id)),
+            ]
+        },
+
+        CHANGE_ANALYTICS_STREAM(state, stream) {
+            state.analytics.stream = stream
         },
 
         SESSION_DETECTED(state, user) {
@@ -142,53 +147,84 @@ const store = new Vuex.Store({
 
         appendNewAnalytic(context, analytic) {
             context.commit('ANALYTIC_CREATED', analytic)
-            context.dispatch('changeAnalyticsPolling', POLL_FREQUENCY_BUSY)
         },
 
-        changeAnalyticsPolling(context, frequency) {
-            if (context.state.analytics.pollingFrequency === frequency) {
+        subscribeToAnalytics(context, version) {
+            if (context.state.analytics.stream) {
                 return  // Nothing to do
             }
 
-            if (context.state.analytics.pollingRef === null) {
-                console.debug('[store] Start polling for analytics (at %s seconds)', Math.round(frequency / 1000))
+            console.debug('[store] Subscribing to analytics stream (from version %s)', version)
+
+            const stream = new EventSource(`/api/analytics/stream?since=${version}`)
+
+            stream.addEventListener('analytics', event => {
+                context.commit('ANALYTICS_CHANGED', JSON.parse(event.data).analytics)
+            })
+
+            stream.onopen = () => {
+                resubscribeAttempts = 0
             }
-            else {
-                console.debug('[store] Update analytics polling rate (at %s seconds)', Math.round(frequency / 1000))
-                clearInterval(context.state.analytics.pollingRef)
+
+            stream.onerror = () => {
+                if (stream.readyState === EventSource.CLOSED) {
+                    console.warn('[store] Analytics stream closed by server')
+                    context.commit('CHANGE_ANALYTICS_STREAM', null)
+                    context.dispatch('resubscribeToAnalytics')
+                }
+            }
+
+            context.commit('CHANGE_ANALYTICS_STREAM', stream)
+        },
+
+        resubscribeToAnalytics(context) {
+            if (resubscribeTimer) {
+                return  // Already scheduled
             }
 
-            const ref = setInterval(() => {
-                context.dispatch('fetchAnalytics', { enablePolling: true })
-            }, frequency)
+            // Re-fetching the full list (rather than reopening the stream) catches up
+            // on missed changes and, through its 401, detects an expired session
+            const delay = Math.min(RESUBSCRIBE_MAX_DELAY, RESUBSCRIBE_MIN_DELAY * Math.pow(2, resubscribeAttempts++))
+
+            console.debug('[store] Resubscribing to analytics in %sms', delay)
+
+            resubscribeTimer = setTimeout(() => {
+                resubscribeTimer = null
 
-            context.commit('CHANGE_ANALYTICS_POLLING', { frequency, ref })
+                if (!context.state.user.isLoggedIn || context.state.analytics.stream) {
+                    return  // Nothing to do
+                }
+
+                context.dispatch('fetchAnalytics', { subscribe: true }).then(() => {
+                    if (context.state.user.isLoggedIn && !context.state.analytics.stream) {
+                        context.dispatch('resubscribeToAnalytics')
+                    }
+                })
+            }, delay)
         },
 
-        disableAnalyticsPolling(context) {
-            console.debug('[store] Disabling analytics polling')
+        unsubscribeFromAnalytics(context) {
+            clearTimeout(resubscribeTimer)
+            resubscribeTimer = null
 
-            clearTimeout(context.state.analytics.pollingRef)
-            context.commit('CHANGE_ANALYTICS_POLLING', {
-                pollingFrequency: null,
-                pollingRef: null,
-            })
+            if (!context.state.analytics.stream) {
+                return  // Nothing to do
+            }
+
+            console.debug('[store] Unsubscribing from analytics stream')
+
+            context.state.analytics.stream.close()
+            context.commit('CHANGE_ANALYTICS_STREAM', null)
         },
 
-        fetchAnalytics(context, { enablePolling } = {}) {
+        fetchAnalytics(context, { subscribe } = {}) {
             context.commit('FETCH_ANALYTICS_START')
             return getClient().get('/api/analytics')
                 .then(response => {
                     context.commit('FETCH_ANALYTICS_SUCCESS', response.data.analytics)
 
-                    if (enablePolling) {
-
-                        // Adjust polling interval based on workload
-                        const frequency = response.data.analytics.some(a => a.status.match(/Pending|Processing/i))
-                            ? POLL_FREQUENCY_BUSY
-                            : POLL_FREQUENCY_IDLE
-
-                        context.dispatch('changeAnalyticsPolling', frequency)
+                    if (subscribe) {
+                        context.dispatch('subscribeToAnalytics', response.data.version || 0)
                     }
                 })
                 .catch(err => {
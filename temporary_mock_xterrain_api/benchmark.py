@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+
+"""
+Drives `server.py` with concurrent load against local Legion and GeoServer
+stand-ins (see `stubs.py`) and reports throughput and latency percentiles
+per scenario, so performance regressions show up without a live backend.
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+import stubs
+
+
+API_KEY = '1234'
+
+DEFAULT_DURATION = 30
+DEFAULT_CONCURRENCY = 8
+DEFAULT_DRAIN_TIMEOUT = 300
+STARTUP_TIMEOUT = 30
+
+# Relative weights; reads outnumber creates, as they do when the frontend
+# polls for analytics
+SCENARIOS = collections.OrderedDict([
+    ('viewshed',           2),
+    ('viewshed_batch',     1),
+    ('hillshade',          2),
+    ('georing',            2),
+    ('georing_batch',      1),
+    ('cost_distance',      2),
+    ('connected_viewshed', 1),
+    ('analytics',          10),
+    ('analytics_since',    10),
+    ('sources',            2),
+    ('download_tif',       4),
+    ('download_kmz',       2),
+])
+
+
+class Benchmark:
+    """
+    Runs weighted scenarios against the API from `concurrency` threads,
+    keeping every response time per scenario.
+    """
+
+    def __init__(self, base_url, concurrency, duration, seed=None):
+        """
+        :type base_url: unicode
+        :type concurrency: int
+        :type duration: float -- seconds
+        :type seed: int?
+        """
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.duration = duration
+
+        self.timings = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.elapsed = None
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ready_layers = []  # (operation, layer ID)
+        self._sources = ['stub_source_0']
+        self._version = None
+
+    def run(self):
+        self._refresh_sources(_create_session())
+
+        deadline = time.perf_counter() + self.duration
+        workers = [threading.Thread(target=self._work, args=(deadline,), daemon=True) for _ in range(self.concurrency)]
+
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.elapsed = time.perf_counter() - started
+
+    def drain(self, timeout):
+        """
+        Waits for every analytic created during the run to finish.
+
+        :type timeout: float
+        :rtype: (float?, int) -- seconds it took, or None on timeout, and
+                                 how many layers failed
+        """
+        session = _create_session()
+        started = time.perf_counter()
+
+        while True:
+            response = session.get(self.base_url + '/api/analytics')
+            response.raise_for_status()
+            statuses = [
+                layer['status']
+                for analytic in response.json()['analytics'] if analytic['name'].startswith('Benchmark ')
+                for layer in analytic['layers']
+            ]
+            failed = statuses.count('Failed')
+
+            if not any(s in ('Pending', 'Processing') for s in statuses):
+                return time.perf_counter() - started, failed
+            if time.perf_counter() - started > timeout:
+                return None, failed
+            time.sleep(0.25)
+
+    def report(self):
+        """
+        :rtype: dict
+        """
+        scenarios = {}
+        for name in SCENARIOS:
+            timings = sorted(self.timings.get(name, ()))
+            if not timings and not self.errors[name]:
+                continue
+            scenarios[name] = {
+                'requests': len(timings),
+                'errors': self.errors[name],
+                'throughput': round(len(timings) / self.elapsed, 2),
+                'p50_ms': _percentile(timings, 50),
+                'p95_ms': _percentile(timings, 95),
+                'p99_ms': _percentile(timings, 99),
+                'max_ms': _percentile(timings, 100),
+            }
+
+        total = sum(s['requests'] for s in scenarios.values())
+
+        return {
+            'elapsed': round(self.elapsed, 2),
+            'concurrency': self.concurrency,
+            'requests': total,
+            'errors': sum(self.errors.values()),
+            'throughput': round(total / self.elapsed, 2),
+            'scenarios': scenarios,
+        }
+
+    def _work(self, deadline):
+        session = _create_session()
+        names = list(SCENARIOS)
+        weights = list(SCENARIOS.values())
+
+        while time.perf_counter() < deadline:
+            with self._lock:
+                name = self._random.choices(names, weights)[0]
+
+            scenario = getattr(self, '_scenario_' + name)
+            started = time.perf_counter()
+            try:
+                outcome = scenario(session)
+            except requests.RequestException:
+                outcome = False
+            ended = time.perf_counter()
+
+            if outcome is None:
+                continue  # Nothing to do yet, e.g., no layers ready to download
+
+            with self._lock:
+                if outcome:
+                    self.timings[name].append((ended - started) * 1000)
+                else:
+                    self.errors[name] += 1
+
+    #
+    # Scenarios: each returns True on success, False on failure and None
+    # when it had nothing to do
+    #
+
+    def _scenario_viewshed(self, session):
+        latitude, longitude = self._point()
+        return self._create(session, '/api/viewshed/create_analytic', {
+            'name': 'Benchmark viewshed',
+            'source': self._source(),
+            'latitude': latitude,
+            'longitude': longitude,
+            'target_height': 2,
+            'observer_height': 2,
+            'outer_radius': 5000,
+        })
+
+    def _scenario_viewshed_batch(self, session):
+        return self._create(session, '/api/viewshed/create_batch', {
+            'name': 'Benchmark viewshed batch',
+            'source': self._source(),
+            'points': [dict(zip(('latitude', 'longitude'), self._point())) for _ in range(4)],
+            'target_height': 2,
+            'observer_height': 2,
+            'outer_radius': 5000,
+        })
+
+    def _scenario_hillshade(self, session):
+        return self._create(session, '/api/hillshade/create_analytic', {
+            'name': 'Benchmark hillshade',
+            'source': self._source(),
+            'bbox': self._bbox(),
+            'sun_azimuth': 315,
+            'sun_altitude': 45,
+        })
+
+    def _scenario_georing(self, session):
+        latitude, longitude = self._point()
+        return self._create(session, '/api/georing/create_analytic', {
+            'name': 'Benchmark GeoRing',
+            'source': self._source(),
+            'latitude': latitude,
+            'longitude': longitude,
+            'altitude': 100,
+            'inner_radius': 1,
+            'outer_radius': 5000,
+        })
+
+    def _scenario_georing_batch(self, session):
+        return self._create(session, '/api/georing/new_analytic', {
+            'name': 'Benchmark GeoRing batch',
+            'source': self._source(),
+            'aggregates': [
+                {
+                    'identifier': 'benchmark_{}'.format(i),
+                    'points': [list(reversed(self._point())) for _ in range(2)],
+                }
+                for i in range(2)
+            ],
+        })
+
+    def _scenario_cost_distance(self, session):
+        west, south, east, north = bbox = self._bbox()
+        return self._create(session, '/api/cost_distance/create_analytic', {
+            'name': 'Benchmark cost distance',
+            'source': self._source(),
+            'latitude': (south + north) / 2,
+            'longitude': (west + east) / 2,
+            'bbox': bbox,
+        })
+
+    def _scenario_connected_viewshed(self, session):
+        west, south, east, north = bbox = self._bbox()
+        return self._create(session, '/api/connected_viewshed/create_analytic', {
+            'name': 'Benchmark connected viewshed',
+            'source': self._source(),
+            'linestring': [{'longitude': west, 'latitude': south}, {'longitude': east, 'latitude': north}],
+            'bbox': bbox,
+            'start_azimuth': 0,
+            'end_azimuth': 360,
+            'target_height': 2,
+            'observer_height': 2,
+            'inner_radius': 1,
+            'outer_radius': 5000,
+        })
+
+    def _scenario_analytics(self, session):
+        response = session.get(self.base_url + '/api/analytics')
+        if response.status_code != 200:
+            return False
+
+        payload = response.json()
+        ready = [
+            (layer['operation'], layer['id'])
+            for analytic in payload['analytics'] if analytic['name'].startswith('Benchmark ')
+            for layer in analytic['layers'] if layer['status'] == 'Ready'
+        ]
+        with self._lock:
+            self._ready_layers = ready
+            self._version = payload.get('version')  # Absent while only fixtures are listed
+        return True
+
+    def _scenario_analytics_since(self, session):
+        with self._lock:
+            version = self._version
+        if version is None:
+            return None
+
+        response = session.get(self.base_url + '/api/analytics', params={'since': version})
+        return response.status_code == 200
+
+    def _scenario_sources(self, session):
+        return self._refresh_sources(session)
+
+    def _scenario_download_tif(self, session):
+        return self._download(session, 'TIF')
+
+    def _scenario_download_kmz(self, session):
+        return self._download(session, 'KMZ')
+
+    #
+    # Helpers
+    #
+
+    def _create(self, session, path, payload):
+        response = session.post(self.base_url + path, json=payload)
+        return response.status_code in (200, 202)
+
+    def _download(self, session, extension):
+        with self._lock:
+            if not self._ready_layers:
+                return None
+            operation, layer_id = self._random.choice(self._ready_layers)
+
+        url = '{}/api/{}/downloads/{}.{}'.format(self.base_url, operation, layer_id, extension)
+        with session.get(url, stream=True) as response:
+            if response.status_code == 409:
+                return None  # Still being produced or fetched again
+            if response.status_code != 200:
+                return False
+            for _ in response.iter_content(stubs.READ_SIZE):
+                pass
+        return True
+
+    def _refresh_sources(self, session):
+        response = session.get(self.base_url + '/api/sources')
+        if response.status_code != 200:
+            return False
+
+        sources = [s['id'] for s in response.json().get('sources', ())]
+        if sources:
+            with self._lock:
+                self._sources = sources
+        return True
+
+    def _source(self):
+        with self._lock:
+            return self._random.choice(self._sources)
+
+    def _point(self):
+        with self._lock:
+            return self._random.uniform(31, 39), self._random.uniform(-119, -111)
+
+    def _bbox(self):
+        latitude, longitude = self._point()
+        size = 0.05
+        return [longitude - size, latitude - size, longitude + size, latitude + size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--duration', default=DEFAULT_DURATION, type=float, help='seconds of load')
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY, type=int, help='concurrent clients')
+    parser.add_argument('--server', default='threaded', help='`--server` to run server.py with')
+    parser.add_argument('--threads', type=int, help='`--threads` to run server.py with')
+    parser.add_argument('--legion-latency', default=0.2, type=float, help='seconds before each Legion response')
+    parser.add_argument('--geoserver-latency', default=0.01, type=float, help='seconds before each GeoServer response')
+    parser.add_argument('--jitter', default=0.0, type=float, help='± seconds of random stub latency')
+    parser.add_argument('--raster-size', default=stubs.DEFAULT_RASTER_SIZE, type=int, help='width and height of GeoTIFFs')
+    parser.add_argument('--drain-timeout', default=DEFAULT_DRAIN_TIMEOUT, type=float,
+                        help='seconds to wait for analytics to finish after the load stops')
+    parser.add_argument('--server-log', help='file to write server.py\'s output to, for when something fails')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    opts = parser.parse_args()
+
+    legion = stubs.LegionStub(raster_size=opts.raster_size, latency=opts.legion_latency, jitter=opts.jitter).start()
+    geoserver = stubs.GeoServerStub(latency=opts.geoserver_latency, jitter=opts.jitter).start()
+
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as workdir:
+        port = _find_free_port()
+        base_url = 'http://127.0.0.1:{}'.format(port)
+
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+                   '--host', '127.0.0.1', '--port', str(port), '--server', opts.server, '--no-debug', '--no-reloader']
+        if opts.threads:
+            command += ['--threads', str(opts.threads)]
+
+        os.mkdir(os.path.join(workdir, 'cache'))
+        os.mkdir(os.path.join(workdir, 'uploads'))
+
+        log_path = opts.server_log or os.path.join(workdir, 'server.log')
+        with open(log_path, 'w') as log_file:
+            server = subprocess.Popen(command, env=_server_environment(workdir, legion, geoserver),
+                                      stdout=log_file, stderr=subprocess.STDOUT)
+            try:
+                if not _wait_until_up(base_url, server):
+                    with open(log_path) as fp:
+                        sys.stderr.write(fp.read())
+                    raise SystemExit('server.py did not start within {} seconds'.format(STARTUP_TIMEOUT))
+
+                benchmark = Benchmark(base_url, opts.concurrency, opts.duration, opts.seed)
+                benchmark.run()
+                drained, failed = benchmark.drain(opts.drain_timeout)
+            finally:
+                server.terminate()
+                server.wait()
+                legion.stop()
+                geoserver.stop()
+
+    report = benchmark.report()
+    report['drain_seconds'] = round(drained, 2) if drained is not None else None
+    report['failed_layers'] = failed
+    report['legion_requests'] = legion.requests
+    report['geoserver_requests'] = geoserver.requests
+
+    if opts.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
+
+    if report['errors'] or failed or drained is None:
+        sys.exit(1)
+
+
+#
+# Helpers
+#
+
+
+def _create_session():
+    session = requests.Session()
+    session.auth = (API_KEY, '')
+    return session
+
+
+def _server_environment(workdir, legion, geoserver):
+    env = dict(os.environ)
+    env.update({
+        'LEGION_SCHEME': 'http',
+        'LEGION_HOST': legion.address,
+        'LEGION_TOKEN': 'benchmark',
+        'LEGION_CACHE_DIR': os.path.join(workdir, 'cache'),
+        'GEOSERVER_BASE_URL': 'http://{}/geoserver'.format(geoserver.address),
+        'GEORING_DB_PATH': os.path.join(workdir, 'georing.sqlite3'),
+        'GEORING_UPLOAD_DIR': os.path.join(workdir, 'uploads'),
+    })
+    return env
+
+
+def _find_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_up(base_url, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            requests.get(base_url + '/auth/whoami', auth=(API_KEY, ''), timeout=1).raise_for_status()
+            return True
+        except requests.RequestException:
+            time.sleep(0.1)
+    return False
+
+
+def _percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile, in milliseconds.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return round(sorted_values[int(rank) - 1], 1)
+
+
+def _print_report(report):
+    columns = ('requests', 'errors', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+    row_format = '{:<20}' + '{:>12}' * len(columns)
+
+    print(row_format.format('scenario', *columns))
+    for name, stats in report['scenarios'].items():
+        print(row_format.format(name, *('-' if stats[c] is None else stats[c] for c in columns)))
+
+    print()
+    print('{requests} requests in {elapsed}s ({throughput}/s) from {concurrency} clients, {errors} errors'.format(**report))
+    print('Analytics drained in {}, {} layers failed'.format(
+        '{}s'.format(report['drain_seconds']) if report['drain_seconds'] is not None else 'more than the timeout',
+        report['failed_layers']))
+    print('Legion saw {legion_requests} requests, GeoServer {geoserver_requests}'.format(**report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+INDEX_FILENAME = 'index.sqlite3'
+PARTIAL_SUFFIX = '.part'
+PARTIAL_MAX_AGE = 3600
+
+
+_log = logging.getLogger(__name__)
+
+
+class Cache:
+    """
+    Size-bounded file cache backed by an on-disk SQLite index.
+
+    Only files written through `write()` are ever served by `lookup()`, so
+    a download that died halfway through can never be mistaken for a
+    complete entry.  Entries are evicted when they outlive `ttl` seconds
+    or, least recently used first, when the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes, ttl=None):
+        """
+        :type directory: unicode
+        :type max_bytes: int
+        :type ttl: int?
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, INDEX_FILENAME), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                filename    TEXT PRIMARY KEY,
+                size        INTEGER NOT NULL,
+                created_on  REAL NOT NULL,
+                accessed_on REAL NOT NULL,
+                hits        INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_accessed_on ON entries (accessed_on)')
+        self._db.commit()
+
+        self._purge_partials()
+
+    def lookup(self, filename):
+        """
+        :type filename: unicode
+        :rtype: unicode?
+        """
+        filepath = os.path.join(self.directory, filename)
+
+        with self._lock:
+            row = self._db.execute('SELECT size, accessed_on FROM entries WHERE filename = ?', (filename,)).fetchone()
+            if not row:
+                return None
+
+            size, accessed_on = row
+            now = time.time()
+
+            if self.ttl and accessed_on < now - self.ttl:
+                _log.info('Entry "%s" has expired', filename)
+                self._remove(filename)
+                self._db.commit()
+                return None
+
+            try:
+                actual_size = os.path.getsize(filepath)
+            except OSError:
+                actual_size = None
+
+            if actual_size != size:
+                _log.warning('Entry "%s" is missing or corrupt (expected %s bytes, found %s); discarding',
+                             filename, size, actual_size)
+                self._remove(filename)
+                self._db.commit()
+                return None
+
+            self._db.execute('UPDATE entries SET accessed_on = ?, hits = hits + 1 WHERE filename = ?', (now, filename))
+            self._db.commit()
+
+        return filepath
+
+    @contextlib.contextmanager
+    def write(self, filename):
+        """
+        Yields a binary file handle to a temporary file which is atomically
+        renamed into place (and indexed) only if the block exits cleanly.
+
+        :type filename: unicode
+        """
+        filepath = os.path.join(self.directory, filename)
+        partial_path = '{}.{}{}'.format(filepath, os.urandom(4).hex(), PARTIAL_SUFFIX)
+
+        try:
+            with open(partial_path, 'wb') as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(partial_path, filepath)
+        except BaseException:
+            _log.warning('Discarding incomplete write to "%s"', filename)
+            with contextlib.suppress(OSError):
+                os.remove(partial_path)
+            raise
+
+        size = os.path.getsize(filepath)
+        now = time.time()
+
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO entries (filename, size, created_on, accessed_on, hits) '
+                             'VALUES (?, ?, ?, ?, 0)', (filename, size, now, now))
+            self._db.commit()
+
+        # The caller is about to use the file, however large it is
+        self.evict(keep=filename)
+
+    def evict(self, keep=None):
+        """
+        Drops expired entries, then least recently used entries until the
+        cache fits within `max_bytes`.  `keep` is left alone.
+
+        :type keep: unicode?
+        """
+        with self._lock:
+            if self.ttl:
+                expired = self._db.execute('SELECT filename FROM entries WHERE accessed_on < ? AND filename IS NOT ?',
+                                           (time.time() - self.ttl, keep)).fetchall()
+                for (filename,) in expired:
+                    _log.info('Evicting expired entry "%s"', filename)
+                    self._remove(filename)
+
+            total, = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+            if total > self.max_bytes:
+                candidates = self._db.execute('SELECT filename, size FROM entries WHERE filename IS NOT ? '
+                                              'ORDER BY accessed_on', (keep,)).fetchall()
+                for filename, size in candidates:
+                    if total <= self.max_bytes:
+                        break
+                    _log.info('Evicting entry "%s" (%d bytes) to stay within %d bytes', filename, size, self.max_bytes)
+                    self._remove(filename)
+                    total -= size
+
+            self._db.commit()
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        with self._lock:
+            count, size, hits = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) FROM entries').fetchone()
+
+        return {
+            'entries': count,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'hits': hits,
+        }
+
+    def _purge_partials(self):
+        cutoff = time.time() - PARTIAL_MAX_AGE
+        for name in os.listdir(self.directory):
+            if not name.endswith(PARTIAL_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            with contextlib.suppress(OSError):
+                if os.path.getmtime(path) < cutoff:
+                    _log.info('Removing abandoned partial file "%s"', name)
+                    os.remove(path)
+
+    def _remove(self, filename):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(self.directory, filename))
+        self._db.execute('DELETE FROM entries WHERE filename = ?', (filename,))
@@ -0,0 +1,169 @@
+import email.utils
+import os
+import zipfile
+
+from bottle import request, HTTPResponse, parse_date, parse_range_header
+
+
+READ_SIZE = 64 * 1024
+
+
+class FileRange:
+    """
+    Read-only view of `length` bytes of an open file starting at `offset`.
+
+    Being file-like, bottle hands it to the server's `wsgi.file_wrapper`,
+    so servers that implement `sendfile()` (gunicorn, `servers.ThreadedServer`)
+    can push the range straight from the page cache to the socket.
+    """
+
+    def __init__(self, filelike, offset, length):
+        self._file = filelike
+        self._file.seek(offset)
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        chunk = self._file.read(size)
+        self._remaining -= len(chunk)
+        return chunk
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+def send_file(filepath, mimetype, download_name=None):
+    """
+    Serves a file with support for conditional GETs (`If-None-Match`,
+    `If-Modified-Since`) and single byte ranges (`Range`, `If-Range`).
+
+    :type filepath: unicode
+    :type mimetype: unicode
+    :type download_name: unicode?
+    :rtype: bottle.HTTPResponse
+    """
+
+    try:
+        stats = os.stat(filepath)
+    except FileNotFoundError:
+        return HTTPResponse({'error': 'File not found'}, status=404)
+
+    size = stats.st_size
+    etag = '"{:x}-{:x}"'.format(stats.st_mtime_ns, size)
+    last_modified = email.utils.formatdate(stats.st_mtime, usegmt=True)
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Type': mimetype,
+        'ETag': etag,
+        'Last-Modified': last_modified,
+    }
+
+    if download_name:
+        headers['Content-Disposition'] = 'attachment; filename="{}"'.format(download_name.replace('"', ''))
+
+    if_none_match = request.get_header('If-None-Match')
+    if if_none_match:
+        if etag in (t.strip() for t in if_none_match.split(',')) or if_none_match.strip() == '*':
+            return HTTPResponse(status=304, **headers)
+    else:
+        if_modified_since = parse_date((request.get_header('If-Modified-Since') or '').split(';')[0].strip())
+        if if_modified_since and if_modified_since >= int(stats.st_mtime):
+            return HTTPResponse(status=304, **headers)
+
+    offset, length, status = 0, size, 200
+
+    range_header = request.get_header('Range')
+    if range_header and _if_range_matches(request.get_header('If-Range'), etag, stats.st_mtime):
+        ranges = list(parse_range_header(range_header, size))
+        if not ranges:
+            headers['Content-Range'] = 'bytes */{}'.format(size)
+            return HTTPResponse(status=416, **headers)
+
+        # Multiple ranges would require a multipart/byteranges body; serving
+        # the first one is permitted and is all download managers ask for
+        start, end = ranges[0]
+        offset, length, status = start, end - start, 206
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, size)
+
+    headers['Content-Length'] = str(length)
+
+    if request.method == 'HEAD':
+        return HTTPResponse(status=status, **headers)
+
+    body = open(filepath, 'rb')
+    if status == 206:
+        body = FileRange(body, offset, length)
+
+    return HTTPResponse(body, status=status, **headers)
+
+
+def stream_zip(entries):
+    """
+    Yields a ZIP archive chunk by chunk as its entries are compressed, so
+    the archive never needs to be staged in memory or on disk.
+
+    :type entries: list[(unicode, unicode)] -- (archive name, file path) pairs
+    """
+
+    sink = _ChunkSink()
+
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, filepath in entries:
+            with open(filepath, 'rb') as src, archive.open(name, 'w') as dest:
+                while True:
+                    chunk = src.read(READ_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+
+    yield from sink.drain()
+
+
+#
+# Helpers
+#
+
+
+def _if_range_matches(if_range, etag, mtime):
+    if not if_range:
+        return True
+
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+
+    date = parse_date(if_range)
+    return date is not None and date >= int(mtime)
+
+
+class _ChunkSink:
+    """
+    Write-only, unseekable file object that buffers whatever `zipfile`
+    writes until it is drained.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
@@ -0,0 +1,111 @@
+import sqlite3
+import threading
+
+
+INDEX_FILENAME = 'extents.sqlite3'
+
+
+class ExtentIndex:
+    """
+    Spatial index of cached rasters, keyed by everything that went into
+    producing them except their extent, so a raster can be found by any
+    extent it covers.  Pass `:memory:` as the path for an index that need
+    not outlive the process, e.g., of datasource extents.
+
+    Backed by an SQLite R*Tree.  The tree stores coordinates as 32-bit
+    floats rounded outwards, so candidates are re-checked against the exact
+    extents kept alongside them.
+    """
+
+    def __init__(self, path):
+        """
+        :type path: unicode
+        """
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS extents USING rtree (
+                id,
+                min_x, max_x,
+                min_y, max_y,
+                +key      TEXT,
+                +filename TEXT,
+                +west     REAL,
+                +south    REAL,
+                +east     REAL,
+                +north    REAL
+            )
+        """)
+        self._db.commit()
+
+    def add(self, key, filename, extent):
+        """
+        :type key: unicode
+        :type filename: unicode
+        :type extent: (float, float, float, float) -- (west, south, east, north)
+        """
+        west, south, east, north = extent
+
+        with self._lock:
+            self._db.execute('DELETE FROM extents WHERE filename = ?', (filename,))
+            self._db.execute('INSERT INTO extents (min_x, max_x, min_y, max_y, key, filename, west, south, east, north) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (west, east, south, north, key, filename, west, south, east, north))
+            self._db.commit()
+
+    def find_containing(self, key, extent):
+        """
+        Finds the rasters produced with `key` which cover `extent`
+        entirely, smallest first.
+
+        :type key: unicode
+        :type extent: (float, float, float, float) -- (west, south, east, north)
+        :rtype: list[unicode]
+        """
+        west, south, east, north = extent
+
+        with self._lock:
+            rows = self._db.execute("""
+                SELECT filename
+                FROM extents
+                WHERE min_x <= ? AND max_x >= ? AND min_y <= ? AND max_y >= ?
+                  AND key = ?
+                  AND west <= ? AND east >= ? AND south <= ? AND north >= ?
+                ORDER BY (east - west) * (north - south)
+            """, (west, east, south, north, key, west, east, south, north)).fetchall()
+
+        return [filename for filename, in rows]
+
+    def find_intersecting(self, key, extent):
+        """
+        Finds the entries added with `key` which overlap `extent`, or touch
+        it, in the order they were added.
+
+        :type key: unicode
+        :type extent: (float, float, float, float) -- (west, south, east, north)
+        :rtype: list[unicode]
+        """
+        west, south, east, north = extent
+
+        with self._lock:
+            rows = self._db.execute("""
+                SELECT filename
+                FROM extents
+                WHERE min_x <= ? AND max_x >= ? AND min_y <= ? AND max_y >= ?
+                  AND key = ?
+                  AND west <= ? AND east >= ? AND south <= ? AND north >= ?
+                ORDER BY id
+            """, (east, west, north, south, key, east, west, north, south)).fetchall()
+
+        return [filename for filename, in rows]
+
+    def remove(self, filename):
+        """
+        :type filename: unicode
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM extents WHERE filename = ?', (filename,))
+            self._db.commit()
@@ -0,0 +1,78 @@
+import math
+
+
+def simplify(points, tolerance):
+    """
+    Douglas-Peucker simplification of a polyline or closed ring.  Points
+    deviating less than `tolerance` (in coordinate units) from the
+    simplified line are dropped; the first and last points are always kept.
+
+    :type points: list[list[float]]
+    :type tolerance: float
+    :rtype: list[list[float]]
+    """
+    if len(points) < 3:
+        return list(points)
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+
+        max_distance = 0
+        max_index = None
+        for i in range(start + 1, end):
+            distance = _distance_to_segment(points[i], points[start], points[end])
+            if distance > max_distance:
+                max_distance = distance
+                max_index = i
+
+        if max_index is not None and max_distance > tolerance:
+            keep[max_index] = True
+            stack.append((start, max_index))
+            stack.append((max_index, end))
+
+    return [p for p, k in zip(points, keep) if k]
+
+
+def simplify_ring(ring, tolerance):
+    """
+    Simplifies a closed linear ring, falling back to the original ring if
+    simplification would collapse it below a valid polygon ring.
+
+    :type ring: list[list[float]]
+    :type tolerance: float
+    :rtype: list[list[float]]
+    """
+    simplified = simplify(ring, tolerance)
+    if len(simplified) < 4:
+        return ring
+    return simplified
+
+
+def tolerance_for_zoom(zoom):
+    """
+    Size of a single pixel, in degrees, at the given web map zoom level.
+
+    :type zoom: int
+    :rtype: float
+    """
+    return 360 / (256 * 2 ** zoom)
+
+
+def _distance_to_segment(point, start, end):
+    px, py = point[0], point[1]
+    ax, ay = start[0], start[1]
+    bx, by = end[0], end[1]
+
+    dx = bx - ax
+    dy = by - ay
+
+    if dx == 0 and dy == 0:
+        return math.hypot(px - ax, py - ay)
+
+    t = max(0, min(1, ((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy)))
+
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
@@ -1,105 +1,139 @@
+import concurrent.futures
+import contextlib
 import logging
 import os
+import threading
 
 import requests
 
+import metrics
+import sessions
+import tracing
+
 
 GEOSERVER_BASE_URL = os.getenv('GEOSERVER_BASE_URL', 'http://localhost:8080/geoserver')
 GEOSERVER_USERNAME = os.getenv('GEOSERVER_USERNAME', 'admin')
 GEOSERVER_PASSWORD = os.getenv('GEOSERVER_PASSWORD', 'geoserver')
+GEOSERVER_POOL_SIZE = int(os.getenv('GEOSERVER_POOL_SIZE', 10))
+GEOSERVER_KEEP_ALIVE = os.getenv('GEOSERVER_KEEP_ALIVE', '1') == '1'
+GEOSERVER_CONNECT_TIMEOUT = float(os.getenv('GEOSERVER_CONNECT_TIMEOUT', 5))
+GEOSERVER_READ_TIMEOUT = float(os.getenv('GEOSERVER_READ_TIMEOUT', 60))
 
 
 _log = logging.getLogger(__name__)
 
+# What this process knows GeoServer to hold, so repeat publishes (e.g., of
+# cached Legion outputs) never have to ask it again
+_workspaces = set()
+_styles = set()
+_layers = {}  # (workspace, layer_id) -> style
+_catalog_lock = threading.Lock()
+
+_request_seconds = metrics.histogram('geoserver_request_seconds', 'Time taken by GeoServer REST calls', ('call',))
+_publish_seconds = metrics.histogram(
+    'geoserver_publish_seconds', 'Time taken to publish a GeoTIFF not yet known to be published', ('workspace',))
+
 
 def create_workspace(name):
     client = _get_client()
 
     try:
         _log.info('Creating workspace "%s"', name)
-        response = client.post('{}/rest/workspaces'.format(GEOSERVER_BASE_URL),
-                               json={'workspace': {'name': name}})
-    except requests.ConnectionError:
+        with _timed('create_workspace'):
+            response = client.post('{}/rest/workspaces'.format(GEOSERVER_BASE_URL),
+                                   json={'workspace': {'name': name}})
+    except (requests.ConnectionError, requests.Timeout):
         raise Unreachable()
 
     if response.status_code != 201:
         if response.status_code == 500 and 'already exists' in response.text:
+            _remember(_workspaces, name)
             raise ObjectExists('workspace', name)
 
         raise ServerError(response)
 
+    _remember(_workspaces, name)
+
+
+def list_workspaces():
+    """
+    :rtype: set[unicode]
+    """
+    names = _list('workspaces', 'workspace')
+
+    with _catalog_lock:
+        _workspaces.update(names)
+
+    return names
+
+
+def ensure_workspaces(names):
+    """
+    Creates whichever of the workspaces are missing, fetching the list of
+    existing ones once (or not at all if they are all already known).
+
+    :type names: iterable[unicode]
+    """
+    missing = [n for n in names if not _knows(_workspaces, n)]
+    if missing:
+        existing = list_workspaces()
+        _map_concurrently(_create_if_missing(create_workspace), [n for n in missing if n not in existing])
+
 
 def workspace_exists(name):
+    if _knows(_workspaces, name):
+        return True
+
     client = _get_client()
 
     try:
         _log.debug('Checking if workspace "%s" exists', name)
-        response = client.get('{}/rest/workspaces/{}?quietOnNotFound=true'.format(GEOSERVER_BASE_URL, name))
-    except requests.ConnectionError:
+        with _timed('get_workspace'):
+            response = client.get('{}/rest/workspaces/{}?quietOnNotFound=true'.format(GEOSERVER_BASE_URL, name))
+    except (requests.ConnectionError, requests.Timeout):
         raise Unreachable()
 
     if response.status_code not in (200, 404):
         raise ServerError(response)
 
+    if response.status_code == 200:
+        _remember(_workspaces, name)
+
     return response.status_code == 200
 
 
-def publish_geotiff(workspace, file_abspath, title=None, style=None):
-    client = _get_client()
-
+def publish_geotiff(workspace, file_abspath, style=None):
+    """
+    Publishes a GeoTIFF as a layer named after its file, with `style` as
+    its default style.  Publishing is idempotent: layers this process has
+    already published are returned without contacting GeoServer, and the
+    rest take one request, plus one more to set the style.
+
+    :type workspace: unicode
+    :type file_abspath: unicode
+    :type style: unicode?
+    :rtype: unicode -- the layer ID
+    """
     layer_id = os.path.basename(file_abspath)
-    try:
-        _log.info('Publishing GeoTIFF to GeoServer:\n'
-                  '----\n\n'
-                  'Workspace: %s\n\n'
-                  'Layer ID: %s\n\n'
-                  'File Path: %s\n\n'
-                  '----', workspace, layer_id, file_abspath)
-        response = client.post(
-            '{}/rest/workspaces/{}/coveragestores'.format(GEOSERVER_BASE_URL, workspace),
-            json={
-                'coverageStore': {
-                    'enabled': True,
-                    'name':    layer_id,
-                    'type':    'GeoTIFF',
-                    'url':     'file://{}'.format(file_abspath),
-                    'workspace': {
-                        'name': workspace,
-                    },
-                },
-            })
-    except requests.ConnectionError:
-        raise Unreachable()
+    key = (workspace, layer_id)
 
-    if response.status_code != 201:
-        if response.status_code == 500 and 'already exists' in response.text:
-            raise ObjectExists('coveragestore', layer_id)
-        raise ServerError(response)
+    with _catalog_lock:
+        published = key in _layers
+        current_style = _layers.get(key)
 
-    try:
-        response = client.post(
-            '{}/rest/workspaces/{}/coveragestores/{}/coverages'.format(GEOSERVER_BASE_URL, workspace, layer_id),
-            json={
-                'coverage': {
-                    'name': layer_id,
-                    'title': title or layer_id,
-                    'srs': 'EPSG:4326',
-                    'nativeFormat': 'GeoTIFF',
-                    'workspace': {
-                        'name': workspace
-                    },
-                },
-            })
-    except requests.ConnectionError:
-        raise Unreachable()
+    if published and current_style == style:
+        _log.debug('Layer "%s:%s" is already published', workspace, layer_id)
+        return layer_id
 
-    if response.status_code != 201:
-        if response.status_code == 500 and 'already exists' in response.text:
-            raise ObjectExists('coverage', layer_id)
-        raise ServerError(response)
+    with _publish_seconds.time(workspace=workspace):
+        if not published:
+            _create_coverage(workspace, layer_id, file_abspath)
+
+        if style:
+            set_layer_style(layer_id, style, workspace=workspace)
 
-    if style:
-        set_layer_style(layer_id, style)
+    with _catalog_lock:
+        _layers[key] = style
 
     return layer_id
 
@@ -113,78 +147,225 @@ def create_style(name, sld_content):
                   'SLD Content:\n\n'
                   '%s\n\n'
                   '----', name, sld_content)
-        response = client.post(
-            '{}/rest/styles'.format(GEOSERVER_BASE_URL),
-            headers={
-                'Content-Type': 'application/vnd.ogc.sld+xml',
-            },
-            params={
-                'name': name,
-            },
-            data=sld_content.strip(),
-        )
-    except requests.ConnectionError:
+        with _timed('create_style'):
+            response = client.post(
+                '{}/rest/styles'.format(GEOSERVER_BASE_URL),
+                headers={
+                    'Content-Type': 'application/vnd.ogc.sld+xml',
+                },
+                params={
+                    'name': name,
+                },
+                data=sld_content.strip(),
+            )
+    except (requests.ConnectionError, requests.Timeout):
         raise Unreachable()
 
     if response.status_code != 201:
         if response.status_code == 500 and 'already exists' in response.text:
+            _remember(_styles, name)
             raise ObjectExists('style', name)
         raise ServerError(response)
 
+    _remember(_styles, name)
+
+
+def list_styles():
+    """
+    :rtype: set[unicode]
+    """
+    names = _list('styles', 'style')
+
+    with _catalog_lock:
+        _styles.update(names)
+
+    return names
+
+
+def ensure_styles(styles):
+    """
+    Creates whichever of the styles are missing, fetching the list of
+    existing ones once (or not at all if they are all already known).
+
+    :type styles: dict[unicode, unicode] -- SLD content by style name
+    """
+    missing = [n for n in styles if not _knows(_styles, n)]
+    if missing:
+        existing = list_styles()
+        _map_concurrently(_create_if_missing(lambda n: create_style(n, styles[n])),
+                          [n for n in missing if n not in existing])
+
 
 def style_exists(name):
+    if _knows(_styles, name):
+        return True
+
     client = _get_client()
 
     _log.debug('Checking if style "%s" exists', name)
     try:
-        response = client.get(
-            '{}/rest/styles/{}'.format(GEOSERVER_BASE_URL, name),
-            params={
-                'quietOnNotFound': True,
-            },
-        )
-    except requests.ConnectionError:
+        with _timed('get_style'):
+            response = client.get(
+                '{}/rest/styles/{}'.format(GEOSERVER_BASE_URL, name),
+                params={
+                    'quietOnNotFound': True,
+                },
+            )
+    except (requests.ConnectionError, requests.Timeout):
         raise Unreachable()
 
     if response.status_code not in (200, 404):
         raise ServerError(response)
 
+    if response.status_code == 200:
+        _remember(_styles, name)
+
     return response.status_code == 200
 
 
-def set_layer_style(layer_id, style):
+def set_layer_style(layer_id, style, workspace=None):
+    client = _get_client()
+
+    qualified_id = '{}:{}'.format(workspace, layer_id) if workspace else layer_id
+
+    _log.info('Setting style "%s" for layer "%s"', style, qualified_id)
+    try:
+        with _timed('set_layer_style'):
+            response = client.put(
+                '{}/rest/layers/{}.json'.format(GEOSERVER_BASE_URL, qualified_id),
+                json={
+                    'layer': {
+                        'defaultStyle': {
+                            'name': style,
+                        },
+                    },
+                })
+    except (requests.ConnectionError, requests.Timeout):
+        raise Unreachable()
+
+    if response.status_code != 200:
+        raise ServerError(response)
+
+
+#
+# Helpers
+#
+
+
+def _create_coverage(workspace, layer_id, file_abspath):
     client = _get_client()
 
-    _log.info('Setting style "%s" for layer "%s"', style, layer_id)
     try:
-        response = client.put(
-            '{}/rest/layers/{}.json'.format(GEOSERVER_BASE_URL, layer_id),
-            json={
-                'layer': {
-                    'defaultStyle': style,
+        _log.info('Publishing GeoTIFF to GeoServer:\n'
+                  '----\n\n'
+                  'Workspace: %s\n\n'
+                  'Layer ID: %s\n\n'
+                  'File Path: %s\n\n'
+                  '----', workspace, layer_id, file_abspath)
+
+        # Creates the coverage store, its coverage and the layer in one
+        # request; repeating it for an existing store is harmless
+        with _timed('create_coverage'):
+            response = client.put(
+                '{}/rest/workspaces/{}/coveragestores/{}/external.geotiff'.format(GEOSERVER_BASE_URL, workspace, layer_id),
+                headers={
+                    'Content-Type': 'text/plain',
                 },
-            })
-    except requests.ConnectionError:
+                params={
+                    'configure': 'first',
+                    'coverageName': layer_id,
+                },
+                data='file://{}'.format(file_abspath),
+            )
+    except (requests.ConnectionError, requests.Timeout):
+        raise Unreachable()
+
+    if response.status_code not in (200, 201):
+        raise ServerError(response)
+
+
+@contextlib.contextmanager
+def _timed(call):
+    with _request_seconds.time(call=call), tracing.span('geoserver.' + call):
+        yield
+
+
+def _create_if_missing(create):
+    def create_if_missing(name):
+        try:
+            create(name)
+        except ObjectExists:
+            pass  # Lost a race with another process; either way, it exists
+    return create_if_missing
+
+
+def _list(collection, item_type):
+    client = _get_client()
+
+    try:
+        _log.debug('Listing %s', collection)
+        with _timed('list'):
+            response = client.get('{}/rest/{}.json'.format(GEOSERVER_BASE_URL, collection))
+    except (requests.ConnectionError, requests.Timeout):
         raise Unreachable()
 
     if response.status_code != 200:
         raise ServerError(response)
 
+    try:
+        # GeoServer renders an empty collection as an empty string
+        items = response.json()[collection] or {}
+        return {item['name'] for item in items.get(item_type, [])}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise ServerError(response)
+
+
+def _map_concurrently(fn, items):
+    """
+    Runs `fn` over `items` in parallel, sized to the GeoServer connection
+    pool, returning results in order and raising the first error.
+    """
+    if not items:
+        return []
+
+    if len(items) == 1:
+        return [fn(items[0])]
+
+    workers = min(GEOSERVER_POOL_SIZE, len(items))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='geoserver') as executor:
+        return list(executor.map(fn, items))
+
 
 def _get_client():
     """
-    :return requests.Session:
+    :return sessions.PooledSession:
     """
     for key in ('GEOSERVER_BASE_URL', 'GEOSERVER_USERNAME', 'GEOSERVER_PASSWORD'):
         if not globals().get(key, None):
             raise ValueError('In settings, "{}" cannot be blank'.format(key))
 
-    client = requests.Session()
+    client = sessions.get_session(
+        'geoserver',
+        pool_size=GEOSERVER_POOL_SIZE,
+        keep_alive=GEOSERVER_KEEP_ALIVE,
+        connect_timeout=GEOSERVER_CONNECT_TIMEOUT,
+        read_timeout=GEOSERVER_READ_TIMEOUT,
+    )
     client.auth = (GEOSERVER_USERNAME, GEOSERVER_PASSWORD)
 
     return client
 
 
+def _knows(collection, name):
+    with _catalog_lock:
+        return name in collection
+
+
+def _remember(collection, name):
+    with _catalog_lock:
+        collection.add(name)
+
+
 class Error(Exception):
     pass
 
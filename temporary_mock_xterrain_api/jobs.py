@@ -0,0 +1,161 @@
+import collections
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+
+
+_log = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_stopping = False
+
+_inflight = 0
+_inflight_lock = threading.Lock()
+
+_job_seconds = metrics.histogram('jobs_duration_seconds', 'Time taken by background jobs', ('job',))
+
+
+def submit(fn, *args, context=None, **kwargs):
+    """
+    Queues `fn` for execution on the bounded background worker pool.
+
+    :type fn: callable
+    :type context: unicode?
+    :rtype: concurrent.futures.Future
+    :raises RuntimeError: once the pool is shutting down
+    """
+
+    global _inflight
+
+    executor = _get_executor()
+
+    with _inflight_lock:
+        _inflight += 1
+
+    try:
+        future = executor.submit(_run, fn, args, kwargs, context)
+    except RuntimeError:
+        with _inflight_lock:
+            _inflight -= 1
+        raise
+
+    _log.debug('[%s] Queued job "%s"', context, fn.__name__)
+
+    return future
+
+
+def submit_all(fn, arg_tuples, concurrency, context=None):
+    """
+    Queues `fn(*args)` for each of `arg_tuples`, keeping at most
+    `concurrency` of them queued or running at any moment.  The rest are
+    released one by one as earlier calls finish, so a large batch neither
+    monopolizes the worker pool nor ties up workers waiting for a slot.
+
+    :type fn: callable
+    :type arg_tuples: list[tuple]
+    :type concurrency: int
+    :type context: unicode?
+    :raises RuntimeError: once the pool is shutting down
+    """
+
+    remaining = collections.deque(arg_tuples)
+    lock = threading.Lock()
+
+    def release_next(_=None):
+        with lock:
+            if not remaining or _stopping:
+                return
+            args = remaining.popleft()
+        try:
+            future = submit(fn, *args, context=context)
+        except RuntimeError:
+            _log.warning('[%s] Dropped %d queued "%s" jobs on shutdown', context, len(remaining) + 1, fn.__name__)
+            return
+        future.add_done_callback(release_next)
+
+    _log.info('[%s] Queued batch of %d "%s" jobs (concurrency=%d)', context, len(remaining), fn.__name__, concurrency)
+
+    # Submitted directly so that, like `submit()`, a batch queued during
+    # shutdown fails rather than being dropped without a word
+    for _ in range(min(concurrency, len(remaining))):
+        with lock:
+            if not remaining:
+                break
+            args = remaining.popleft()
+        submit(fn, *args, context=context).add_done_callback(release_next)
+
+
+def inflight():
+    """
+    :rtype: int
+    """
+    return _inflight
+
+
+def shutdown(wait=True):
+    """
+    Stops the worker pool; batches stop releasing their remaining jobs and
+    no new jobs are accepted.  The lock is released before joining the
+    workers, as jobs finishing meanwhile still call into this module.
+    """
+    global _executor, _stopping
+
+    with _executor_lock:
+        _stopping = True
+        executor, _executor = _executor, None
+
+    if executor is None:
+        return
+
+    _log.info('Shutting down job workers (wait=%s)', wait)
+    executor.shutdown(wait=wait)
+
+
+#
+# Helpers
+#
+
+
+def _get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _stopping:
+            raise RuntimeError('job workers are shutting down')
+        if _executor is None:
+            _log.info('Starting %d job workers', JOB_WORKERS)
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+        return _executor
+
+
+def _run(fn, args, kwargs, context):
+    global _inflight
+
+    started = time.perf_counter()
+
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        _log.exception('[%s] Job "%s" failed', context, fn.__name__)
+        raise
+    finally:
+        _job_seconds.observe(time.perf_counter() - started, job=fn.__name__)
+        with _inflight_lock:
+            _inflight -= 1
+
+
+def _collect_metrics():
+    return [
+        ('jobs_in_flight', 'gauge', 'Background jobs queued or running', [({}, _inflight)]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
@@ -1,19 +1,56 @@
+import collections
+import concurrent.futures
+import contextlib
 import datetime as dt
+import functools
+import gzip
 import hashlib
 import json
 import logging
 import os
 import urllib.parse
 import re
+import threading
+import time
 import xml.etree.ElementTree as et
 
 import requests
 
+import cache
+import extents
+import geometry
+import metrics
+import rasters
+import sessions
+import tracing
+
 
 LEGION_SCHEME = os.getenv('LEGION_SCHEME', 'http')
 LEGION_HOST = os.getenv('LEGION_HOST')
 LEGION_TOKEN = os.getenv('LEGION_TOKEN')
 LEGION_CACHE_DIR = os.getenv('LEGION_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'cache'))
+LEGION_CACHE_MAX_BYTES = int(os.getenv('LEGION_CACHE_MAX_BYTES', 20 * 1024 ** 3))
+LEGION_CACHE_TTL = int(os.getenv('LEGION_CACHE_TTL', 30 * 86400))
+LEGION_POOL_SIZE = int(os.getenv('LEGION_POOL_SIZE', 10))
+LEGION_KEEP_ALIVE = os.getenv('LEGION_KEEP_ALIVE', '1') == '1'
+LEGION_CONNECT_TIMEOUT = float(os.getenv('LEGION_CONNECT_TIMEOUT', 10))
+LEGION_READ_TIMEOUT = float(os.getenv('LEGION_READ_TIMEOUT', 600))
+LEGION_LOOKUP_READ_TIMEOUT = float(os.getenv('LEGION_LOOKUP_READ_TIMEOUT', 30))
+LEGION_LOOKUP_RETRIES = int(os.getenv('LEGION_LOOKUP_RETRIES', 2))
+LEGION_LOOKUP_HEDGE_AFTER = float(os.getenv('LEGION_LOOKUP_HEDGE_AFTER', 0))
+LEGION_BREAKER_THRESHOLD = int(os.getenv('LEGION_BREAKER_THRESHOLD', 5))
+LEGION_BREAKER_RESET_TIMEOUT = float(os.getenv('LEGION_BREAKER_RESET_TIMEOUT', 30))
+LEGION_OPTIMIZE_GEOTIFFS = os.getenv('LEGION_OPTIMIZE_GEOTIFFS', '1') == '1'
+LEGION_SOURCES_MAX_AGE = int(os.getenv('LEGION_SOURCES_MAX_AGE', 86400))
+LEGION_SOURCES_REFRESH_AHEAD = int(os.getenv('LEGION_SOURCES_REFRESH_AHEAD', 3600))
+LEGION_SOURCES_RETRY_INTERVAL = int(os.getenv('LEGION_SOURCES_RETRY_INTERVAL', 60))
+
+# Operations whose output over an extent can be cropped out of their output
+# over a larger one.  Hillshade is computed pixel by pixel; a cost surface
+# cropped from a larger one may route through cheaper terrain outside the
+# requested extent, which is the more faithful answer anyway.
+LEGION_CROPPABLE_OPERATIONS = tuple(filter(None, os.getenv(
+    'LEGION_CROPPABLE_OPERATIONS', 'LegionHillshadeOperation,LegionCostSurfaceOperation').split(',')))
 
 READ_SIZE = 8192
 
@@ -21,9 +58,44 @@ FORMAT_KML     = 'KML'
 FORMAT_GEOTIFF = 'GEOTIFF'
 FORMAT_PNG     = 'PNG'
 
+KML_NAMESPACE = 'http://www.opengis.net/kml/2.2'
+
+SOURCES_INDEX_KEY = 'datasource'
+
+FOOTPRINTS_COMPRESSION_LEVEL = 9
+
 
 _log = logging.getLogger(__name__)
 
+_cache = None
+_cache_lock = threading.Lock()
+
+_extents = None
+_extents_lock = threading.Lock()
+
+_breaker = sessions.CircuitBreaker(LEGION_BREAKER_THRESHOLD, LEGION_BREAKER_RESET_TIMEOUT)
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+_sources = None
+_sources_lock = threading.Lock()
+_sources_refresh_after = 0.0
+_sources_refreshing = False
+
+_footprints = {}
+_footprints_lock = threading.Lock()
+
+_footprint_collection = None
+_footprint_collection_lock = threading.Lock()
+
+_execute_seconds = metrics.histogram(
+    'legion_execute_seconds', 'Time taken by Legion to execute an operation and stream back its output',
+    ('operation', 'source'))
+_cache_requests = metrics.counter(
+    'legion_cache_requests_total', 'Executions read from cache ("hit"), cropped out of a cached output ("crop") '
+    'or sent to Legion ("miss")', ('operation', 'result'))
+
 
 def execute(operation, source, format_, params, bbox=None, context=None):
     """
@@ -38,61 +110,284 @@ def execute(operation, source, format_, params, bbox=None, context=None):
 
     _check_settings()
 
-    serialized_params = ','.join(':'.join([k, str(v)]) for k, v in sorted(params.items()))
+    serialized_params = _serialize_params(params)
 
-    cachefile_path = _create_filepath(operation, source, format_, serialized_params, bbox)
+    filename = os.path.basename(_create_filepath(operation, source, format_, serialized_params, bbox))
 
-    if os.path.exists(cachefile_path):
-        _log.info('[%s] Read "%s" from cache', context, os.path.basename(cachefile_path))
+    with tracing.span('legion.cache_lookup'):
+        cachefile_path = _get_cache().lookup(filename)
+    if cachefile_path:
+        _log.info('[%s] Read "%s" from cache', context, filename)
+        _cache_requests.inc(operation=operation, result='hit')
         return cachefile_path
 
-    url_params = {
-        'REQUEST': 'Execute',
-        'FORMAT': format_,
-        'DATASOURCE': source,
-        'OPERATION': operation,
-        'PARAMETERS': serialized_params,
-    }
+    return _single_flight(filename, _fetch, operation, source, format_, serialized_params, bbox, filename, context)
 
-    if bbox:
-        url_params['BBOX'] = bbox
 
-    url = '{}://{}/legion/?token={}&{}'.format(
-        LEGION_SCHEME,
-        LEGION_HOST,
-        LEGION_TOKEN,
-        '&'.join('{}={}'.format(k, v) for k, v in url_params.items()),
-    )
+def optimize_geotiff(filepath, context=None):
+    """
+    Rewrites a cached GeoTIFF in place as a Cloud-Optimized one (tiled,
+    compressed, with overviews), so it takes up a single cache entry which
+    later executions with the same parameters read as is.  Leaves it alone
+    when it already is one or cannot be converted.
 
-    _log.info('[%s] Execute "%s"', context, url)
+    :type filepath: unicode
+    :type context: unicode?
+    :rtype: unicode
+    """
+    if not LEGION_OPTIMIZE_GEOTIFFS:
+        return filepath
+
+    filename = os.path.basename(filepath)
+
+    return _single_flight('optimize:' + filename, _optimize, filepath, filename, context)
+
+
+def find_cached(operation, source, format_, params, bbox=None):
+    """
+    Returns the cached output of an execution, if it is still cached,
+    without executing it otherwise.
+
+    :type operation: unicode
+    :type source: unicode
+    :type format_: unicode
+    :type params: dict
+    :type bbox: unicode?
+    :rtype: unicode?
+    """
+
+    _check_settings()
+
+    filename = os.path.basename(_create_filepath(operation, source, format_, _serialize_params(params), bbox))
+
+    return _get_cache().lookup(filename)
+
+
+def get_sources(bbox=None):
+    """
+    :type bbox: (float, float, float, float)? -- (west, south, east, north);
+                                                  only datasources whose
+                                                  extent intersects it
+    :rtype: list[dict]
+    """
+    _, sources, by_id, index = _get_source_index()
+
+    if bbox is None:
+        return sources
+
+    return [by_id[source_id] for source_id in index.find_intersecting(SOURCES_INDEX_KEY, bbox)]
+
+
+def get_source(source):
+    """
+    :type source: unicode
+    :rtype: dict?
+    """
+    return _get_source_index()[2].get(source)
+
+
+def get_source_footprint(source, tolerance=None):
+    """
+    :type source: unicode
+    :type tolerance: float?
+    :rtype: dict
+    """
+    if tolerance:
+        return _simplify_footprint(source, tolerance)
+
+    # Footprints are refetched along with the datasource listing
+    fetched_at = _get_source_index()[0]
+
+    with _footprints_lock:
+        cached_fetched_at, feature = _footprints.get(source, (None, None))
+
+    if cached_fetched_at != fetched_at:
+        feature = _fetch_source_footprint(source, fetched_at)
+        with _footprints_lock:
+            _footprints[source] = (fetched_at, feature)
+
+    return feature
+
+
+def get_footprint_collection():
+    """
+    Returns the footprints of every datasource as one precomputed
+    FeatureCollection, built once per datasource listing.  Footprints that
+    could not be fetched are left out and retried after
+    `LEGION_SOURCES_RETRY_INTERVAL`.
+
+    :rtype: FootprintCollection
+    """
+    global _footprint_collection
+
+    fetched_at, sources, _, _ = _get_source_index()
+
+    with _footprint_collection_lock:
+        collection = _footprint_collection
+        if collection is None or collection.catalog_fetched_at != fetched_at or \
+                (not collection.complete and time.time() - collection.created >= LEGION_SOURCES_RETRY_INTERVAL):
+            collection = _footprint_collection = _build_footprint_collection(fetched_at, sources)
+        return collection
+
+
+class FootprintCollection:
+    """
+    GeoJSON FeatureCollection of datasource footprints, serialized and
+    gzipped up front so it can be served from memory as-is.  Features are
+    also kept serialized individually, so subsets are assembled without
+    encoding any JSON.
+    """
+
+    def __init__(self, catalog_fetched_at, features, complete):
+        """
+        :type catalog_fetched_at: float -- when the datasource listing the
+                                           collection was built from was
+                                           fetched
+        :type features: list[dict]
+        :type complete: bool -- whether every datasource has a footprint
+        """
+        self.catalog_fetched_at = catalog_fetched_at
+        self.complete = complete
+        self.created = time.time()
+
+        self._features = collections.OrderedDict(
+            (f['properties']['id'], json.dumps(f, separators=(',', ':')).encode()) for f in features)
+
+        self.body = self.serialize()
+        self.gzipped = gzip.compress(self.body, FOOTPRINTS_COMPRESSION_LEVEL)
+        self.version = hashlib.sha1(self.body).hexdigest()[:16]
+
+    def __len__(self):
+        return len(self._features)
+
+    def serialize(self, source_ids=None):
+        """
+        :type source_ids: list[unicode]? -- defaults to every datasource
+        :rtype: bytes
+        """
+        if source_ids is None:
+            fragments = self._features.values()
+        else:
+            fragments = [self._features[i] for i in source_ids if i in self._features]
+
+        return b'{"type":"FeatureCollection","features":[' + b','.join(fragments) + b']}'
+
+
+class Error(Exception):
+    pass
+
+
+class ExecutionFailed(Error):
+    def __init__(self, response):
+        super(Error, self).__init__('execution failed with HTTP {}'.format(response.status_code))
+        self.status = response.status_code
+        self.body = response.text
+
+
+#
+# Helpers
+#
+
+
+def _get_source_index():
+    """
+    Returns the datasource listing along with indexes of it by ID and by
+    extent.  Only the first call waits on Legion (or the copy on disk);
+    once the listing nears `LEGION_SOURCES_MAX_AGE` it is refreshed in the
+    background while the current one keeps being served, past its age if
+    need be, until the refresh succeeds.
+
+    :rtype: (float, list[dict], dict, extents.ExtentIndex)
+    """
+    global _sources, _sources_refresh_after, _sources_refreshing
+
+    with _sources_lock:
+        if _sources is None:
+            _sources = _load_sources()
+            _sources_refresh_after = _sources[0] + LEGION_SOURCES_MAX_AGE - LEGION_SOURCES_REFRESH_AHEAD
+
+        catalog = _sources
+        refresh = not _sources_refreshing and time.time() >= _sources_refresh_after
+        if refresh:
+            _sources_refreshing = True
+
+    if refresh:
+        _log.info('Datasources were fetched %ds ago, refreshing in the background', time.time() - catalog[0])
+        threading.Thread(target=_refresh_sources, name='sources-refresh', daemon=True).start()
+
+    return catalog
+
+
+def _load_sources():
+    """
+    :rtype: (float, list[dict], dict, extents.ExtentIndex)
+    """
+    cachefile_path = _get_sources_cachefile_path()
+
+    if os.path.exists(cachefile_path):
+        _log.info('Read "%s" from cache', os.path.basename(cachefile_path))
+        try:
+            with open(cachefile_path) as f:
+                return _index_sources(os.path.getmtime(cachefile_path), json.load(f))
+        except (OSError, ValueError) as err:
+            _log.warning('Discarding unreadable "%s": %s', os.path.basename(cachefile_path), err)
+
+    sources = _fetch_sources(cachefile_path)
+    return _index_sources(os.path.getmtime(cachefile_path), sources)
+
+
+def _index_sources(fetched_at, sources):
+    """
+    :type fetched_at: float -- UNIX timestamp; the modification time of the
+                               listing's copy on disk, so it survives restarts
+    :type sources: list[dict]
+    :rtype: (float, list[dict], dict, extents.ExtentIndex)
+    """
+    index = extents.ExtentIndex(':memory:')
+    for source in sources:
+        index.add(SOURCES_INDEX_KEY, source['id'], source['bbox'])
+
+    return fetched_at, sources, {s['id']: s for s in sources}, index
+
+
+def _refresh_sources():
+    """
+    Fetches the datasource listing from Legion and swaps it in, leaving
+    the current one in place if that fails.
+    """
+    global _sources, _sources_refresh_after, _sources_refreshing
 
     try:
-        response = requests.get(url, verify=False, stream=True)
-    except requests.ConnectionError as err:
-        _log.error('[%s] Legion is unreachable'
-                   '---\n\n'
-                   'Error: %s\n\n'
-                   'URL: %s\n\n'
-                   '---',
-                   context, err, url)
-        raise Error('Legion is unreachable: {}'.format(err))
+        cachefile_path = _get_sources_cachefile_path()
+        sources = _fetch_sources(cachefile_path)
+        catalog = _index_sources(os.path.getmtime(cachefile_path), sources)
+    except Exception as err:
+        _log.error('Could not refresh datasources, retrying in %ss: %s', LEGION_SOURCES_RETRY_INTERVAL, err)
+        with _sources_lock:
+            _sources_refresh_after = time.time() + LEGION_SOURCES_RETRY_INTERVAL
+            _sources_refreshing = False
+        return
 
-    if not response.ok:
-        _log.error('[%s] Execution failed: Legion returned HTTP %s:\n'
-                   '---\n'
-                   'Response: %s\n'
-                   '---',
-                   context, response.status_code, response.text)
-        raise ExecutionFailed(response)
+    with _sources_lock:
+        _sources = catalog
+        _sources_refresh_after = catalog[0] + LEGION_SOURCES_MAX_AGE - LEGION_SOURCES_REFRESH_AHEAD
+        _sources_refreshing = False
 
-    with open(cachefile_path, 'wb') as f:
-        for chunk in response.iter_content(READ_SIZE):
-            f.write(chunk)
+    _log.info('Refreshed datasources (%d found)', len(catalog[1]))
 
-    return cachefile_path
+    _simplify_footprint.cache_clear()
 
+    try:
+        get_footprint_collection()
+    except Exception as err:
+        _log.error('Could not rebuild the footprint collection: %s', err)
+
+
+def _get_sources_cachefile_path():
+    return os.path.join(LEGION_CACHE_DIR, 'DATASOURCES_{:%Y%m%d}.JSON'.format(dt.datetime.utcnow()))
 
-def get_sources():
+
+def _fetch_sources(cachefile_path):
     _check_settings()
 
     url = '{}://{}/legion/?token={}&{}'.format(
@@ -105,16 +400,10 @@ def get_sources():
         }),
     )
 
-    cachefile_path = os.path.join(LEGION_CACHE_DIR, 'DATASOURCES_{:%Y%m%d}.JSON'.format(dt.datetime.utcnow()))
-    if os.path.exists(cachefile_path):
-        _log.info('Read "%s" from cache', os.path.basename(cachefile_path))
-        with open(cachefile_path) as f:
-            return json.load(f)
-
     _log.info('Looking up available datasources via "%s"', url)
     try:
-        response = requests.get(url, verify=False)
-    except requests.ConnectionError as err:
+        response = _lookup(url)
+    except (requests.ConnectionError, requests.Timeout) as err:
         _log.error('Legion is unreachable'
                    '---\n\n'
                    'Error: %s\n\n'
@@ -148,13 +437,18 @@ def get_sources():
                    response.text)
         raise Error('malformed response')
 
-    with open(cachefile_path, 'w') as f:
-        json.dump(sources, f, indent=4)
+    _write_json(cachefile_path, sources)
 
     return sources
 
 
-def get_source_footprint(source):
+def _fetch_source_footprint(source, fetched_at):
+    """
+    :type source: unicode
+    :type fetched_at: float -- when the current datasource listing was
+                               fetched; older copies on disk are stale
+    :rtype: dict
+    """
     url = '{}://{}/legion/?token={}&{}'.format(
         LEGION_SCHEME,
         LEGION_HOST,
@@ -167,14 +461,20 @@ def get_source_footprint(source):
 
     cachefile_path = os.path.join(LEGION_CACHE_DIR, 'DATASOURCE_FOOTPRINT_{}.JSON'.format(source))
     if os.path.exists(cachefile_path):
-        _log.info('Read "%s" from cache', os.path.basename(cachefile_path))
-        with open(cachefile_path) as f:
-            return json.load(f)
+        try:
+            with open(cachefile_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as err:
+            _log.warning('Discarding unreadable "%s": %s', os.path.basename(cachefile_path), err)
+        else:
+            if isinstance(cached, dict) and cached.get('fetched_at') == fetched_at:
+                _log.info('Read "%s" from cache', os.path.basename(cachefile_path))
+                return cached['feature']
 
     _log.info('Fetching footprint for datasource "%s" via "%s"', source, url)
     try:
-        response = requests.get(url, verify=False)
-    except requests.ConnectionError as err:
+        response = _lookup(url, stream=True)
+    except (requests.ConnectionError, requests.Timeout) as err:
         _log.error('Legion is unreachable'
                    '---\n\n'
                    'Error: %s\n\n'
@@ -189,20 +489,14 @@ def get_source_footprint(source):
                    response.status_code, response.text)
         raise Error('Legion returned HTTP {}'.format(response.status_code))
 
-    xmlns = {
-        'kml': 'http://www.opengis.net/kml/2.2',
-    }
-
-    doc = et.fromstring(response.text)
-
-    properties = None
-    for d in get_sources():
-        if d['id'] == source:
-            properties = d
-
-    coordinates = []
-    for node in doc.findall('.//kml:LinearRing/kml:coordinates', xmlns):
-        coordinates.append([[float(coord) for coord in pairs.split(',')] for pairs in node.text.strip().split()])
+    response.raw.decode_content = True
+    try:
+        coordinates = list(_parse_kml_rings(response.raw))
+    except et.ParseError as err:
+        _log.error('Legion returned malformed footprint for datasource "%s": %s', source, err)
+        raise Error('malformed response')
+    finally:
+        response.close()
 
     feature = {
         'type': 'Feature',
@@ -210,29 +504,95 @@ def get_source_footprint(source):
             'type': 'Polygon',
             'coordinates': coordinates,
         },
-        'properties': properties,
+        'properties': get_source(source),
     }
 
-    with open(cachefile_path, 'w') as f:
-        json.dump(feature, f, indent=4)
+    _write_json(cachefile_path, {'fetched_at': fetched_at, 'feature': feature})
 
     return feature
 
 
-class Error(Exception):
-    pass
+def _write_json(filepath, value):
+    """
+    Writes to a temporary file renamed into place, so concurrent readers
+    never see a partial document.
+    """
+    partial_path = '{}.{}{}'.format(filepath, os.urandom(4).hex(), cache.PARTIAL_SUFFIX)
+    try:
+        with open(partial_path, 'w') as f:
+            json.dump(value, f, indent=4)
+        os.replace(partial_path, filepath)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(partial_path)
+        raise
 
 
-class ExecutionFailed(Error):
-    def __init__(self, response):
-        super(Error, self).__init__('execution failed with HTTP {}'.format(response.status_code))
-        self.status = response.status_code
-        self.body = response.text
+def _parse_kml_rings(stream):
+    """
+    Incrementally parses a KML document, yielding the coordinates of each
+    `LinearRing` without holding the whole tree in memory.
+    """
+    ring_tag = '{{{}}}LinearRing'.format(KML_NAMESPACE)
+    coordinates_tag = '{{{}}}coordinates'.format(KML_NAMESPACE)
 
+    ring_depth = 0
+    for event, elem in et.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == ring_tag:
+                ring_depth += 1
+            continue
 
-#
-# Helpers
-#
+        if elem.tag == ring_tag:
+            ring_depth -= 1
+        elif elem.tag == coordinates_tag and ring_depth:
+            yield [[float(coord) for coord in pairs.split(',')] for pairs in elem.text.strip().split()]
+
+        elem.clear()
+
+
+def _build_footprint_collection(fetched_at, sources):
+    """
+    :type fetched_at: float
+    :type sources: list[dict]
+    :rtype: FootprintCollection
+    """
+    started = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LEGION_POOL_SIZE) as executor:
+        futures = [executor.submit(get_source_footprint, s['id']) for s in sources]
+
+    features = []
+    for source, future in zip(sources, futures):
+        try:
+            feature = future.result()
+        except Error as err:
+            _log.warning('Leaving datasource "%s" out of the footprint collection: %s', source['id'], err)
+            continue
+        features.append({**feature, 'properties': source})
+
+    collection = FootprintCollection(fetched_at, features, complete=len(features) == len(sources))
+
+    _log.info('Built footprint collection of %d/%d datasources (%d bytes, %d gzipped) in %.2fs',
+              len(features), len(sources), len(collection.body), len(collection.gzipped),
+              time.perf_counter() - started)
+
+    return collection
+
+
+@functools.lru_cache(maxsize=256)
+def _simplify_footprint(source, tolerance):
+    feature = get_source_footprint(source)
+
+    _log.info('Simplifying footprint for datasource "%s" (tolerance=%s)', source, tolerance)
+
+    return {
+        **feature,
+        'geometry': {
+            'type': 'Polygon',
+            'coordinates': [geometry.simplify_ring(ring, tolerance) for ring in feature['geometry']['coordinates']],
+        },
+    }
 
 
 def _check_settings():
@@ -252,6 +612,82 @@ def _check_settings():
         raise Error(''.join(errors))
 
 
+def _get_cache():
+    """
+    :rtype: cache.Cache
+    """
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = cache.Cache(LEGION_CACHE_DIR, max_bytes=LEGION_CACHE_MAX_BYTES, ttl=LEGION_CACHE_TTL)
+        return _cache
+
+
+def _collect_cache_metrics():
+    if not os.path.isdir(LEGION_CACHE_DIR):
+        return []
+
+    stats = _get_cache().stats()
+
+    return [
+        ('legion_cache_entries', 'gauge', 'Files in the Legion cache', [({}, stats['entries'])]),
+        ('legion_cache_bytes', 'gauge', 'Size of the Legion cache', [({}, stats['bytes'])]),
+        ('legion_cache_max_bytes', 'gauge', 'Size the Legion cache is kept within', [({}, stats['max_bytes'])]),
+    ]
+
+
+metrics.register_collector(_collect_cache_metrics)
+
+
+def _get_extents():
+    """
+    :rtype: extents.ExtentIndex
+    """
+    global _extents
+
+    with _extents_lock:
+        if _extents is None:
+            _extents = extents.ExtentIndex(os.path.join(LEGION_CACHE_DIR, extents.INDEX_FILENAME))
+        return _extents
+
+
+def _get_session(lookups=False):
+    """
+    Lookups have a connection pool of their own, so they never wait for a
+    connection behind long-running executions holding every one of them.
+    Both share the circuit breaker, as they share the upstream.
+
+    :type lookups: bool
+    :rtype: sessions.PooledSession
+    """
+    session = sessions.get_session(
+        'legion-lookups' if lookups else 'legion',
+        pool_size=LEGION_POOL_SIZE,
+        keep_alive=LEGION_KEEP_ALIVE,
+        connect_timeout=LEGION_CONNECT_TIMEOUT,
+        read_timeout=LEGION_LOOKUP_READ_TIMEOUT if lookups else LEGION_READ_TIMEOUT,
+        breaker=_breaker,
+    )
+    session.verify = False
+    return session
+
+
+def _lookup(url, **kwargs):
+    """
+    Issues a cheap, idempotent request, which can afford a tighter deadline
+    than an execution, retries, and hedging.
+
+    :rtype: requests.Response
+    """
+    return _get_session(lookups=True).get(
+        url,
+        retries=LEGION_LOOKUP_RETRIES,
+        hedge_after=LEGION_LOOKUP_HEDGE_AFTER or None,
+        **kwargs
+    )
+
+
 def _create_filepath(operation, source, format_, params, bbox):
     filename = '{operation}___{source}___{param_hash}.{extension}'.format(
         operation=operation, source=source,
@@ -259,3 +695,197 @@ def _create_filepath(operation, source, format_, params, bbox):
         extension=re.sub(r'^GEO', '', format_).upper(),
     )
     return os.path.join(LEGION_CACHE_DIR, filename.upper())
+
+
+def _serialize_params(params):
+    return ','.join(':'.join([k, str(v)]) for k, v in sorted(params.items()))
+
+
+def _fetch(operation, source, format_, serialized_params, bbox, filename, context):
+    cachefile_path = _get_cache().lookup(filename)
+    if cachefile_path:
+        _log.info('[%s] Read "%s" from cache (written by a concurrent execution)', context, filename)
+        _cache_requests.inc(operation=operation, result='hit')
+        return cachefile_path
+
+    extent_key = None
+    if bbox and format_ == FORMAT_GEOTIFF and operation in LEGION_CROPPABLE_OPERATIONS:
+        extent_key = '{}|{}|{}|{}'.format(operation, source, format_, serialized_params)
+        with tracing.span('legion.crop_cached'):
+            cachefile_path = _crop_cached(extent_key, bbox, filename, context)
+        if cachefile_path:
+            _cache_requests.inc(operation=operation, result='crop')
+            return cachefile_path
+
+    _cache_requests.inc(operation=operation, result='miss')
+
+    url_params = {
+        'REQUEST': 'Execute',
+        'FORMAT': format_,
+        'DATASOURCE': source,
+        'OPERATION': operation,
+        'PARAMETERS': serialized_params,
+    }
+
+    if bbox:
+        url_params['BBOX'] = bbox
+
+    url = '{}://{}/legion/?token={}&{}'.format(
+        LEGION_SCHEME,
+        LEGION_HOST,
+        LEGION_TOKEN,
+        '&'.join('{}={}'.format(k, v) for k, v in url_params.items()),
+    )
+
+    _log.info('[%s] Execute "%s"', context, url)
+
+    started = time.perf_counter()
+
+    try:
+        response = _get_session().get(url, stream=True)
+    except (requests.ConnectionError, requests.Timeout) as err:
+        _log.error('[%s] Legion is unreachable'
+                   '---\n\n'
+                   'Error: %s\n\n'
+                   'URL: %s\n\n'
+                   '---',
+                   context, err, url)
+        raise Error('Legion is unreachable: {}'.format(err))
+
+    if not response.ok:
+        _log.error('[%s] Execution failed: Legion returned HTTP %s:\n'
+                   '---\n'
+                   'Response: %s\n'
+                   '---',
+                   context, response.status_code, response.text)
+        raise ExecutionFailed(response)
+
+    # Headers are in once `get()` returns; the body is still streaming
+    first_byte = time.perf_counter()
+    tracing.record('legion.first_byte', started, first_byte)
+
+    write_seconds = 0
+    try:
+        with _get_cache().write(filename) as f:
+            for chunk in response.iter_content(READ_SIZE):
+                write_started = time.perf_counter()
+                f.write(chunk)
+                write_seconds += time.perf_counter() - write_started
+            body_ended = time.perf_counter()
+    except requests.RequestException as err:
+        _log.error('[%s] Legion stream was interrupted:\n'
+                   '---\n\n'
+                   'Error: %s\n\n'
+                   'URL: %s\n\n'
+                   '---',
+                   context, err, url)
+        raise Error('Legion stream was interrupted: {}'.format(err))
+
+    ended = time.perf_counter()
+    _execute_seconds.observe(ended - started, operation=operation, source=source)
+
+    tracing.record('legion.request', started, ended)
+    tracing.record('legion.body', first_byte, body_ended)
+    # Writes are interleaved with reads, so they are reported as one span
+    # of their combined length, plus syncing the file, ending once it is in
+    # the cache
+    tracing.record('legion.file_write', body_ended - write_seconds, ended)
+
+    if extent_key:
+        _index_extent(extent_key, filename, context)
+
+    return os.path.join(LEGION_CACHE_DIR, filename)
+
+
+def _crop_cached(extent_key, bbox, filename, context):
+    """
+    Crops the output for `bbox` out of a cached output covering it, if
+    there is one.
+    """
+    extent = tuple(float(n) for n in bbox.split(','))
+
+    for cached_filename in _get_extents().find_containing(extent_key, extent):
+        cached_path = _get_cache().lookup(cached_filename)
+        if not cached_path:
+            _get_extents().remove(cached_filename)
+            continue
+
+        try:
+            raster = rasters.open_raster(cached_path)
+        except rasters.Unsupported as err:
+            _log.warning('[%s] Cannot crop "%s": %s', context, cached_filename, err)
+            return None
+
+        with _get_cache().write(filename) as f:
+            rasters.write_cog(raster, f, window=raster.window(*extent))
+
+        _log.info('[%s] Cropped "%s" out of cached "%s"', context, filename, cached_filename)
+        _index_extent(extent_key, filename, context)
+
+        return os.path.join(LEGION_CACHE_DIR, filename)
+
+    return None
+
+
+def _index_extent(extent_key, filename, context):
+    try:
+        raster = rasters.open_raster(os.path.join(LEGION_CACHE_DIR, filename))
+    except rasters.Unsupported as err:
+        _log.info('[%s] Not indexing extent of "%s": %s', context, filename, err)
+        return
+
+    _get_extents().add(extent_key, filename, raster.bounds)
+
+
+def _optimize(filepath, filename, context):
+    try:
+        raster = rasters.open_raster(filepath)
+    except rasters.Unsupported as err:
+        _log.warning('[%s] Publishing "%s" as is: %s', context, filepath, err)
+        return filepath
+
+    if raster.is_cloud_optimized:
+        return filepath
+
+    started = time.monotonic()
+
+    # The original stays mapped for reading until the optimized copy is
+    # renamed over it
+    with tracing.span('legion.optimize'), _get_cache().write(filename) as f:
+        rasters.write_cog(raster, f)
+
+    _log.info('[%s] Optimized "%s" in %.2fs', context, filepath, time.monotonic() - started)
+
+    return filepath
+
+
+def _single_flight(key, fn, *args):
+    """
+    Collapses concurrent calls sharing `key` into a single call to `fn`;
+    every other caller blocks until that call completes and receives the
+    same result (or exception).
+    """
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = concurrent.futures.Future()
+            _inflight[key] = future
+
+    if not is_leader:
+        _log.info('Waiting on in-flight execution "%s"', key)
+        with tracing.span('legion.wait_in_flight'):
+            return future.result()
+
+    try:
+        result = fn(*args)
+    except BaseException as err:
+        future.set_exception(err)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
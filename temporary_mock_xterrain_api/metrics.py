@@ -0,0 +1,254 @@
+import bisect
+import contextlib
+import logging
+import math
+import threading
+import time
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; spans fast cache reads through multi-minute Legion executions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+_log = logging.getLogger(__name__)
+
+_metrics = {}
+_collectors = []
+_registry_lock = threading.Lock()
+
+
+class Counter:
+    """
+    Monotonically increasing count, optionally broken down by labels.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help_, labels=()):
+        """
+        :type name: unicode
+        :type help_: unicode
+        :type labels: tuple[unicode]
+        """
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        """
+        :type amount: float
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        """
+        :rtype: list[(unicode, dict, float)]
+        """
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, dict(zip(self.labels, key)), value) for key, value in values]
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down.
+    """
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """
+        :type value: float
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        """
+        :type amount: float
+        """
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    """
+    Distribution of observations over fixed buckets.
+
+    Observing costs a binary search and one locked increment; buckets are
+    only made cumulative when rendered.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        :type name: unicode
+        :type help_: unicode
+        :type labels: tuple[unicode]
+        :type buckets: tuple[float] -- upper bounds, ascending
+        """
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        """
+        :type value: float
+        """
+        key = tuple(str(labels[name]) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observes how long the block takes, whether or not it raises.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        """
+        :rtype: list[(unicode, dict, float)]
+        """
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+
+        samples = []
+        for key, values in series:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values):
+                cumulative += count
+                samples.append((self.name + '_bucket', {**labels, 'le': _format_value(bound)}, cumulative))
+            samples.append((self.name + '_sum', labels, values[-1]))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+def counter(name, help_, labels=()):
+    """
+    :type name: unicode
+    :type help_: unicode
+    :type labels: tuple[unicode]
+    :rtype: Counter
+    """
+    return _register(Counter(name, help_, labels))
+
+
+def gauge(name, help_, labels=()):
+    """
+    :type name: unicode
+    :type help_: unicode
+    :type labels: tuple[unicode]
+    :rtype: Gauge
+    """
+    return _register(Gauge(name, help_, labels))
+
+
+def histogram(name, help_, labels=(), buckets=DEFAULT_BUCKETS):
+    """
+    :type name: unicode
+    :type help_: unicode
+    :type labels: tuple[unicode]
+    :type buckets: tuple[float]
+    :rtype: Histogram
+    """
+    return _register(Histogram(name, help_, labels, buckets))
+
+
+def register_collector(fn):
+    """
+    Registers a function to be called on every scrape, for values that
+    are cheaper to read when asked for than to keep up to date, e.g., the
+    size of a cache.  It returns an iterable of
+    `(name, kind, help, [(labels, value), ...])`.
+
+    :type fn: callable
+    """
+    with _registry_lock:
+        _collectors.append(fn)
+
+
+def render():
+    """
+    Renders every metric in the Prometheus text exposition format.
+
+    :rtype: unicode
+    """
+    with _registry_lock:
+        metrics = sorted(_metrics.values(), key=lambda m: m.name)
+        collectors = list(_collectors)
+
+    families = [(m.name, m.kind, m.help, m.samples()) for m in metrics]
+
+    for collect in collectors:
+        try:
+            families.extend(
+                (name, kind, help_, [(name, labels, value) for labels, value in samples])
+                for name, kind, help_, samples in collect()
+            )
+        except Exception as err:
+            _log.warning('Metrics collector "%s" failed: %s', collect.__name__, err)
+
+    lines = []
+    for name, kind, help_, samples in families:
+        lines.append('# HELP {} {}'.format(name, help_.replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for sample_name, labels, value in samples:
+            lines.append('{}{} {}'.format(sample_name, _format_labels(labels), _format_value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+#
+# Helpers
+#
+
+
+def _register(metric):
+    with _registry_lock:
+        if metric.name in _metrics:
+            raise ValueError('metric "{}" is already registered'.format(metric.name))
+        _metrics[metric.name] = metric
+    return metric
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape_label_value(v)) for k, v in labels.items()) + '}'
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
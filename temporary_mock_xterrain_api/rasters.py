@@ -0,0 +1,711 @@
+import functools
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+CHUNK_CACHE_SIZE = 64
+OPEN_RASTERS_MAX = 32
+
+COG_TILE_SIZE = 256
+COG_COMPRESSION_LEVEL = 6
+
+COMPRESSION_NONE = 1
+COMPRESSION_LZW = 5
+COMPRESSION_DEFLATE = 8
+COMPRESSION_DEFLATE_OLD = 32946
+COMPRESSION_PACKBITS = 32773
+
+PREDICTOR_NONE = 1
+PREDICTOR_HORIZONTAL = 2
+PREDICTOR_FLOATING_POINT = 3
+
+TAG_NEW_SUBFILE_TYPE = 254
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_PLANAR_CONFIGURATION = 284
+TAG_PREDICTOR = 317
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+TAG_SAMPLE_FORMAT = 339
+TAG_MODEL_PIXEL_SCALE = 33550
+TAG_MODEL_TIEPOINT = 33922
+TAG_MODEL_TRANSFORMATION = 34264
+TAG_GEO_KEY_DIRECTORY = 34735
+TAG_GEO_DOUBLE_PARAMS = 34736
+TAG_GEO_ASCII_PARAMS = 34737
+TAG_GDAL_NODATA = 42113
+
+TYPE_ASCII = 2
+TYPE_SHORT = 3
+TYPE_LONG = 4
+TYPE_DOUBLE = 12
+TYPE_LONG8 = 16
+
+GEO_KEY_RASTER_TYPE = 1025
+RASTER_PIXEL_IS_POINT = 2
+
+
+_log = logging.getLogger(__name__)
+
+# TIFF field type -> (struct format, size)
+_FIELD_TYPES = {
+    1: ('B', 1),   # BYTE
+    2: ('s', 1),   # ASCII
+    3: ('H', 2),   # SHORT
+    4: ('I', 4),   # LONG
+    5: ('II', 8),  # RATIONAL
+    6: ('b', 1),   # SBYTE
+    7: ('B', 1),   # UNDEFINED
+    8: ('h', 2),   # SSHORT
+    9: ('i', 4),   # SLONG
+    10: ('ii', 8), # SRATIONAL
+    11: ('f', 4),  # FLOAT
+    12: ('d', 8),  # DOUBLE
+    16: ('Q', 8),  # LONG8
+    17: ('q', 8),  # SLONG8
+    18: ('Q', 8),  # IFD8
+}
+
+_SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+# Georeferencing carried over from the source raster, with field types
+_GEO_TAGS = {
+    TAG_MODEL_PIXEL_SCALE: TYPE_DOUBLE,
+    TAG_MODEL_TIEPOINT: TYPE_DOUBLE,
+    TAG_MODEL_TRANSFORMATION: TYPE_DOUBLE,
+    TAG_GEO_KEY_DIRECTORY: TYPE_SHORT,
+    TAG_GEO_DOUBLE_PARAMS: TYPE_DOUBLE,
+    TAG_GEO_ASCII_PARAMS: TYPE_ASCII,
+    TAG_GDAL_NODATA: TYPE_ASCII,
+}
+
+_open_lock = threading.Lock()
+
+
+class GeoTiff:
+    """
+    Read-only GeoTIFF in EPSG:4326 supporting sparse reads, i.e., only the
+    strips or tiles holding the requested pixels are read and decoded.
+
+    Uncompressed rasters are memory-mapped, so only the pages backing the
+    requested pixels are ever read.  Overviews, if present, are exposed as
+    levels (0 being full resolution).
+    """
+
+    def __init__(self, path):
+        """
+        :type path: unicode
+        """
+        if np is None:
+            raise Unsupported('reading rasters requires NumPy')
+
+        self.path = path
+
+        with open(path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._byte_order = _read_header(self._mmap)
+        self.images = [_Image(self._mmap, self._byte_order, tags) for tags in _read_ifds(self._mmap)]
+
+        if not self.images:
+            raise Unsupported('"{}" contains no images'.format(path))
+
+        image = self.images[0]
+        self.width = image.width
+        self.height = image.height
+        self.dtype = image.dtype
+        self.nodata = image.nodata
+        self.west, self.north, self.x_resolution, self.y_resolution = _read_georeferencing(image.tags, self.path)
+
+        overviews = [i for i in self.images[1:] if i.reduced and i.dtype == image.dtype and i.width < image.width]
+        self.levels = [image] + sorted(overviews, key=lambda i: -i.width)
+
+    @property
+    def bounds(self):
+        """
+        :rtype: (float, float, float, float) -- (west, south, east, north)
+        """
+        return (
+            self.west,
+            self.north - self.height * self.y_resolution,
+            self.west + self.width * self.x_resolution,
+            self.north,
+        )
+
+    @property
+    def is_cloud_optimized(self):
+        """
+        Whether the raster is tiled, with overviews down to a single tile.
+
+        :rtype: bool
+        """
+        coarsest = self.levels[-1]
+        return (TAG_TILE_WIDTH in self.images[0].tags
+                and coarsest.width <= coarsest.chunk_width
+                and coarsest.height <= coarsest.chunk_height)
+
+    def window(self, west, south, east, north):
+        """
+        Finds the pixels covering an extent, widened outwards to whole
+        pixels and clipped to the raster.
+
+        :type west: float
+        :type south: float
+        :type east: float
+        :type north: float
+        :rtype: (int, int, int, int) -- (column, row, width, height)
+        """
+        # Tolerate floating-point noise at pixel edges
+        epsilon = 1e-6
+
+        first_col = max(math.floor((west - self.west) / self.x_resolution + epsilon), 0)
+        last_col = min(math.ceil((east - self.west) / self.x_resolution - epsilon), self.width)
+        first_row = max(math.floor((self.north - north) / self.y_resolution + epsilon), 0)
+        last_row = min(math.ceil((self.north - south) / self.y_resolution - epsilon), self.height)
+
+        return first_col, first_row, max(last_col - first_col, 1), max(last_row - first_row, 1)
+
+    def level_for(self, resolution):
+        """
+        Picks the coarsest level that is still at least as detailed as
+        `resolution`.
+
+        :type resolution: float -- degrees per pixel
+        :rtype: int
+        """
+        level = 0
+        for i in range(1, len(self.levels)):
+            if self.level_resolution(i)[0] <= resolution:
+                level = i
+        return level
+
+    def level_resolution(self, level):
+        """
+        :type level: int
+        :rtype: (float, float) -- degrees per pixel, horizontally and vertically
+        """
+        image = self.levels[level]
+        return (self.x_resolution * self.width / image.width,
+                self.y_resolution * self.height / image.height)
+
+    def level_size(self, level):
+        """
+        :type level: int
+        :rtype: (int, int) -- width, height
+        """
+        image = self.levels[level]
+        return image.width, image.height
+
+    def sample(self, rows, cols, level=0):
+        """
+        Reads the pixels at the intersections of `rows` and `cols` of the
+        first band.
+
+        :type rows: numpy.ndarray -- sorted, in-bounds row indices
+        :type cols: numpy.ndarray -- sorted, in-bounds column indices
+        :type level: int
+        :rtype: numpy.ndarray
+        """
+        return self.levels[level].sample(rows, cols)
+
+
+class Unsupported(Exception):
+    pass
+
+
+def write_cog(raster, fp, window=None, tile_size=COG_TILE_SIZE):
+    """
+    Writes the first band of a raster as a Cloud-Optimized GeoTIFF:
+    Deflate-compressed tiles plus overviews, each decimated by half, down
+    to a single tile.  All IFDs come first and tile data follows from the
+    coarsest overview to full resolution, so readers fetch just the
+    headers and the tiles they need.
+
+    The source is read one row of tiles at a time, never whole.  Given a
+    `window`, only that part of the raster is written, georeferenced to
+    match.
+
+    :type raster: GeoTiff
+    :type fp: file -- seekable, opened for binary writing
+    :type window: (int, int, int, int)? -- (column, row, width, height), as from `GeoTiff.window()`
+    :type tile_size: int
+    """
+    col_offset, row_offset, full_width, full_height = window or (0, 0, raster.width, raster.height)
+
+    dtype = raster.dtype.newbyteorder('<')
+    predictor = PREDICTOR_FLOATING_POINT if dtype.kind == 'f' else PREDICTOR_HORIZONTAL
+
+    factors = [1]
+    while max(full_width, full_height) > factors[-1] * tile_size:
+        factors.append(factors[-1] * 2)
+
+    levels = []
+    for factor in factors:
+        width, height = -(-full_width // factor), -(-full_height // factor)
+        levels.append({
+            'factor': factor,
+            'width': width,
+            'height': height,
+            'tiles_across': -(-width // tile_size),
+            'tiles_down': -(-height // tile_size),
+        })
+
+    # Offsets only fit in 32 bits below 4 GiB; assume little compression
+    bigtiff = full_width * full_height * dtype.itemsize * 4 // 3 > 0xFFFFFFFF - 2 ** 24
+    offset_type = TYPE_LONG8 if bigtiff else TYPE_LONG
+
+    geo_tags = {tag: raster.images[0].tags[tag] for tag in _GEO_TAGS if tag in raster.images[0].tags}
+    if window:
+        # Re-anchor the window's top-left pixel, as an area or a point
+        # alike to the source
+        half_pixel = 0.5 if _is_pixel_is_point(geo_tags) else 0
+        for tag in (TAG_MODEL_TRANSFORMATION, TAG_MODEL_PIXEL_SCALE, TAG_MODEL_TIEPOINT):
+            geo_tags.pop(tag, None)
+        geo_tags[TAG_MODEL_PIXEL_SCALE] = (raster.x_resolution, raster.y_resolution, 0.0)
+        geo_tags[TAG_MODEL_TIEPOINT] = (0.0, 0.0, 0.0,
+                                        raster.west + (col_offset + half_pixel) * raster.x_resolution,
+                                        raster.north - (row_offset + half_pixel) * raster.y_resolution,
+                                        0.0)
+
+    def build_ifd(level, offsets, byte_counts):
+        entries = [
+            (TAG_NEW_SUBFILE_TYPE, TYPE_LONG, (0 if level['factor'] == 1 else 1,)),
+            (TAG_IMAGE_WIDTH, TYPE_LONG, (level['width'],)),
+            (TAG_IMAGE_LENGTH, TYPE_LONG, (level['height'],)),
+            (TAG_BITS_PER_SAMPLE, TYPE_SHORT, (dtype.itemsize * 8,)),
+            (TAG_COMPRESSION, TYPE_SHORT, (COMPRESSION_DEFLATE,)),
+            (TAG_PHOTOMETRIC, TYPE_SHORT, (1,)),
+            (TAG_SAMPLES_PER_PIXEL, TYPE_SHORT, (1,)),
+            (TAG_PLANAR_CONFIGURATION, TYPE_SHORT, (1,)),
+            (TAG_PREDICTOR, TYPE_SHORT, (predictor,)),
+            (TAG_TILE_WIDTH, TYPE_SHORT, (tile_size,)),
+            (TAG_TILE_LENGTH, TYPE_SHORT, (tile_size,)),
+            (TAG_TILE_OFFSETS, offset_type, offsets),
+            (TAG_TILE_BYTE_COUNTS, offset_type, byte_counts),
+            (TAG_SAMPLE_FORMAT, TYPE_SHORT, ({'u': 1, 'i': 2, 'f': 3}[dtype.kind],)),
+        ]
+        for tag, field_type in _GEO_TAGS.items():
+            if tag in geo_tags and (level['factor'] == 1 or tag == TAG_GDAL_NODATA):
+                entries.append((tag, field_type, geo_tags[tag]))
+        return sorted(entries)
+
+    # Lay out the IFDs with placeholder offsets, which take the same space
+    ifd_offsets = []
+    position = 16 if bigtiff else 8
+    for level in levels:
+        count = level['tiles_across'] * level['tiles_down']
+        ifd_offsets.append(position)
+        position += len(_encode_ifd(build_ifd(level, (0,) * count, (0,) * count), position, 0, bigtiff))
+
+    fp.seek(position)
+
+    for level in reversed(levels):
+        level['offsets'], level['byte_counts'] = [], []
+        factor = level['factor']
+        cols = col_offset + np.arange(level['width']) * factor
+
+        for tile_row in range(level['tiles_down']):
+            first = tile_row * tile_size
+            rows = row_offset + np.arange(first, min(first + tile_size, level['height'])) * factor
+            band = raster.sample(rows, cols)
+
+            for tile_col in range(level['tiles_across']):
+                tile = np.zeros((tile_size, tile_size), dtype)
+                block = band[:, tile_col * tile_size:(tile_col + 1) * tile_size]
+                tile[:block.shape[0], :block.shape[1]] = block
+
+                data = zlib.compress(_apply_predictor(tile, predictor), COG_COMPRESSION_LEVEL)
+                level['offsets'].append(fp.tell())
+                level['byte_counts'].append(len(data))
+                fp.write(data)
+
+    fp.seek(0)
+    if bigtiff:
+        fp.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, ifd_offsets[0]))
+    else:
+        fp.write(b'II' + struct.pack('<HI', 42, ifd_offsets[0]))
+
+    for i, level in enumerate(levels):
+        next_offset = ifd_offsets[i + 1] if i + 1 < len(levels) else 0
+        fp.write(_encode_ifd(build_ifd(level, level['offsets'], level['byte_counts']), ifd_offsets[i], next_offset, bigtiff))
+
+    fp.seek(0, os.SEEK_END)
+
+
+def open_raster(path):
+    """
+    Opens a raster, reusing an already open one unless the file changed.
+
+    :type path: unicode
+    :rtype: GeoTiff
+    """
+    stats = os.stat(path)
+    with _open_lock:
+        return _open_raster(path, stats.st_mtime_ns, stats.st_size)
+
+
+#
+# Helpers
+#
+
+
+@functools.lru_cache(maxsize=OPEN_RASTERS_MAX)
+def _open_raster(path, mtime_ns, size):
+    _log.debug('Opening raster "%s"', path)
+    return GeoTiff(path)
+
+
+class _Image:
+    """
+    A single image (IFD) within a TIFF.
+    """
+
+    def __init__(self, buffer, byte_order, tags):
+        self.tags = tags
+        self._buffer = buffer
+
+        self.width = _scalar(tags, TAG_IMAGE_WIDTH)
+        self.height = _scalar(tags, TAG_IMAGE_LENGTH)
+        self.samples = _scalar(tags, TAG_SAMPLES_PER_PIXEL, 1)
+        self.compression = _scalar(tags, TAG_COMPRESSION, COMPRESSION_NONE)
+        self.predictor = _scalar(tags, TAG_PREDICTOR, PREDICTOR_NONE)
+        self.reduced = bool(_scalar(tags, TAG_NEW_SUBFILE_TYPE, 0) & 1)
+
+        bits = tags.get(TAG_BITS_PER_SAMPLE, (1,))[0]
+        kind = _SAMPLE_KINDS.get(tags.get(TAG_SAMPLE_FORMAT, (1,))[0])
+        if kind is None or bits not in (8, 16, 32, 64) or (kind == 'f' and bits < 32):
+            raise Unsupported('{}-bit samples of format {} are not supported'.format(bits, tags.get(TAG_SAMPLE_FORMAT)))
+
+        if _scalar(tags, TAG_PLANAR_CONFIGURATION, 1) != 1 and self.samples > 1:
+            raise Unsupported('planar (band-separate) layouts are not supported')
+
+        if self.compression not in (COMPRESSION_NONE, COMPRESSION_LZW, COMPRESSION_DEFLATE,
+                                    COMPRESSION_DEFLATE_OLD, COMPRESSION_PACKBITS):
+            raise Unsupported('compression {} is not supported'.format(self.compression))
+
+        self.dtype = np.dtype('{}{}{}'.format(byte_order, kind, bits // 8))
+
+        nodata = tags.get(TAG_GDAL_NODATA)
+        self.nodata = float(nodata.strip('\x00 ')) if nodata else None
+
+        if TAG_TILE_WIDTH in tags:
+            self.chunk_width = _scalar(tags, TAG_TILE_WIDTH)
+            self.chunk_height = _scalar(tags, TAG_TILE_LENGTH)
+            self.offsets = tags[TAG_TILE_OFFSETS]
+            self.byte_counts = tags[TAG_TILE_BYTE_COUNTS]
+        else:
+            self.chunk_width = self.width
+            self.chunk_height = min(_scalar(tags, TAG_ROWS_PER_STRIP, self.height), self.height)
+            self.offsets = tags[TAG_STRIP_OFFSETS]
+            self.byte_counts = tags[TAG_STRIP_BYTE_COUNTS]
+
+        self.chunks_across = -(-self.width // self.chunk_width)
+
+        self._pixels = self._map_pixels()
+        self._chunk = functools.lru_cache(maxsize=CHUNK_CACHE_SIZE)(self._decode_chunk)
+
+    def sample(self, rows, cols):
+        if self._pixels is not None:
+            return self._pixels[np.ix_(rows, cols)]
+
+        out = np.empty((len(rows), len(cols)), self.dtype.newbyteorder('='))
+
+        chunk_rows = rows // self.chunk_height
+        chunk_cols = cols // self.chunk_width
+
+        for chunk_row in np.unique(chunk_rows):
+            row_mask = chunk_rows == chunk_row
+            local_rows = rows[row_mask] - chunk_row * self.chunk_height
+
+            for chunk_col in np.unique(chunk_cols):
+                col_mask = chunk_cols == chunk_col
+                local_cols = cols[col_mask] - chunk_col * self.chunk_width
+
+                chunk = self._chunk(int(chunk_row * self.chunks_across + chunk_col))
+                out[np.ix_(row_mask, col_mask)] = chunk[np.ix_(local_rows, local_cols)]
+
+        return out
+
+    def _map_pixels(self):
+        """
+        Views the first band of an uncompressed image whose strips sit
+        back to back as one array, without reading anything.
+        """
+        if self.compression != COMPRESSION_NONE or self.chunk_width != self.width:
+            return None
+
+        offset = self.offsets[0]
+        for i in range(1, len(self.offsets)):
+            if self.offsets[i] != self.offsets[i - 1] + self.byte_counts[i - 1]:
+                return None
+
+        pixels = np.ndarray((self.height, self.width, self.samples), self.dtype, self._buffer, offset)
+        return pixels[:, :, 0]
+
+    def _decode_chunk(self, index):
+        offset, byte_count = self.offsets[index], self.byte_counts[index]
+        data = self._buffer[offset:offset + byte_count]
+
+        if self.compression in (COMPRESSION_DEFLATE, COMPRESSION_DEFLATE_OLD):
+            data = zlib.decompress(data)
+        elif self.compression == COMPRESSION_LZW:
+            data = _decompress_lzw(data)
+        elif self.compression == COMPRESSION_PACKBITS:
+            data = _decompress_packbits(data)
+
+        # The last strip may be short, and tiles may extend past the image
+        values_per_row = self.chunk_width * self.samples
+        rows = min(self.chunk_height, len(data) // (values_per_row * self.dtype.itemsize))
+        size = rows * values_per_row * self.dtype.itemsize
+
+        if self.predictor == PREDICTOR_FLOATING_POINT:
+            raw = np.frombuffer(data, np.uint8, size).reshape(rows, -1)
+            raw = np.cumsum(raw, axis=1, dtype=np.uint8)
+            # Bytes are stored most significant first, grouped by significance
+            raw = raw.reshape(rows, self.dtype.itemsize, values_per_row).transpose(0, 2, 1)
+            values = np.ascontiguousarray(raw).view(self.dtype.newbyteorder('>')).reshape(rows, values_per_row)
+        else:
+            values = np.frombuffer(data, self.dtype, rows * values_per_row).reshape(rows, values_per_row)
+            if self.predictor == PREDICTOR_HORIZONTAL:
+                values = values.reshape(rows, self.chunk_width, self.samples)
+                values = np.cumsum(values, axis=1, dtype=values.dtype).reshape(rows, values_per_row)
+
+        values = values.reshape(rows, self.chunk_width, self.samples)[:, :, 0].astype(self.dtype.newbyteorder('='))
+
+        if rows < self.chunk_height:
+            padded = np.zeros((self.chunk_height, self.chunk_width), values.dtype)
+            padded[:rows] = values
+            values = padded
+
+        return values
+
+
+def _apply_predictor(tile, predictor):
+    if predictor == PREDICTOR_FLOATING_POINT:
+        # Split values into bytes, most significant first, grouped by
+        # significance, then difference them
+        rows = tile.shape[0]
+        raw = tile.astype(tile.dtype.newbyteorder('>')).view(np.uint8)
+        raw = raw.reshape(rows, -1, tile.dtype.itemsize).transpose(0, 2, 1).reshape(rows, -1)
+        encoded = raw.copy()
+        encoded[:, 1:] = np.diff(raw, axis=1)
+        return encoded.tobytes()
+
+    encoded = tile.copy()
+    encoded[:, 1:] = np.diff(tile, axis=1)
+    return encoded.tobytes()
+
+
+def _encode_ifd(entries, offset, next_offset, bigtiff):
+    """
+    Serializes an IFD positioned at `offset`, with values too large to fit
+    in their entry placed directly after it.
+    """
+    offset_format, count_format, entry_size = ('Q', 'Q', 20) if bigtiff else ('I', 'H', 12)
+    inline_size = struct.calcsize(offset_format)
+
+    table_size = struct.calcsize(count_format) + len(entries) * entry_size + inline_size
+    table = [struct.pack('<' + count_format, len(entries))]
+    values = []
+    values_offset = offset + table_size
+
+    for tag, field_type, value in entries:
+        if field_type == TYPE_ASCII:
+            payload = value.encode('latin1') if isinstance(value, str) else bytes(value)
+            if not payload.endswith(b'\x00'):
+                payload += b'\x00'
+            count = len(payload)
+        else:
+            value_format = _FIELD_TYPES[field_type][0]
+            payload = struct.pack('<' + value_format * len(value), *value)
+            count = len(value)
+
+        if len(payload) <= inline_size:
+            table.append(struct.pack('<HH' + offset_format, tag, field_type, count) + payload.ljust(inline_size, b'\x00'))
+        else:
+            table.append(struct.pack('<HH' + offset_format + offset_format, tag, field_type, count, values_offset))
+            if len(payload) % 2:
+                payload += b'\x00'
+            values.append(payload)
+            values_offset += len(payload)
+
+    table.append(struct.pack('<' + offset_format, next_offset))
+
+    return b''.join(table + values)
+
+
+def _read_header(buffer):
+    byte_order = {b'II': '<', b'MM': '>'}.get(bytes(buffer[:2]))
+    if byte_order is None:
+        raise Unsupported('not a TIFF')
+    return byte_order
+
+
+def _read_ifds(buffer):
+    byte_order = _read_header(buffer)
+    version, = struct.unpack_from(byte_order + 'H', buffer, 2)
+
+    if version == 42:
+        offset_format, count_format, entry_size = 'I', 'H', 12
+        offset, = struct.unpack_from(byte_order + 'I', buffer, 4)
+    elif version == 43:
+        offset_format, count_format, entry_size = 'Q', 'Q', 20
+        offset, = struct.unpack_from(byte_order + 'Q', buffer, 8)
+    else:
+        raise Unsupported('unknown TIFF version {}'.format(version))
+
+    inline_size = struct.calcsize(offset_format)
+    ifds = []
+    seen = set()
+
+    while offset and offset not in seen:
+        seen.add(offset)
+
+        count, = struct.unpack_from(byte_order + count_format, buffer, offset)
+        position = offset + struct.calcsize(count_format)
+
+        tags = {}
+        for _ in range(count):
+            tag, field_type, value_count = struct.unpack_from(byte_order + 'HH' + offset_format, buffer, position)
+            position += entry_size
+
+            if field_type not in _FIELD_TYPES:
+                continue
+
+            value_format, value_size = _FIELD_TYPES[field_type]
+            size = value_size * value_count
+            value_offset = position - inline_size
+            if size > inline_size:
+                value_offset, = struct.unpack_from(byte_order + offset_format, buffer, value_offset)
+
+            if field_type == 2:
+                tags[tag] = bytes(buffer[value_offset:value_offset + value_count]).decode('latin1')
+            else:
+                values = struct.unpack_from('{}{}'.format(byte_order, value_format * value_count), buffer, value_offset)
+                if field_type in (5, 10):
+                    values = tuple(values[i] / values[i + 1] for i in range(0, len(values), 2))
+                tags[tag] = values
+
+        ifds.append(tags)
+        offset, = struct.unpack_from(byte_order + offset_format, buffer, position)
+
+    return ifds
+
+
+def _read_georeferencing(tags, path):
+    if TAG_MODEL_TRANSFORMATION in tags:
+        matrix = tags[TAG_MODEL_TRANSFORMATION]
+        if matrix[1] or matrix[4]:
+            raise Unsupported('rotated rasters are not supported')
+        west, north, x_resolution, y_resolution = matrix[3], matrix[7], matrix[0], -matrix[5]
+    elif TAG_MODEL_PIXEL_SCALE in tags and TAG_MODEL_TIEPOINT in tags:
+        x_scale, y_scale = tags[TAG_MODEL_PIXEL_SCALE][:2]
+        i, j, _, x, y, _ = tags[TAG_MODEL_TIEPOINT][:6]
+        west, north, x_resolution, y_resolution = x - i * x_scale, y + j * y_scale, x_scale, y_scale
+    else:
+        raise Unsupported('"{}" is not georeferenced'.format(path))
+
+    if _is_pixel_is_point(tags):
+        west -= x_resolution / 2
+        north += y_resolution / 2
+
+    return west, north, x_resolution, y_resolution
+
+
+def _is_pixel_is_point(tags):
+    geo_keys = tags.get(TAG_GEO_KEY_DIRECTORY, ())
+    for i in range(4, len(geo_keys) - 3, 4):
+        if geo_keys[i] == GEO_KEY_RASTER_TYPE and geo_keys[i + 3] == RASTER_PIXEL_IS_POINT:
+            return True
+    return False
+
+
+def _scalar(tags, tag, default=None):
+    values = tags.get(tag)
+    if values is None:
+        if default is None:
+            raise Unsupported('required TIFF tag {} is missing'.format(tag))
+        return default
+    return values[0]
+
+
+def _decompress_lzw(data):
+    """
+    TIFF-flavoured LZW: MSB-first codes, with code widths growing one code
+    early compared to GIF.
+    """
+    out = bytearray()
+    table = [bytes((i,)) for i in range(256)] + [b'', b'']
+    width = 9
+    bit_buffer = 0
+    bit_count = 0
+    previous = None
+
+    for byte in data:
+        bit_buffer = (bit_buffer << 8) | byte
+        bit_count += 8
+        if bit_count < width:
+            continue
+
+        bit_count -= width
+        code = (bit_buffer >> bit_count) & ((1 << width) - 1)
+
+        if code == 256:
+            table = table[:258]
+            width = 9
+            previous = None
+            continue
+
+        if code == 257:
+            break
+
+        if previous is None:
+            entry = table[code]
+        elif code < len(table):
+            entry = table[code]
+            table.append(previous + entry[:1])
+        else:
+            entry = previous + previous[:1]
+            table.append(entry)
+
+        out += entry
+        previous = entry
+
+        if len(table) + 1 >= (1 << width) and width < 12:
+            width += 1
+
+    return bytes(out)
+
+
+def _decompress_packbits(data):
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        n = data[i]
+        i += 1
+        if n < 128:
+            out += data[i:i + n + 1]
+            i += n + 1
+        elif n > 128:
+            out += data[i:i + 1] * (257 - n)
+            i += 1
+    return bytes(out)
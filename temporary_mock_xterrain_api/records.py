@@ -0,0 +1,373 @@
+import csv
+import datetime as dt
+import io
+import json
+import logging
+import sqlite3
+import threading
+
+
+INSERT_BATCH_SIZE = 10000
+
+COLUMN_ALIASES = {
+    'identifier': ('identifier', 'id', 'name'),
+    'timestamp': ('timestamp', 'date', 'datetime', 'time'),
+    'longitude': ('longitude', 'lon', 'lng', 'long', 'x'),
+    'latitude': ('latitude', 'lat', 'y'),
+}
+
+
+_log = logging.getLogger(__name__)
+
+
+class RecordStore:
+    """
+    SQLite-backed store of uploaded files and the point records parsed from
+    them.  Records are indexed by identifier, file and timestamp, and all
+    filtering and aggregation happens inside SQLite.
+    """
+
+    def __init__(self, path):
+        """
+        :type path: unicode
+        """
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id           TEXT PRIMARY KEY,
+                name         TEXT NOT NULL,
+                size         INTEGER NOT NULL,
+                sha256       TEXT,
+                record_count INTEGER NOT NULL DEFAULT 0,
+                uploaded_on  TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_name ON files (name);
+            CREATE UNIQUE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+
+            CREATE TABLE IF NOT EXISTS records (
+                file_id    TEXT NOT NULL,
+                identifier TEXT NOT NULL,
+                timestamp  REAL NOT NULL,
+                longitude  REAL NOT NULL,
+                latitude   REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS records_identifier_timestamp ON records (identifier, timestamp);
+            CREATE INDEX IF NOT EXISTS records_file_id ON records (file_id);
+            CREATE INDEX IF NOT EXISTS records_timestamp ON records (timestamp);
+
+            CREATE TABLE IF NOT EXISTS identifiers (
+                identifier TEXT PRIMARY KEY
+            ) WITHOUT ROWID;
+        """)
+        self._db.commit()
+
+    def add_file(self, file_id, name, size, sha256=None):
+        """
+        :type file_id: unicode
+        :type name: unicode
+        :type size: int
+        :type sha256: unicode?
+        """
+        with self._lock:
+            try:
+                self._db.execute('INSERT INTO files (id, name, size, sha256, uploaded_on) VALUES (?, ?, ?, ?, ?)',
+                                 (file_id, name, size, sha256, _format_timestamp(dt.datetime.utcnow().timestamp())))
+            except sqlite3.IntegrityError:
+                raise DuplicateFile(name)
+            self._db.commit()
+
+    def add_records(self, file_id, records):
+        """
+        Inserts records from any iterable of (identifier, timestamp,
+        longitude, latitude) tuples in batches, so the iterable is consumed
+        lazily and never materialized.
+
+        :type file_id: unicode
+        :type records: iterable[(unicode, float, float, float)]
+        :rtype: int
+        """
+        total = 0
+        batch = []
+
+        for record in records:
+            batch.append((file_id,) + tuple(record))
+            if len(batch) >= INSERT_BATCH_SIZE:
+                total += self._insert(file_id, batch)
+                batch = []
+
+        if batch:
+            total += self._insert(file_id, batch)
+
+        _log.info('Stored %d records for file "%s"', total, file_id)
+
+        return total
+
+    def find_file(self, file_id=None, sha256=None):
+        """
+        :type file_id: unicode?
+        :type sha256: unicode?
+        :rtype: dict?
+        """
+        column, value = ('id', file_id) if file_id else ('sha256', sha256)
+
+        with self._lock:
+            row = self._db.execute('SELECT id, name, size, record_count FROM files WHERE {} = ?'.format(column),
+                                   (value,)).fetchone()
+
+        return _file_row_to_dict(row) if row else None
+
+    def list_files(self):
+        """
+        :rtype: list[dict]
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT id, name, size, record_count FROM files ORDER BY uploaded_on').fetchall()
+
+        return [_file_row_to_dict(r) for r in rows]
+
+    def delete_file(self, file_id):
+        """
+        :type file_id: unicode
+        :rtype: bool
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM records WHERE file_id = ?', (file_id,))
+            deleted = self._db.execute('DELETE FROM files WHERE id = ?', (file_id,)).rowcount
+            self._db.execute('DELETE FROM identifiers WHERE NOT EXISTS '
+                             '(SELECT 1 FROM records WHERE records.identifier = identifiers.identifier)')
+            self._db.commit()
+
+        return bool(deleted)
+
+    def total_count(self):
+        """
+        :rtype: int
+        """
+        with self._lock:
+            count, = self._db.execute('SELECT COALESCE(SUM(record_count), 0) FROM files').fetchone()
+
+        return count
+
+    def aggregate(self, file_name='', identifier='', min_date=None, max_date=None, identifiers=None,
+                  cursor=None, limit=1000):
+        """
+        Aggregates records per identifier (points, count, first/last heard,
+        file names), ordered by identifier.  Pass the returned cursor back
+        in to fetch the next page.
+
+        :type file_name: unicode -- keyword to match against file names
+        :type identifier: unicode -- keyword to match against identifiers
+        :type min_date: unicode? -- ISO 8601
+        :type max_date: unicode? -- ISO 8601
+        :type identifiers: list[unicode]?
+        :type cursor: unicode?
+        :type limit: int
+        :rtype: (list[dict], unicode?)
+        """
+        clauses = []
+        params = []
+
+        if file_name:
+            # Files are few; resolving the keyword against them first lets
+            # the record scan use the file index
+            clauses.append('r.file_id IN (SELECT id FROM files WHERE name LIKE ? ESCAPE \'\\\')')
+            params.append('%{}%'.format(_escape_like(file_name)))
+
+        if identifier:
+            # Likewise, substring matches can't use an index, so match the
+            # keyword against distinct identifiers rather than every record
+            clauses.append('r.identifier IN (SELECT identifier FROM identifiers WHERE identifier LIKE ? ESCAPE \'\\\')')
+            params.append('%{}%'.format(_escape_like(identifier)))
+
+        if identifiers is not None:
+            clauses.append('r.identifier IN (SELECT value FROM json_each(?))')
+            params.append(json.dumps(list(identifiers)))
+
+        if min_date:
+            clauses.append('r.timestamp >= ?')
+            params.append(parse_timestamp(min_date))
+
+        if max_date:
+            clauses.append('r.timestamp <= ?')
+            params.append(parse_timestamp(max_date))
+
+        if cursor:
+            clauses.append('r.identifier > ?')
+            params.append(cursor)
+
+        query = """
+            SELECT r.identifier,
+                   COUNT(*),
+                   MIN(r.timestamp),
+                   MAX(r.timestamp),
+                   json_group_array(json_array(r.longitude, r.latitude)),
+                   json_group_array(DISTINCT r.file_id)
+            FROM records AS r
+            {where}
+            GROUP BY r.identifier
+            ORDER BY r.identifier
+            LIMIT ?
+        """.format(where='WHERE ' + ' AND '.join(clauses) if clauses else '')
+
+        with self._lock:
+            rows = self._db.execute(query, params + [limit + 1]).fetchall()
+            file_names = dict(self._db.execute('SELECT id, name FROM files'))
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+
+        aggregates = [
+            {
+                'identifier': identifier_,
+                'count': count,
+                'min_date': _format_timestamp(min_timestamp),
+                'max_date': _format_timestamp(max_timestamp),
+                'points': json.loads(points),
+                'file_names': sorted(file_names[f] for f in json.loads(file_ids)),
+            }
+            for identifier_, count, min_timestamp, max_timestamp, points, file_ids in rows
+        ]
+
+        return aggregates, next_cursor
+
+    def _insert(self, file_id, batch):
+        with self._lock:
+            self._db.executemany('INSERT INTO records (file_id, identifier, timestamp, longitude, latitude) '
+                                 'VALUES (?, ?, ?, ?, ?)', batch)
+            self._db.executemany('INSERT OR IGNORE INTO identifiers (identifier) VALUES (?)',
+                                 {(r[1],) for r in batch})
+            self._db.execute('UPDATE files SET record_count = record_count + ? WHERE id = ?', (len(batch), file_id))
+            self._db.commit()
+        return len(batch)
+
+
+class Error(Exception):
+    pass
+
+
+class DuplicateFile(Error):
+    def __init__(self, name):
+        Error.__init__(self, 'file "{}" has already been uploaded'.format(name))
+
+
+class ParseError(Error):
+    def __init__(self, line, message):
+        Error.__init__(self, 'line {}: {}'.format(line, message))
+        self.line = line
+
+
+def parse_csv(fp):
+    """
+    Lazily parses point records from a delimited text file whose header
+    row names identifier, timestamp, longitude and latitude columns (in
+    any order, alongside any other columns).  Comma, tab, semicolon and
+    pipe delimiters are recognized.
+
+    :type fp: file -- opened in binary mode
+    :rtype: iterator[(unicode, float, float, float)]
+    """
+    text = io.TextIOWrapper(fp, encoding='utf-8-sig', errors='replace', newline='')
+
+    header_line = text.readline()
+    if not header_line.strip():
+        raise ParseError(1, 'file has no header row')
+
+    delimiter = max(',\t;|', key=header_line.count)
+    try:
+        header = [c.strip().lower() for c in next(csv.reader([header_line], delimiter=delimiter))]
+    except csv.Error as err:
+        raise ParseError(1, str(err))
+
+    indices = {}
+    for column, aliases in COLUMN_ALIASES.items():
+        index = next((header.index(a) for a in aliases if a in header), None)
+        if index is None:
+            raise ParseError(1, 'header has no "{}" column'.format(column))
+        indices[column] = index
+
+    i_identifier, i_timestamp, i_longitude, i_latitude = (indices[c] for c in ('identifier', 'timestamp', 'longitude', 'latitude'))
+    width = max(indices.values()) + 1
+
+    rows = csv.reader(text, delimiter=delimiter)
+    line = 1
+
+    while True:
+        line += 1
+        try:
+            row = next(rows)
+        except StopIteration:
+            return
+        except csv.Error as err:  # e.g., a field over the size limit
+            raise ParseError(line, str(err))
+
+        if not row or not any(row):
+            continue
+
+        if len(row) < width:
+            raise ParseError(line, 'expected at least {} columns, found {}'.format(width, len(row)))
+
+        identifier = row[i_identifier].strip()
+        if not identifier:
+            raise ParseError(line, 'identifier is blank')
+
+        try:
+            timestamp = parse_timestamp(row[i_timestamp])
+        except ValueError:
+            raise ParseError(line, 'invalid timestamp "{}"'.format(row[i_timestamp]))
+
+        try:
+            longitude = float(row[i_longitude])
+            latitude = float(row[i_latitude])
+        except ValueError:
+            raise ParseError(line, 'invalid coordinates "{}, {}"'.format(row[i_longitude], row[i_latitude]))
+
+        if not (-180 <= longitude <= 180 and -90 <= latitude <= 90):
+            raise ParseError(line, 'coordinates "{}, {}" are out of range'.format(longitude, latitude))
+
+        yield identifier, timestamp, longitude, latitude
+
+
+def parse_timestamp(value):
+    """
+    :type value: unicode -- ISO 8601; UTC is assumed when no offset is given
+    :rtype: float
+    """
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+
+    timestamp = dt.datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=dt.timezone.utc)
+
+    return timestamp.timestamp()
+
+
+#
+# Helpers
+#
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _file_row_to_dict(row):
+    file_id, name, size, record_count = row
+    return {
+        'id': file_id,
+        'name': name,
+        'size': size,
+        'record_count': record_count,
+    }
+
+
+def _format_timestamp(timestamp):
+    return dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
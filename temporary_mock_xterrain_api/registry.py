@@ -0,0 +1,226 @@
+import collections
+import threading
+
+
+class Layer:
+    __slots__ = (
+        'id',
+        'geoserver_id',
+        'name',
+        'operation',
+        'status',
+        'processing_started_on',
+        'processing_ended_on',
+        'error',
+        'execute_params',
+        'style',
+        'trace',
+    )
+
+    def __init__(self, id_, name, operation, status):
+        self.id = id_
+        self.geoserver_id = None
+        self.name = name
+        self.operation = operation
+        self.status = status
+        self.processing_started_on = None
+        self.processing_ended_on = None
+        self.error = None
+        self.execute_params = None
+        self.style = None
+        self.trace = None
+
+    def serialize(self, include_timings=False):
+        """
+        :type include_timings: bool
+        :rtype: dict
+        """
+        serialized = {
+            'id': self.id,
+            'geoserver_id': self.geoserver_id,
+            'name': self.name,
+            'operation': self.operation,
+            'status': self.status,
+            'processing_started_on': self.processing_started_on,
+            'processing_ended_on': self.processing_ended_on,
+        }
+
+        if self.error:
+            serialized['error'] = self.error
+
+        if include_timings:
+            serialized['timings'] = self.trace.serialize() if self.trace else []
+
+        return serialized
+
+
+class Analytic:
+    __slots__ = (
+        'id',
+        'name',
+        'status',
+        'created_on',
+        'layers',
+        'version',
+    )
+
+    def __init__(self, id_, name, status, created_on, layers):
+        self.id = id_
+        self.name = name
+        self.status = status
+        self.created_on = created_on
+        self.layers = tuple(layers)
+        self.version = 0
+
+    def serialize(self, include_timings=False):
+        """
+        :type include_timings: bool
+        :rtype: dict
+        """
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'created_on': self.created_on,
+            'layers': [l.serialize(include_timings) for l in self.layers],
+        }
+
+
+class Registry:
+    """
+    Thread-safe in-memory store of analytics, indexed by analytic ID,
+    layer ID and layer operation.
+
+    Every change recorded through `touch()` bumps a registry-wide version,
+    which lets callers cheaply ask for only what changed since a version
+    they have already seen.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._next_id = 0
+        self._version = 0
+        self._analytics = {}
+        self._analytics_by_version = collections.OrderedDict()
+        self._layers = {}
+        self._layers_by_operation = {}
+
+    def __len__(self):
+        return len(self._analytics)
+
+    @property
+    def version(self):
+        """
+        :rtype: int
+        """
+        return self._version
+
+    def create(self, name, status, created_on, layers):
+        """
+        Assigns the next analytic ID and indexes the analytic and its layers.
+
+        :type name: unicode
+        :type status: unicode
+        :type created_on: unicode
+        :type layers: list[Layer]
+        :rtype: Analytic
+        """
+        with self._lock:
+            analytic = Analytic('{:05}'.format(self._next_id), name, status, created_on, layers)
+            self._next_id += 1
+
+            self._analytics[analytic.id] = analytic
+            for layer in analytic.layers:
+                self._layers[layer.id] = layer
+                self._layers_by_operation.setdefault(layer.operation, {})[layer.id] = layer
+
+            self._touch(analytic)
+
+        return analytic
+
+    def touch(self, analytic):
+        """
+        Records that the state of `analytic` (or one of its layers) changed.
+
+        :type analytic: Analytic
+        """
+        with self._lock:
+            self._touch(analytic)
+
+    def get(self, analytic_id):
+        """
+        :type analytic_id: unicode
+        :rtype: Analytic?
+        """
+        return self._analytics.get(analytic_id)
+
+    def get_layer(self, layer_id, operation=None):
+        """
+        :type layer_id: unicode
+        :type operation: unicode?
+        :rtype: Layer?
+        """
+        if operation is None:
+            return self._layers.get(layer_id)
+        return self._layers_by_operation.get(operation, {}).get(layer_id)
+
+    def layers(self, operation):
+        """
+        :type operation: unicode
+        :rtype: list[Layer]
+        """
+        with self._lock:
+            return list(self._layers_by_operation.get(operation, {}).values())
+
+    def all(self):
+        """
+        :rtype: list[Analytic]
+        """
+        with self._lock:
+            return list(self._analytics.values())
+
+    def changed_since(self, version):
+        """
+        Returns analytics changed after `version`, oldest change first.
+        Walks back from the most recent change, so the cost depends on the
+        number of changes rather than the number of analytics.
+
+        A `version` ahead of the registry's was handed out before a restart,
+        so nothing since can be told apart from what came before; every
+        analytic is returned.
+
+        :type version: int
+        :rtype: list[Analytic]
+        """
+        changed = []
+        with self._lock:
+            if version > self._version:
+                return list(self._analytics_by_version.values())
+            for analytic in reversed(self._analytics_by_version.values()):
+                if analytic.version <= version:
+                    break
+                changed.append(analytic)
+        changed.reverse()
+        return changed
+
+    def wait_for_change(self, version, timeout):
+        """
+        Blocks until the registry moves past `version` or `timeout` seconds
+        elapse, then returns the current version.  Returns at once if
+        `version` is ahead of the registry's, i.e., from before a restart.
+
+        :type version: int
+        :type timeout: float
+        :rtype: int
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self._version != version, timeout)
+            return self._version
+
+    def _touch(self, analytic):
+        self._version += 1
+        analytic.version = self._version
+        self._analytics_by_version[analytic.id] = analytic
+        self._analytics_by_version.move_to_end(analytic.id)
+        self._changed.notify_all()
@@ -1,16 +1,38 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import collections
+import concurrent.futures
 import datetime
+import functools
+import gzip
+import hashlib
+import importlib.util
+import json
 import logging
+import math
 import os
 import random
-import traceback
+import re
+import threading
+import time
 
-from bottle import run, request, response, redirect, post, get, static_file
+from bottle import run, request, response, redirect, post, get, delete, install, HTTPResponse
 
+import downloads
 import legion
+import geometry
 import geoserver
+import jobs
+import metrics
+import rasters
+import records
+import registry
+import servers
+import tiles
+import tracing
+import uploads
 
 
 API_KEY = '1234'
@@ -21,22 +43,122 @@ STYLE_RAINBOW = 'rainbow'
 STYLE_GREENSCALE = 'greenscale'
 STYLE_GREYSCALE = 'greyscale'
 
+STATUS_PENDING = 'Pending'
+STATUS_PROCESSING = 'Processing'
+STATUS_READY = 'Ready'
+STATUS_FAILED = 'Failed'
 
-_analytics = []
+VIEWSHED_BATCH_MAX_POINTS = int(os.getenv('VIEWSHED_BATCH_MAX_POINTS', 100))
+# Leaves a job worker free for single analytics queued behind a batch
+VIEWSHED_BATCH_CONCURRENCY = int(os.getenv('VIEWSHED_BATCH_CONCURRENCY', max(1, jobs.JOB_WORKERS - 1)))
+
+GEORING_BATCH_MAX_ORIGINS = int(os.getenv('GEORING_BATCH_MAX_ORIGINS', 1000))
+# Leaves a job worker free for single analytics queued behind a batch
+GEORING_BATCH_CONCURRENCY = int(os.getenv('GEORING_BATCH_CONCURRENCY', max(1, jobs.JOB_WORKERS - 1)))
+GEORING_BATCH_ALTITUDE = float(os.getenv('GEORING_BATCH_ALTITUDE', 0))
+GEORING_BATCH_INNER_RADIUS = float(os.getenv('GEORING_BATCH_INNER_RADIUS', 1))
+GEORING_BATCH_OUTER_RADIUS = float(os.getenv('GEORING_BATCH_OUTER_RADIUS', 50000))
+
+GEORING_DB_PATH = os.getenv('GEORING_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'georing.sqlite3'))
+GEORING_AGGREGATES_PAGE_SIZE = 1000
+GEORING_UPLOAD_DIR = os.getenv('GEORING_UPLOAD_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+GEORING_UPLOAD_MAX_BYTES = int(os.getenv('GEORING_UPLOAD_MAX_BYTES', 4 * 1024 ** 3))
+
+FETCH_RETRY_AFTER = 5
+
+STREAM_HEARTBEAT_INTERVAL = 15
+STREAM_MAX_DURATION = 300
+STREAM_RETRY_MILLIS = 3000
+
+GEOSERVER_WORKSPACES = (
+    'connected_viewshed',
+    'cost_distance',
+    'hillshade',
+    'georing',
+    'viewshed',
+)
+
+SERVER_THREADED = 'threaded'
+SERVER_WAITRESS = 'waitress'
+SERVER_GUNICORN = 'gunicorn'
+
+
+# Named explicitly, as this module usually runs as __main__
+_log = logging.getLogger('server')
+
+_analytics = registry.Registry()
+_stopping = threading.Event()
+_geoserver_ready = threading.Event()
+_geoserver_ready.set()
+
+_records = None
+_records_lock = threading.Lock()
+
+_uploads = None
+_uploads_lock = threading.Lock()
+
+# Layer outputs being fetched into the Legion cache, by layer ID and
+# format; each maps to None until the fetch fails, then to its error
+_fetches = {}
+_fetches_lock = threading.Lock()
+
+_PATTERN_CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+_request_seconds = metrics.histogram('http_request_seconds', 'Time taken to handle requests, by route',
+                                     ('method', 'route', 'status'))
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', default='localhost')
     parser.add_argument('--port', default=3001, type=int)
+    parser.add_argument('--server', default=SERVER_THREADED, choices=(SERVER_THREADED, SERVER_WAITRESS, SERVER_GUNICORN),
+                        help='WSGI server to run under (waitress and gunicorn must be installed separately)')
+    parser.add_argument('--threads', default=servers.DEFAULT_THREADS, type=int,
+                        help='request threads per worker; each open analytics stream holds one')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='worker processes (gunicorn only)')
+    parser.add_argument('--no-debug', dest='debug', action='store_false')
+    parser.add_argument('--no-reloader', dest='reloader', action='store_false')
+    parser.add_argument('--defer-geoserver-init', action='store_true',
+                        help='start serving at once and set up GeoServer workspaces and styles in the background')
     opts = parser.parse_args()
 
+    if opts.workers < 1 or opts.threads < 1:
+        parser.error('--workers and --threads must be at least 1')
+
+    if opts.workers > 1 and opts.server != SERVER_GUNICORN:
+        parser.error('--workers requires --server {}'.format(SERVER_GUNICORN))
+
+    if opts.server != SERVER_THREADED and not importlib.util.find_spec(opts.server):
+        parser.error('--server {0} requires the "{0}" package to be installed'.format(opts.server))
+
     logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)s] %(levelname)-5s %(message)s')
 
-    _initialize_geoserver_workspaces()
-    _initialize_geoserver_styles()
+    if opts.workers > 1:
+        _log.warning('Each of the %d workers keeps its own analytics registry; clients '
+                        'must be pinned to a single worker to see their analytics', opts.workers)
+
+    if opts.defer_geoserver_init:
+        _geoserver_ready.clear()
+        threading.Thread(target=_initialize_geoserver, kwargs={'deferred': True}, name='geoserver-init', daemon=True).start()
+    else:
+        _initialize_geoserver()
+
+    atexit.register(jobs.shutdown, wait=True)
+
+    # Analytics streams hold their connection open, so every server mode
+    # must serve requests concurrently
+    if opts.server == SERVER_THREADED:
+        server_options = {'threads': opts.threads, 'on_shutdown': _stopping.set}
+        opts.server = servers.ThreadedServer
+    elif opts.server == SERVER_WAITRESS:
+        server_options = {'threads': opts.threads}
+    else:
+        server_options = {'workers': opts.workers, 'threads': opts.threads, 'worker_class': 'gthread'}
 
-    run(host=opts.host, port=opts.port, debug=True, reloader=True)
+    run(host=opts.host, port=opts.port, server=opts.server, debug=opts.debug, reloader=opts.reloader,
+        **server_options)
 
 
 @get('/api/sources')
@@ -45,22 +167,95 @@ def list_sources():
         response.status = 401
         return {'error': 'You are not logged in'}
 
+    try:
+        bbox = _parse_bbox(request.GET['bbox']) if 'bbox' in request.GET else None
+    except ValueError as err:
+        response.status = 400
+        return {'error': 'Invalid "bbox": {}'.format(err)}
+
     response.set_header('Cache-Control', 'max-age=86400')
 
     return {
-        'sources': legion.get_sources(),
+        'sources': legion.get_sources(bbox=bbox),
     }
 
 
+@get('/api/sources/footprints')
+def list_source_footprints():
+    """
+    Returns the footprints of every datasource, or of those intersecting
+    `bbox` and/or listed in `sources`, as one FeatureCollection.
+    """
+
+    if not _logged_in():
+        response.status = 401
+        return {'error': 'You are not logged in'}
+
+    try:
+        bbox = _parse_bbox(request.GET['bbox']) if 'bbox' in request.GET else None
+    except ValueError as err:
+        response.status = 400
+        return {'error': 'Invalid "bbox": {}'.format(err)}
+
+    source_ids = set(filter(None, request.GET.get('sources', '').split(','))) or None
+
+    try:
+        collection = legion.get_footprint_collection()
+    except legion.Error as err:
+        response.status = 502
+        return {'error': 'Could not look up footprints: {}'.format(err)}
+
+    gzipped = _accepts_gzip()
+
+    if bbox is None and source_ids is None:
+        etag = '"{}"'.format(collection.version)
+        body = collection.gzipped if gzipped else collection.body
+    else:
+        selected = [s['id'] for s in legion.get_sources(bbox=bbox) if source_ids is None or s['id'] in source_ids]
+        etag = '"{}-{}"'.format(collection.version, hashlib.sha1(','.join(selected).encode()).hexdigest()[:8])
+        body = collection.serialize(selected)
+        if gzipped:
+            body = gzip.compress(body, legion.FOOTPRINTS_COMPRESSION_LEVEL)
+
+    response.set_header('Cache-Control', 'max-age=86400')
+    response.set_header('ETag', etag)
+    response.set_header('Vary', 'Accept-Encoding')
+
+    if etag in (t.strip() for t in request.get_header('If-None-Match', '').split(',')):
+        response.status = 304
+        return ''
+
+    response.content_type = 'application/json'
+    if gzipped:
+        response.set_header('Content-Encoding', 'gzip')
+
+    return body
+
+
 @get('/api/sources/<source>')
 def get_source_footprint(source):
     if not _logged_in():
         response.status = 401
         return {'error': 'You are not logged in'}
 
+    try:
+        if 'zoom' in request.GET:
+            tolerance = geometry.tolerance_for_zoom(int(request.GET['zoom']))
+        elif 'tolerance' in request.GET:
+            tolerance = float(request.GET['tolerance'])
+        else:
+            tolerance = None
+    except ValueError:
+        response.status = 400
+        return {'error': '"zoom" must be an integer and "tolerance" must be a number'}
+
+    if tolerance is not None and tolerance < 0:
+        response.status = 400
+        return {'error': '"tolerance" must be a positive number'}
+
     response.set_header('Cache-Control', 'max-age=86400')
 
-    return legion.get_source_footprint(source)
+    return legion.get_source_footprint(source, tolerance=tolerance)
 
 
 @post('/api/viewshed/create_analytic')
@@ -82,64 +277,87 @@ def create_viewshed():
         response.status = 400
         return {'error': 'Invalid payload: {}'.format(err)}
 
-    analytic_id = '{:05}'.format(len(_analytics))
-    layer_id = os.urandom(5).hex()
-
-    layer = {
-        'id': layer_id,
-        'geoserver_id': None,
-        'name': 'Viewshed ({} @ {}, {})'.format(source, round(latitude, 3), round(longitude, 3)),
-        'operation': 'viewshed',
-        'status': 'Ready',
-        'processing_started_on': _create_timestamp(),
-        'processing_ended_on': None,
-    }
-
-    analytic = {
-        'id': analytic_id,
-        'name': name,
-        'status': 'Ready',
-        'created_on': _create_timestamp(),
-        'layers': [layer],
-    }
+    analytic = _create_analytic(name, [
+        _create_layer('viewshed', 'Viewshed ({} @ {}, {})'.format(source, round(latitude, 3), round(longitude, 3))),
+    ])
 
     try:
-        tiff_path = legion.execute(
-            operation='LegionViewshedOperation',
-            source=source,
-            format_='GEOTIFF',
-            params={
-                'observerCoord': '{longitude}+{latitude}'.format(longitude=longitude, latitude=latitude),
-                'observerHeight': observer_height,
-                'targetHeight': target_height,
-                'outerRadius': outer_radius,
-                'normalizeScaleValue': 255,  # This magic number looks like it's required by Legion Core for... reasons?
-            },
-            context=analytic['id'],
+        jobs.submit(
+            _execute_layer,
+            analytic,
+            analytic.layers[0],
+            workspace='viewshed',
+            style=STYLE_BINARY,
+            execute_params=_viewshed_execute_params(source, latitude, longitude, observer_height, target_height, outer_radius),
+            context=analytic.id,
         )
+    except RuntimeError as err:
+        return _fail_unscheduled(analytic, err)
 
-        layer['geoserver_id'] = geoserver.publish_geotiff('viewshed', tiff_path, title=name, style=STYLE_BINARY)
-    except geoserver.ObjectExists:
-        layer['geoserver_id'] = os.path.basename(tiff_path)  # HACK
-    except legion.ExecutionFailed as err:
-        response.status = err.status
-        return {'error': 'Legion execution failed: {}'.format(err)}
-    except Exception as err:
-        print('!' * 120,
-              'Execution Error: {}'.format(err),
-              traceback.format_exc(),
-              '!' * 120,
-              sep='\n\n')
-        response.status = 500
-        return {'error': 'Unknown error occurred'.format(err)}
+    response.status = 202
 
-    layer['processing_ended_on'] = _create_timestamp()
+    return {'analytic': analytic.serialize()}
 
-    _analytics.append(analytic)
 
-    response.status = 201
+@post('/api/viewshed/create_batch')
+def create_viewshed_batch():
+    if not _logged_in():
+        response.status = 401
+        return {'error': 'You are not logged in'}
 
-    return {'analytic': analytic}
+    try:
+        reader = PayloadReader(request.json)
+        name            = reader.string('name', min_length=1)
+        source          = reader.string('source', min_length=1)
+        points          = reader.array('points', min_length=1, max_length=VIEWSHED_BATCH_MAX_POINTS)
+        target_height   = reader.number('target_height')
+        observer_height = reader.number('observer_height', min_value=0)
+        outer_radius    = reader.number('outer_radius', min_value=1)
+
+        observers = []
+        for i, point in enumerate(points):
+            try:
+                point_reader = PayloadReader(point)
+                observers.append((
+                    point_reader.number('latitude', min_value=-90, max_value=90),
+                    point_reader.number('longitude', min_value=-180, max_value=180),
+                ))
+            except PayloadReader.Error as err:
+                raise PayloadReader.Error('points[{}]: {}'.format(i, err))
+    except PayloadReader.Error as err:
+        response.status = 400
+        return {'error': 'Invalid payload: {}'.format(err)}
+
+    # Identical observers would produce identical layers
+    observers = list(collections.OrderedDict.fromkeys(observers))
+
+    analytic = _create_analytic(name, [
+        _create_layer('viewshed', 'Viewshed ({} @ {}, {})'.format(source, round(latitude, 3), round(longitude, 3)))
+        for latitude, longitude in observers
+    ])
+
+    try:
+        jobs.submit_all(
+            _execute_layer,
+            [
+                (
+                    analytic,
+                    layer,
+                    'viewshed',
+                    STYLE_BINARY,
+                    _viewshed_execute_params(source, latitude, longitude, observer_height, target_height, outer_radius),
+                )
+                for layer, (latitude, longitude) in zip(analytic.layers, observers)
+            ],
+            concurrency=VIEWSHED_BATCH_CONCURRENCY,
+            context=analytic.id,
+        )
+    except RuntimeError as err:
+        return _fail_unscheduled(analytic, err)
+
+    response.status = 202
+
+    return {'analytic': analytic.serialize()}
 
 
 @post('/api/hillshade/create_analytic')
@@ -159,62 +377,35 @@ def create_hillshade():
         response.status = 400
         return {'error': 'Invalid payload: {}'.format(err)}
 
-    analytic_id = '{:05}'.format(len(_analytics))
-    layer_id = os.urandom(5).hex()
-
-    layer = {
-        'id': layer_id,
-        'geoserver_id': None,
-        'name': 'Hillshade ({} @ {})'.format(source, source, ', '.join(str(round(n, 2)) for n in bbox)),
-        'operation': 'hillshade',
-        'status': 'Ready',
-        'processing_started_on': _create_timestamp(),
-        'processing_ended_on': None,
-    }
-
-    analytic = {
-        'id': analytic_id,
-        'name': name,
-        'status': 'Ready',
-        'created_on': _create_timestamp(),
-        'layers': [layer],
-    }
+    analytic = _create_analytic(name, [
+        _create_layer('hillshade', 'Hillshade ({} @ {})'.format(source, ', '.join(str(round(n, 2)) for n in bbox))),
+    ])
 
     try:
-        tiff_path = legion.execute(
-            operation='LegionHillshadeOperation',
-            source=source,
-            format_='GEOTIFF',
-            bbox=','.join(str(n) for n in bbox),
-            params={
-                'sunAltitudeAngle': sun_altitude,
-                'sunAzimuth': sun_azimuth,
-            },
-            context=analytic['id'],
+        jobs.submit(
+            _execute_layer,
+            analytic,
+            analytic.layers[0],
+            workspace='hillshade',
+            style=STYLE_GREYSCALE,
+            execute_params=dict(
+                operation='LegionHillshadeOperation',
+                source=source,
+                format_='GEOTIFF',
+                bbox=','.join(str(n) for n in bbox),
+                params={
+                    'sunAltitudeAngle': sun_altitude,
+                    'sunAzimuth': sun_azimuth,
+                },
+            ),
+            context=analytic.id,
         )
+    except RuntimeError as err:
+        return _fail_unscheduled(analytic, err)
 
-        layer['geoserver_id'] = geoserver.publish_geotiff('hillshade', tiff_path, title=name, style=STYLE_GREYSCALE)
-    except geoserver.ObjectExists:
-        layer['geoserver_id'] = os.path.basename(tiff_path)  # HACK
-    except legion.ExecutionFailed as err:
-        response.status = err.status
-        return {'error': 'Legion execution failed: {}'.format(err)}
-    except Exception as err:
-        print('!' * 120,
-              'Execution Error: {}'.format(err),
-              traceback.format_exc(),
-              '!' * 120,
-              sep='\n\n')
-        response.status = 500
-        return {'error': 'Unknown error occurred'.format(err)}
-
-    layer['processing_ended_on'] = _create_timestamp()
-
-    _analytics.append(analytic)
+    response.status = 202
 
-    response.status = 201
-
-    return {'analytic': analytic}
+    return {'analytic': analytic.serialize()}
 
 
 @post('/api/georing/create_analytic')
@@ -236,62 +427,26 @@ def create_georing():
         response.status = 400
         return {'error': 'Invalid payload: {}'.format(err)}
 
-    analytic_id = '{:05}'.format(len(_analytics))
-    layer_id = os.urandom(5).hex()
-
-    layer = {
-        'id': layer_id,
-        'geoserver_id': None,
-        'name': 'GeoRing ({} @ {}, {})'.format(source, round(latitude, 3), round(longitude, 3)),
-        'operation': 'georing',
-        'status': 'Ready',
-        'processing_started_on': _create_timestamp(),
-        'processing_ended_on': None,
-    }
-
-    analytic = {
-        'id': analytic_id,
-        'name': name,
-        'status': 'Ready',
-        'created_on': _create_timestamp(),
-        'layers': [layer],
-    }
+    analytic = _create_analytic(name, [
+        _create_layer('georing', 'GeoRing ({} @ {}, {})'.format(source, round(latitude, 3), round(longitude, 3))),
+    ])
 
     try:
-        tiff_path = legion.execute(
-            operation='LegionGeoRingOperation',
-            source=source,
-            format_='GEOTIFF',
-            params={
-                'originPoint': '{longitude}+{latitude}+{altitude}'.format(longitude=longitude, latitude=latitude, altitude=altitude),
-                'innerRadius': inner_radius,
-                'outerRadius': outer_radius,
-            },
-            context=analytic['id'],
+        jobs.submit(
+            _execute_layer,
+            analytic,
+            analytic.layers[0],
+            workspace='georing',
+            style=STYLE_BINARY,
+            execute_params=_georing_execute_params(source, latitude, longitude, altitude, inner_radius, outer_radius),
+            context=analytic.id,
         )
+    except RuntimeError as err:
+        return _fail_unscheduled(analytic, err)
 
-        layer['geoserver_id'] = geoserver.publish_geotiff('georing', tiff_path, title=name, style=STYLE_BINARY)
-    except geoserver.ObjectExists:
-        layer['geoserver_id'] = os.path.basename(tiff_path)  # HACK
-    except legion.ExecutionFailed as err:
-        response.status = err.status
-        return {'error': 'Legion execution failed: {}'.format(err)}
-    except Exception as err:
-        print('!' * 120,
-              'Execution Error: {}'.format(err),
-              traceback.format_exc(),
-              '!' * 120,
-              sep='\n\n')
-        response.status = 500
-        return {'error': 'Unknown error occurred'.format(err)}
-
-    layer['processing_ended_on'] = _create_timestamp()
-
-    _analytics.append(analytic)
+    response.status = 202
 
-    response.status = 201
-
-    return {'analytic': analytic}
+    return {'analytic': analytic.serialize()}
 
 
 @post('/api/cost_distance/create_analytic')
@@ -311,62 +466,35 @@ def create_cost_distance():
         response.status = 400
         return {'error': 'Invalid payload: {}'.format(err)}
 
-    analytic_id = '{:05}'.format(len(_analytics))
-    layer_id = os.urandom(5).hex()
-
-    layer = {
-        'id': layer_id,
-        'geoserver_id': None,
-        'name': 'Cost Distance ({} @ {})'.format(source, ', '.join(str(round(n, 2)) for n in bbox)),
-        'operation': 'cost_distance',
-        'status': 'Ready',
-        'processing_started_on': _create_timestamp(),
-        'processing_ended_on': None,
-    }
-
-    analytic = {
-        'id': analytic_id,
-        'name': name,
-        'status': 'Ready',
-        'created_on': _create_timestamp(),
-        'layers': [layer],
-    }
+    analytic = _create_analytic(name, [
+        _create_layer('cost_distance', 'Cost Distance ({} @ {})'.format(source, ', '.join(str(round(n, 2)) for n in bbox))),
+    ])
 
     try:
-        tiff_path = legion.execute(
-            operation='LegionCostSurfaceOperation',
-            source=source,
-            format_='GEOTIFF',
-            bbox=','.join(str(n) for n in bbox),
-            params={
-                'originPoint': '{longitude}+{latitude}'.format(longitude=longitude, latitude=latitude),
-                'output': 'COST',
-            },
-            context=analytic['id'],
+        jobs.submit(
+            _execute_layer,
+            analytic,
+            analytic.layers[0],
+            workspace='cost_distance',
+            style=STYLE_RAINBOW,
+            execute_params=dict(
+                operation='LegionCostSurfaceOperation',
+                source=source,
+                format_='GEOTIFF',
+                bbox=','.join(str(n) for n in bbox),
+                params={
+                    'originPoint': '{longitude}+{latitude}'.format(longitude=longitude, latitude=latitude),
+                    'output': 'COST',
+                },
+            ),
+            context=analytic.id,
         )
+    except RuntimeError as err:
+        return _fail_unscheduled(analytic, err)
 
-        layer['geoserver_id'] = geoserver.publish_geotiff('cost_distance', tiff_path, title=name, style=STYLE_RAINBOW)
-    except geoserver.ObjectExists:
-        layer['geoserver_id'] = os.path.basename(tiff_path)  # HACK
-    except legion.ExecutionFailed as err:
-        response.status = err.status
-        return {'error': 'Legion execution failed: {}'.format(err)}
-    except Exception as err:
-        print('!' * 120,
-              'Execution Error: {}'.format(err),
-              traceback.format_exc(),
-              '!' * 120,
-              sep='\n\n')
-        response.status = 500
-        return {'error': 'Unknown error occurred'.format(err)}
-
-    layer['processing_ended_on'] = _create_timestamp()
+    response.status = 202
 
-    _analytics.append(analytic)
-
-    response.status = 201
-
-    return {'analytic': analytic}
+    return {'analytic': analytic.serialize()}
 
 
 @post('/api/connected_viewshed/create_analytic')
@@ -391,89 +519,154 @@ def create_connected_viewshed():
         response.status = 400
         return {'error': 'Invalid payload: {}'.format(err)}
 
-    analytic_id = '{:05}'.format(len(_analytics))
-    layer_id = os.urandom(5).hex()
-
-    layer = {
-        'id': layer_id,
-        'geoserver_id': None,
-        'name': 'Connected Viewshed ({} @ {})'.format(source, ', '.join(str(round(n, 2)) for n in bbox)),
-        'operation': 'connected_viewshed',
-        'status': 'Ready',
-        'processing_started_on': _create_timestamp(),
-        'processing_ended_on': None,
-    }
-
-    analytic = {
-        'id': analytic_id,
-        'name': name,
-        'status': 'Ready',
-        'created_on': _create_timestamp(),
-        'layers': [layer],
-    }
+    analytic = _create_analytic(name, [
+        _create_layer('connected_viewshed', 'Connected Viewshed ({} @ {})'.format(source, ', '.join(str(round(n, 2)) for n in bbox))),
+    ])
 
     try:
-        tiff_path = legion.execute(
-            operation='LegionConnectedViewshedOperation',
-            source=source,
-            format_='GEOTIFF',
-            bbox=','.join(str(n) for n in bbox),
-            params={
-                'polyline': '+'.join('{longitude}+{latitude}'.format(**p) for p in linestring),
-                'startAzimuth': start_azimuth,
-                'endAzimuth': end_azimuth,
-                'observerHeight': observer_height,
-                'targetHeight': target_height,
-                'innerRadius': inner_radius,
-                'outerRadius': outer_radius,
-                'normalize': 'RADIUS',  # This magic string looks like it's required by Legion Core for... reasons?
-                'normalizeScaleValue': 255,  # This magic number looks like it's required by Legion Core for... reasons?
-            },
-            context=analytic['id'],
+        jobs.submit(
+            _execute_layer,
+            analytic,
+            analytic.layers[0],
+            workspace='connected_viewshed',
+            style=STYLE_GREENSCALE,
+            execute_params=dict(
+                operation='LegionConnectedViewshedOperation',
+                source=source,
+                format_='GEOTIFF',
+                bbox=','.join(str(n) for n in bbox),
+                params={
+                    'polyline': '+'.join('{longitude}+{latitude}'.format(**p) for p in linestring),
+                    'startAzimuth': start_azimuth,
+                    'endAzimuth': end_azimuth,
+                    'observerHeight': observer_height,
+                    'targetHeight': target_height,
+                    'innerRadius': inner_radius,
+                    'outerRadius': outer_radius,
+                    'normalize': 'RADIUS',  # This magic string looks like it's required by Legion Core for... reasons?
+                    'normalizeScaleValue': 255,  # This magic number looks like it's required by Legion Core for... reasons?
+                },
+            ),
+            context=analytic.id,
         )
+    except RuntimeError as err:
+        return _fail_unscheduled(analytic, err)
 
-        layer['geoserver_id'] = geoserver.publish_geotiff('connected_viewshed', tiff_path, title=name, style=STYLE_GREENSCALE)
-    except geoserver.ObjectExists:
-        layer['geoserver_id'] = os.path.basename(tiff_path)  # HACK
-    except legion.ExecutionFailed as err:
-        response.status = err.status
-        return {'error': 'Legion execution failed: {}'.format(err)}
-    except Exception as err:
-        print('!' * 120,
-              'Execution Error: {}'.format(err),
-              traceback.format_exc(),
-              '!' * 120,
-              sep='\n\n')
-        response.status = 500
-        return {'error': 'Unknown error occurred'.format(err)}
+    response.status = 202
 
-    layer['processing_ended_on'] = _create_timestamp()
+    return {'analytic': analytic.serialize()}
 
-    _analytics.append(analytic)
 
-    response.status = 201
+@get('/api/<operation>/downloads/<layer_id>.TIF')
+def download_tiff(operation, layer_id):
+    if not _logged_in():
+        response.status = 401
+        return {'error': 'You are not logged in'}
 
-    return {'analytic': analytic}
+    layer = _analytics.get_layer(layer_id, operation)
 
+    if not layer:
+        response.status = 404
+        return {'error': 'Layer "{}" not found'.format(layer_id)}
+
+    if layer.status != STATUS_READY:
+        response.status = 409
+        return {'error': 'Layer "{}" is not ready'.format(layer_id)}
+
+    tiff_path = legion.find_cached(**layer.execute_params)
+    if not tiff_path:
+        return _fetch_in_background(layer, layer.execute_params)
+
+    return downloads.send_file(tiff_path, 'image/tiff')
+
+
+@get('/api/tiles/<layer_id>/<z:int>/<x:int>/<y:int>.png')
+def get_tile(layer_id, z, x, y):
+    """
+    Renders an XYZ tile of a finished layer straight from its cached
+    GeoTIFF, bypassing GeoServer.  Accepts `style` to override the layer's
+    style and a WMS-style `env` (e.g., `red:0;orange:60`) to adjust the
+    style's breakpoints.
+    """
 
-@get('/api/<operation>/downloads/<layer_id>.TIF')
-def download_tiff(operation, layer_id):
     if not _logged_in():
         response.status = 401
         return {'error': 'You are not logged in'}
 
-    layer = None
-    for a in _analytics:
-        for l in a['layers']:
-            if l['id'] == layer_id:
-                layer = l
-                break
+    layer = _analytics.get_layer(layer_id)
 
     if not layer:
         response.status = 404
         return {'error': 'Layer "{}" not found'.format(layer_id)}
 
-    return static_file(layer['geoserver_id'], legion.LEGION_CACHE_DIR, mimetype='image/tiff')
+    if layer.status != STATUS_READY:
+        response.status = 409
+        return {'error': 'Layer "{}" is not ready'.format(layer_id)}
+
+    if not tiles.available():
+        response.status = 501
+        return {'error': 'Tile rendering requires NumPy to be installed'}
+
+    if not 0 <= z <= tiles.MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        response.status = 404
+        return {'error': 'Tile {}/{}/{} does not exist'.format(z, x, y)}
+
+    style = request.GET.get('style') or layer.style
+    if style not in tiles.COLORMAPS:
+        response.status = 400
+        return {'error': '"style" must be one of: {}'.format(', '.join(sorted(tiles.COLORMAPS)))}
+
+    try:
+        env = tiles.parse_env(request.GET.get('env', ''))
+    except ValueError:
+        response.status = 400
+        return {'error': '"env" must be of the form "name:value;name:value"'}
+
+    tiff_path = legion.find_cached(**layer.execute_params)
+    if not tiff_path:
+        return _fetch_in_background(layer, layer.execute_params)
+
+    try:
+        tile = tiles.get_tile(tiff_path, style, z, x, y, env)
+    except FileNotFoundError:
+        # Evicted since it was looked up
+        return _fetch_in_background(layer, layer.execute_params)
+    except rasters.Unsupported as err:
+        response.status = 422
+        return {'error': 'Cannot render layer "{}": {}'.format(layer_id, err)}
+
+    response.content_type = 'image/png'
+    response.set_header('Cache-Control', 'private, max-age=86400')
+
+    return tile
+
+
+@get('/api/<operation>/downloads/<layer_id>.KMZ')
+def download_kmz(operation, layer_id):
+    if not _logged_in():
+        response.status = 401
+        return {'error': 'You are not logged in'}
+
+    layer = _analytics.get_layer(layer_id, operation)
+
+    if not layer:
+        response.status = 404
+        return {'error': 'Layer "{}" not found'.format(layer_id)}
+
+    if layer.status != STATUS_READY:
+        response.status = 409
+        return {'error': 'Layer "{}" is not ready'.format(layer_id)}
+
+    # Produced on first request, as most layers are never downloaded as KMZ
+    kml_params = {**layer.execute_params, 'format_': legion.FORMAT_KML}
+    kml_path = legion.find_cached(**kml_params)
+    if not kml_path:
+        return _fetch_in_background(layer, kml_params)
+
+    response.content_type = 'application/vnd.google-earth.kmz'
+    response.set_header('Content-Disposition', 'attachment; filename="{}.KMZ"'.format(layer.id))
+
+    return downloads.stream_zip([('doc.kml', kml_path)])
 
 
 @get('/api/analytics')
@@ -484,8 +677,43 @@ def list_analytics():
 
     _extend_session()
 
+    try:
+        since = int(request.GET['since']) if 'since' in request.GET else None
+    except ValueError:
+        response.status = 400
+        return {'error': '"since" must be an integer'}
+
+    include = set(filter(None, request.GET.get('include', '').split(',')))
+    if include - {'timings'}:
+        response.status = 400
+        return {'error': '"include" may only contain "timings"'}
+
+    timings = 'timings' in include
+
+    version = _analytics.version
+    if since is not None and since > version:
+        since = None  # Handed out before a restart; the client has to start over
+
+    etag = '"{}-{}{}"'.format(version, since if since is not None else 'all', '-timings' if timings else '')
+
+    response.set_header('Cache-Control', 'no-cache')
+    response.set_header('ETag', etag)
+
+    if etag in (t.strip() for t in request.get_header('If-None-Match', '').split(',')):
+        response.status = 304
+        return ''
+
+    if since is not None:
+        return {
+            'analytics': [a.serialize(timings) for a in _analytics.changed_since(since)],
+            'version': version,
+        }
+
     if _analytics:
-        return {'analytics': _analytics}
+        return {
+            'analytics': [a.serialize(timings) for a in _analytics.all()],
+            'version': version,
+        }
 
     return {
         'analytics': [
@@ -624,19 +852,40 @@ def list_analytics():
     }
 
 
+@get('/api/analytics/stream')
+def stream_analytics():
+    """
+    Server-sent event stream of analytic state changes.  Each event carries
+    the analytics changed since the previous one and uses the registry
+    version as its ID, so `EventSource` reconnects resume where they left off.
+    """
+
+    if not _logged_in():
+        response.status = 401
+        return {'error': 'You are not logged in'}
+
+    _extend_session()
+
+    try:
+        since = int(request.get_header('Last-Event-ID') or request.GET.get('since') or _analytics.version)
+    except ValueError:
+        response.status = 400
+        return {'error': '"since" must be an integer'}
+
+    response.content_type = 'text/event-stream'
+    response.set_header('Cache-Control', 'no-cache')
+    response.set_header('X-Accel-Buffering', 'no')
+
+    return _stream_analytic_changes(since)
+
+
 @get('/api/georing/files')
 def list_georing_files():
     if not _logged_in():
         response.status = 401
         return {'error': 'You are not logged in'}
     return {
-        'files': [
-            {
-                'id': '1234',
-                'name': 'FIXTURE.FILE',
-                'size': 999999999,
-            }
-        ],
+        'files': _get_records().list_files(),
     }
 
 
@@ -645,16 +894,32 @@ def list_georing_aggregates():
     if not _logged_in():
         response.status = 401
         return {'error': 'You are not logged in'}
+
+    try:
+        limit = int(request.GET.get('limit', GEORING_AGGREGATES_PAGE_SIZE))
+        if not 1 <= limit <= GEORING_AGGREGATES_PAGE_SIZE:
+            raise ValueError()
+    except ValueError:
+        response.status = 400
+        return {'error': '"limit" must be an integer between 1 and {}'.format(GEORING_AGGREGATES_PAGE_SIZE)}
+
+    try:
+        aggregates, next_cursor = _query_georing_aggregates(
+            file_name=request.GET.get('file_name', ''),
+            identifier=request.GET.get('identifier', ''),
+            min_date=request.GET.get('min_date'),
+            max_date=request.GET.get('max_date'),
+            cursor=request.GET.get('cursor'),
+            limit=limit,
+        )
+    except ValueError as err:
+        response.status = 400
+        return {'error': 'Invalid date: {}'.format(err)}
+
     return {
-        'aggregates': [
-            {
-                'identifier': 'FIXTURE_IDENT_01',
-                'points': [[30, 30], [0, 0], [0, 15], [15, 15]],
-                'file_names': ['something.txt'],
-                'count': 4,
-            },
-        ],
-        'total_count': 4,
+        'aggregates': aggregates,
+        'next_cursor': next_cursor,
+        'total_count': _get_records().total_count(),
         'criteria': {
             'file_name': request.GET.get('file_name', ''),
             'identifier': request.GET.get('identifier', ''),
@@ -664,17 +929,247 @@ def list_georing_aggregates():
     }
 
 
+@post('/api/georing/new_analytic')
+def create_georing_batch():
+    """
+    Creates one GeoRing layer per distinct origin point of the selected
+    aggregates.  Aggregates may be passed in directly (`aggregates`, each
+    with `identifier` and `points`) or selected with the same `filters` as
+    `/api/georing/aggregates` plus a list of `identifiers`.
+    """
+
+    if not _logged_in():
+        response.status = 401
+        return {'error': 'You are not logged in'}
+
+    try:
+        reader = PayloadReader(request.json)
+        name         = reader.string('name', min_length=1)
+        source       = reader.string('source', min_length=1)
+        altitude     = reader.number('altitude', min_value=0, optional=True)
+        inner_radius = reader.number('inner_radius', min_value=1, optional=True)
+        outer_radius = reader.number('outer_radius', min_value=1, optional=True)
+
+        if request.json.get('aggregates') is not None:
+            aggregates = reader.array('aggregates', min_length=1)
+        else:
+            filters_reader = PayloadReader(reader.dict('filters'))
+            identifiers = filters_reader.array('identifiers', min_length=1, max_length=GEORING_BATCH_MAX_ORIGINS)
+            try:
+                aggregates, _ = _query_georing_aggregates(
+                    file_name=filters_reader.string('file_name', optional=True, min_length=None),
+                    identifier=filters_reader.string('identifier', optional=True, min_length=None),
+                    min_date=filters_reader.string('min_date', optional=True, min_length=None) or None,
+                    max_date=filters_reader.string('max_date', optional=True, min_length=None) or None,
+                    identifiers=identifiers,
+                    limit=len(identifiers),
+                )
+            except ValueError as err:
+                raise PayloadReader.Error('invalid date: {}'.format(err))
+
+        origins = collections.OrderedDict()
+        for i, aggregate in enumerate(aggregates):
+            try:
+                aggregate_reader = PayloadReader(aggregate)
+                identifier = aggregate_reader.string('identifier', min_length=1)
+                for j, point in enumerate(aggregate_reader.array('points', min_length=1)):
+                    try:
+                        longitude, latitude = (float(n) for n in point)
+                    except (TypeError, ValueError):
+                        raise PayloadReader.Error('points[{}] is not a [longitude, latitude] pair'.format(j))
+                    # Also false for NaN
+                    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                        raise PayloadReader.Error('points[{}] must have a longitude between -180 and 180 '
+                                                  'and a latitude between -90 and 90'.format(j))
+                    origins.setdefault((latitude, longitude), identifier)
+            except PayloadReader.Error as err:
+                raise PayloadReader.Error('aggregates[{}]: {}'.format(i, err))
+    except PayloadReader.Error as err:
+        response.status = 400
+        return {'error': 'Invalid payload: {}'.format(err)}
+
+    if not origins:
+        response.status = 400
+        return {'error': 'Invalid payload: no points match the selected aggregates'}
+
+    if len(origins) > GEORING_BATCH_MAX_ORIGINS:
+        response.status = 400
+        return {'error': 'Invalid payload: {} origin points exceeds the limit of {}'.format(len(origins), GEORING_BATCH_MAX_ORIGINS)}
+
+    if altitude is None:
+        altitude = GEORING_BATCH_ALTITUDE
+    if inner_radius is None:
+        inner_radius = GEORING_BATCH_INNER_RADIUS
+    if outer_radius is None:
+        outer_radius = GEORING_BATCH_OUTER_RADIUS
+
+    analytic = _create_analytic(name, [
+        _create_layer('georing', '{} ({}, {})'.format(identifier, round(latitude, 3), round(longitude, 3)))
+        for (latitude, longitude), identifier in origins.items()
+    ])
+
+    try:
+        jobs.submit_all(
+            _execute_layer,
+            [
+                (
+                    analytic,
+                    layer,
+                    'georing',
+                    STYLE_BINARY,
+                    _georing_execute_params(source, latitude, longitude, altitude, inner_radius, outer_radius),
+                )
+                for layer, (latitude, longitude) in zip(analytic.layers, origins)
+            ],
+            concurrency=GEORING_BATCH_CONCURRENCY,
+            context=analytic.id,
+        )
+    except RuntimeError as err:
+        return _fail_unscheduled(analytic, err)
+
+    response.status = 202
+
+    return {'analytic': analytic.serialize()}
+
+
 @post('/api/georing/files')
-def index():
-    return {
-        'file': {
-            'id': os.urandom(5).hex(),
-            'name': 'wat',
-            'size': 12345,
+def upload_georing_file():
+    """
+    Receives a file of point records, either whole (as `multipart/form-data`
+    or a raw body) or in chunks.  The body is streamed to disk and hashed
+    as it arrives, then parsed record by record into the record store.
+
+    To upload in chunks, send each one as a raw body with an `Upload-Id`
+    header of the client's choosing and a `Content-Range` header.  Chunks
+    before the last are answered with 202 and the offset received so far.
+    A client that lost its connection can get that offset from
+    `/api/georing/files/uploads/<upload_id>` and resume from there.
+    """
+
+    if not _logged_in():
+        response.status = 401
+        return {'error': 'You are not logged in'}
+
+    try:
+        length = int(request.get_header('Content-Length', ''))
+    except ValueError:
+        response.status = 411
+        return {'error': 'Content-Length is required'}
+
+    content_type = request.get_header('Content-Type', '')
+    content_range = request.get_header('Content-Range')
+    upload_id = request.get_header('Upload-Id')
+
+    if content_range:
+        match = _PATTERN_CONTENT_RANGE.match(content_range)
+        if not match:
+            response.status = 400
+            return {'error': 'Content-Range must be of the form "bytes <start>-<end>/<size>"'}
+
+        start, end, size = (int(v) for v in match.groups())
+        if not start <= end < size or end - start + 1 != length:
+            response.status = 400
+            return {'error': 'Content-Range does not match the request body'}
+
+        if not uploads.is_valid_upload_id(upload_id):
+            response.status = 400
+            return {'error': 'Upload-Id must be 1-64 letters, digits, dashes or underscores'}
+
+        if content_type.startswith('multipart/'):
+            response.status = 400
+            return {'error': 'Chunks must be sent as raw bodies'}
+    else:
+        start, end, size = 0, length - 1, length
+        upload_id = os.urandom(8).hex()
+
+    if size > GEORING_UPLOAD_MAX_BYTES:
+        response.status = 413
+        return {'error': 'File exceeds the limit of {} bytes'.format(GEORING_UPLOAD_MAX_BYTES)}
+
+    staging = _get_uploads()
+    stream = request.environ['wsgi.input']
+
+    try:
+        if content_type.startswith('multipart/form-data'):
+            name, chunks = uploads.read_multipart_file(stream, length, content_type)
+        else:
+            name = uploads.filename_from_disposition(request.get_header('Content-Disposition')) or upload_id
+            chunks = uploads.read_body(stream, length)
+
+        received = staging.append(upload_id, chunks, offset=start)
+    except uploads.OffsetMismatch as err:
+        response.status = 416
+        return {
+            'error': 'Upload "{}" continues from byte {}'.format(upload_id, err.offset),
+            'upload': {'id': upload_id, 'offset': err.offset, 'size': size},
         }
+    except uploads.MalformedBody as err:
+        if not content_range:
+            staging.discard(upload_id)
+        response.status = 400
+        return {'error': 'Malformed upload: {}'.format(err)}
+
+    if content_range and received < size:
+        response.status = 202
+        return {
+            'upload': {'id': upload_id, 'offset': received, 'size': size},
+        }
+
+    filepath, sha256 = staging.finish(upload_id)
+    file_id = os.urandom(5).hex()
+    store = _get_records()
+
+    try:
+        store.add_file(file_id, name, os.path.getsize(filepath), sha256)
+        with open(filepath, 'rb') as fp:
+            store.add_records(file_id, records.parse_csv(fp))
+    except records.DuplicateFile:
+        response.status = 409
+        return {'error': 'This file was already uploaded'}
+    except records.ParseError as err:
+        store.delete_file(file_id)
+        response.status = 422
+        return {'error': str(err)}
+    except Exception:
+        store.delete_file(file_id)  # Records are committed in batches; don't leave a partial file behind
+        raise
+    finally:
+        os.remove(filepath)
+
+    return {
+        'file': store.find_file(file_id),
+    }
+
+
+@get('/api/georing/files/uploads/<upload_id>')
+def get_georing_upload(upload_id):
+    if not _logged_in():
+        response.status = 401
+        return {'error': 'You are not logged in'}
+
+    offset = _get_uploads().offset(upload_id) if uploads.is_valid_upload_id(upload_id) else None
+    if offset is None:
+        response.status = 404
+        return {'error': 'Upload not found'}
+
+    return {
+        'upload': {'id': upload_id, 'offset': offset},
     }
 
 
+@delete('/api/georing/files/<file_id>')
+def delete_georing_file(file_id):
+    if not _logged_in():
+        response.status = 401
+        return {'error': 'You are not logged in'}
+
+    if not _get_records().delete_file(file_id):
+        response.status = 404
+        return {'error': 'File not found'}
+
+    response.status = 204
+
+
 @get('/auth/login')
 def login():
     return """
@@ -725,6 +1220,155 @@ def whoami():
     }
 
 
+@get('/metrics')
+def get_metrics():
+    response.content_type = metrics.CONTENT_TYPE
+    return metrics.render()
+
+
+def _accepts_gzip():
+    for coding in request.get_header('Accept-Encoding', '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def _create_analytic(name, layers):
+    """
+    :rtype: registry.Analytic
+    """
+    return _analytics.create(name, STATUS_PENDING, _create_timestamp(), layers)
+
+
+def _create_layer(operation, name):
+    """
+    :rtype: registry.Layer
+    """
+    layer = registry.Layer(os.urandom(5).hex(), name, operation, STATUS_PENDING)
+
+    # Everything the request did up to here was reading its payload
+    request_trace = tracing.current()
+    if request_trace:
+        layer.trace = tracing.Trace(started=request_trace.started)
+        layer.trace.record('validate_payload', request_trace.started)
+    else:
+        layer.trace = tracing.Trace()
+
+    return layer
+
+
+def _execute_layer(analytic, layer, workspace, style, execute_params):
+    """
+    Runs on a job worker; drives a single layer from `Pending` through
+    `Processing` to either `Ready` or `Failed`.
+    """
+
+    layer.status = STATUS_PROCESSING
+    layer.processing_started_on = _create_timestamp()
+    layer.execute_params = execute_params
+    layer.style = style
+    _update_analytic_status(analytic)
+
+    if layer.trace:
+        layer.trace.record('queued', layer.trace.created)
+
+    try:
+        with tracing.activate(layer.trace):
+            tiff_path = legion.execute(context=analytic.id, **execute_params)
+            tiff_path = legion.optimize_geotiff(tiff_path, context=analytic.id)
+
+            with tracing.span('geoserver.wait_ready'):
+                _geoserver_ready.wait()
+            layer.geoserver_id = geoserver.publish_geotiff(workspace, tiff_path, style=style)
+        layer.status = STATUS_READY
+    except legion.ExecutionFailed as err:
+        layer.status = STATUS_FAILED
+        layer.error = 'Legion execution failed: {}'.format(err)
+    except Exception:
+        # Handled here, so the job itself never fails
+        _log.exception('[%s] Could not execute layer "%s"', analytic.id, layer.id)
+        layer.status = STATUS_FAILED
+        layer.error = 'Unknown error occurred'
+    finally:
+        layer.processing_ended_on = _create_timestamp()
+        _update_analytic_status(analytic)
+
+
+def _fail_unscheduled(analytic, err):
+    """
+    Fails the layers of an analytic which could not be queued, as the job
+    workers are shutting down, rather than leave them `Pending` for good.
+    """
+    for layer in analytic.layers:
+        if layer.status == STATUS_PENDING:
+            layer.status = STATUS_FAILED
+            layer.error = 'Could not be scheduled: {}'.format(err)
+    _update_analytic_status(analytic)
+
+    response.status = 503
+    return {'error': 'Cannot run analytic: {}'.format(err)}
+
+
+def _fetch_in_background(layer, execute_params):
+    """
+    Answers a request for a layer output which is not in the Legion cache
+    (not fetched yet, or evicted since) by having a job worker fetch it
+    and the client retry, rather than waiting on Legion in the request
+    thread.  The next request after a failed fetch
+    is told why, and the one after that starts over.
+
+    :type layer: registry.Layer
+    :type execute_params: dict
+    """
+    key = (layer.id, execute_params['format_'])
+
+    with _fetches_lock:
+        started = key in _fetches
+        error = _fetches.pop(key) if started and _fetches[key] else None
+        if not started:
+            _fetches[key] = None
+
+    if error:
+        response.status = 502
+        return {'error': 'Could not fetch the output of layer "{}" from Legion: {}'.format(layer.id, error)}
+
+    if not started:
+        try:
+            jobs.submit(_fetch_layer_output, layer, execute_params, context=layer.id)
+        except RuntimeError:
+            with _fetches_lock:
+                del _fetches[key]
+            response.status = 503
+            return {'error': 'The server is shutting down'}
+
+    response.status = 409
+    response.set_header('Retry-After', str(FETCH_RETRY_AFTER))
+    return {'error': 'The output of layer "{}" is being fetched'.format(layer.id)}
+
+
+def _fetch_layer_output(layer, execute_params):
+    """
+    Runs on a job worker; see `_fetch_in_background()`.
+    """
+    key = (layer.id, execute_params['format_'])
+
+    error = 'Unknown error occurred'
+    try:
+        filepath = legion.execute(context=layer.id, **execute_params)
+        if execute_params['format_'] == legion.FORMAT_GEOTIFF:
+            legion.optimize_geotiff(filepath, context=layer.id)
+        error = None
+    except legion.Error as err:
+        error = str(err)
+    finally:
+        with _fetches_lock:
+            if error:
+                _fetches[key] = error
+            else:
+                del _fetches[key]
+
+
 def _create_timestamp(min_seconds=0, max_seconds=0):
     return (datetime.datetime.utcnow() -
             datetime.timedelta(seconds=random.randint(min_seconds, max_seconds))).isoformat() + 'Z'
@@ -737,17 +1381,35 @@ def _extend_session():
     response.set_cookie('mock_session', cookie, secret=SECRET_KEY, path='/', httponly=True, max_age=3600)
 
 
+def _initialize_geoserver(deferred=False):
+    """
+    Creates whatever workspaces and styles GeoServer is missing.  When
+    deferred, failures are logged rather than raised and layers wait for
+    this to finish before publishing.
+    """
+
+    started = time.monotonic()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='geoserver-init') as executor:
+            futures = [
+                executor.submit(_initialize_geoserver_workspaces),
+                executor.submit(_initialize_geoserver_styles),
+            ]
+        for future in futures:
+            future.result()
+    except geoserver.Error as err:
+        if not deferred:
+            raise
+        _log.error('GeoServer initialization failed: %s', err)
+    else:
+        _log.info('GeoServer initialized in %.0fms', (time.monotonic() - started) * 1000)
+    finally:
+        _geoserver_ready.set()
+
+
 def _initialize_geoserver_workspaces():
-    for workspace in (
-            'connected_viewshed',
-            'cost_distance',
-            'hillshade',
-            'georing',
-            'viewshed',
-    ):
-        if geoserver.workspace_exists(workspace):
-            continue
-        geoserver.create_workspace(workspace)
+    geoserver.ensure_workspaces(GEOSERVER_WORKSPACES)
 
 
 def _initialize_geoserver_styles():
@@ -870,10 +1532,155 @@ def _initialize_geoserver_styles():
         """,
     }
 
-    for name, sld_content in styles.items():
-        if geoserver.style_exists(name):
+    geoserver.ensure_styles(styles)
+
+
+def _stream_analytic_changes(since):
+    deadline = time.monotonic() + STREAM_MAX_DURATION
+
+    yield 'retry: {}\n\n'.format(STREAM_RETRY_MILLIS)
+
+    while time.monotonic() < deadline and not _stopping.is_set():
+        version = _analytics.wait_for_change(since, timeout=STREAM_HEARTBEAT_INTERVAL)
+
+        if version == since:
+            yield ': heartbeat\n\n'
             continue
-        geoserver.create_style(name, sld_content)
+
+        # A `since` ahead of `version` dates from before a restart, in which
+        # case `changed_since()` sends everything
+        yield 'id: {}\nevent: analytics\ndata: {}\n\n'.format(version, json.dumps({
+            'analytics': [a.serialize() for a in _analytics.changed_since(since)],
+            'version': version,
+        }))
+
+        since = version
+
+
+def _georing_execute_params(source, latitude, longitude, altitude, inner_radius, outer_radius):
+    return dict(
+        operation='LegionGeoRingOperation',
+        source=source,
+        format_='GEOTIFF',
+        params={
+            'originPoint': '{longitude}+{latitude}+{altitude}'.format(longitude=longitude, latitude=latitude, altitude=altitude),
+            'innerRadius': inner_radius,
+            'outerRadius': outer_radius,
+        },
+    )
+
+
+def _get_records():
+    """
+    :rtype: records.RecordStore
+    """
+    global _records
+
+    with _records_lock:
+        if _records is None:
+            _records = records.RecordStore(GEORING_DB_PATH)
+        return _records
+
+
+def _get_uploads():
+    """
+    :rtype: uploads.Uploads
+    """
+    global _uploads
+
+    with _uploads_lock:
+        if _uploads is None:
+            _uploads = uploads.Uploads(GEORING_UPLOAD_DIR)
+        return _uploads
+
+
+def _parse_bbox(value):
+    """
+    :type value: unicode -- "west,south,east,north"
+    :rtype: (float, float, float, float)
+    """
+    try:
+        west, south, east, north = (float(n) for n in value.split(','))
+    except ValueError:
+        raise ValueError('must be four comma-separated numbers (west,south,east,north)')
+
+    if not (-180 <= west <= east <= 180 and -90 <= south <= north <= 90):
+        raise ValueError('must lie within -180,-90,180,90 with west <= east and south <= north')
+
+    return west, south, east, north
+
+
+def _query_georing_aggregates(file_name, identifier, min_date, max_date, identifiers=None, cursor=None,
+                              limit=GEORING_AGGREGATES_PAGE_SIZE):
+    """
+    :rtype: (list[dict], unicode?)
+    """
+    return _get_records().aggregate(
+        file_name=file_name,
+        identifier=identifier,
+        min_date=min_date,
+        max_date=max_date,
+        identifiers=identifiers,
+        cursor=cursor,
+        limit=limit,
+    )
+
+
+def _viewshed_execute_params(source, latitude, longitude, observer_height, target_height, outer_radius):
+    return dict(
+        operation='LegionViewshedOperation',
+        source=source,
+        format_='GEOTIFF',
+        params={
+            'observerCoord': '{longitude}+{latitude}'.format(longitude=longitude, latitude=latitude),
+            'observerHeight': observer_height,
+            'targetHeight': target_height,
+            'outerRadius': outer_radius,
+            'normalizeScaleValue': 255,  # This magic number looks like it's required by Legion Core for... reasons?
+        },
+    )
+
+
+def _update_analytic_status(analytic):
+    statuses = {l.status for l in analytic.layers}
+
+    if statuses == {STATUS_PENDING}:
+        analytic.status = STATUS_PENDING
+    elif statuses & {STATUS_PENDING, STATUS_PROCESSING}:
+        analytic.status = STATUS_PROCESSING
+    elif STATUS_FAILED in statuses:
+        analytic.status = STATUS_FAILED
+    else:
+        analytic.status = STATUS_READY
+
+    _analytics.touch(analytic)
+
+
+def _measure_request(callback):
+    """
+    Plugin timing every route, and tracing it for any analytic layers it
+    creates.  Streamed responses are only timed until their generator is
+    returned.
+    """
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        status = 500
+        try:
+            with tracing.activate(tracing.Trace(started)):
+                result = callback(*args, **kwargs)
+            status = result.status_code if isinstance(result, HTTPResponse) else response.status_code
+            return result
+        except HTTPResponse as err:
+            status = err.status_code
+            raise
+        finally:
+            _request_seconds.observe(time.perf_counter() - started,
+                                     method=request.method, route=request.route.rule, status=status)
+    return wrapper
+
+
+install(_measure_request)
 
 
 def _logged_in():
@@ -916,6 +1723,9 @@ class PayloadReader:
     def string(self, key, min_length=0, max_length=256, optional=False):
         value = self._read(key, optional)
 
+        if value is None and optional:
+            return ''
+
         value = str(value).strip()
 
         if min_length is not None and max_length is not None and not min_length <= len(value) <= max_length:
@@ -923,6 +1733,17 @@ class PayloadReader:
 
         return value
 
+    def dict(self, key, optional=False):
+        value = self._read(key, optional)
+
+        if value is None and optional:
+            return None
+
+        if not isinstance(value, dict):
+            raise self.Error('"{}" must be a dictionary'.format(key))
+
+        return value
+
     def bool(self, key, optional=False):
         value = self._read(key, optional)
 
@@ -934,11 +1755,18 @@ class PayloadReader:
     def number(self, key, type_=float, min_value=None, max_value=None, optional=False):
         value = self._read(key, optional)
 
+        if value is None and optional:
+            return None
+
         try:
             value = type_(value)
         except:
             raise self.Error('"{}" is not a valid {}'.format(key, type_.__name__))
 
+        # JSON payloads may carry NaN and Infinity, which slip past `min_value`
+        if not math.isfinite(value):
+            raise self.Error('"{}" must be a finite {}'.format(key, type_.__name__))
+
         if min_value is not None and max_value is not None and not min_value <= value <= max_value:
             raise self.Error('"{}" must be a {} between {} and {}'.format(key, type_.__name__, min_value, max_value))
 
@@ -0,0 +1,136 @@
+import concurrent.futures
+import io
+import logging
+import signal
+import threading
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+from bottle import WSGIRefServer
+
+
+DEFAULT_THREADS = 32
+
+
+_log = logging.getLogger(__name__)
+
+
+class ThreadedServer(WSGIRefServer):
+    """
+    Bottle adapter for wsgiref which serves requests from a bounded pool
+    of threads and shuts down gracefully on SIGTERM/SIGINT: it stops
+    accepting connections, lets in-flight requests finish and then returns
+    from `bottle.run()`.
+
+    Accepts a `threads` option (default: 32) and an `on_shutdown` callback
+    invoked as soon as shutdown begins, e.g. to end long-lived responses.
+
+    File responses with a known length are sent with `socket.sendfile()`.
+    """
+
+    def run(self, app):
+        threads = self.options.pop('threads', DEFAULT_THREADS)
+        self._on_shutdown = self.options.pop('on_shutdown', None)
+
+        self.options['server_class'] = type('_PooledWSGIServer', (_PooledWSGIServer,), {'threads': threads})
+        self.options['handler_class'] = type('_RequestHandler', (_RequestHandler,), {'quiet': self.quiet})
+
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, self._on_signal)
+
+        _log.info('Serving on %s:%s with %d request threads', self.host, self.port, threads)
+
+        try:
+            super().run(app)
+        finally:
+            if getattr(self, 'srv', None):
+                self.srv.server_close()
+
+        _log.info('Server stopped')
+
+    def _on_signal(self, signum, _):
+        _log.info('Received %s, shutting down', signal.Signals(signum).name)
+
+        if self._on_shutdown:
+            self._on_shutdown()
+
+        # `shutdown()` blocks until `serve_forever()` returns, so it cannot
+        # be called from the thread running it
+        threading.Thread(target=self.srv.shutdown, daemon=True).start()
+
+
+class _PooledWSGIServer(WSGIServer):
+    threads = DEFAULT_THREADS
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='http')
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=True)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class _RequestHandler(WSGIRequestHandler):
+    quiet = False
+
+    def address_string(self):
+        return self.client_address[0]  # Skip reverse DNS lookups
+
+    def log_request(self, *args, **kwargs):
+        if not self.quiet:
+            super().log_request(*args, **kwargs)
+
+    def handle(self):
+        # Mirrors `WSGIRequestHandler.handle()`, substituting a handler
+        # that knows how to use sendfile
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = _SendfileServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+                                         multithread=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+class _SendfileServerHandler(ServerHandler):
+    def sendfile(self):
+        filelike = self.result.filelike
+        length = self.headers.get('Content-Length')
+
+        if length is None:
+            return False
+
+        try:
+            offset = filelike.tell()
+            filelike.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return False
+
+        if not self.headers_sent:
+            self.bytes_sent = 0
+            self.send_headers()
+        self._flush()
+
+        self.bytes_sent += self.request_handler.connection.sendfile(filelike, offset, int(length))
+
+        return True
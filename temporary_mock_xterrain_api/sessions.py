@@ -0,0 +1,280 @@
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+
+import requests
+import requests.adapters
+
+import metrics
+
+
+RETRY_BACKOFF = 0.5
+
+# Responses which mean the upstream itself is in trouble, rather than the
+# request
+UNAVAILABLE_STATUSES = (502, 503, 504)
+
+
+_log = logging.getLogger(__name__)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class PooledSession(requests.Session):
+    """
+    `requests.Session` with a bounded connection pool and default
+    connect/read timeouts, meant to be shared across threads for all
+    traffic to a single upstream.
+
+    Requests also take `retries`, to retry idempotent requests that fail
+    for want of the upstream with jittered exponential backoff, and
+    `hedge_after`, to race a second identical request against one that
+    has not answered within that many seconds.  With a circuit breaker,
+    requests fail fast with `CircuitOpen` while the upstream is down.
+    """
+
+    def __init__(self, name, pool_size, keep_alive, connect_timeout, read_timeout, breaker=None):
+        super().__init__()
+
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker
+
+        self._pool_size = pool_size
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+        if not keep_alive:
+            self.headers['Connection'] = 'close'
+
+    def request(self, method, url, retries=0, hedge_after=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        attempt = 0
+        while True:
+            try:
+                if hedge_after:
+                    response = self._request_hedged(method, url, kwargs, hedge_after)
+                else:
+                    response = self._request_once(method, url, kwargs)
+            except CircuitOpen:
+                raise
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if attempt >= retries:
+                    raise
+                reason = err
+            else:
+                if response.status_code not in UNAVAILABLE_STATUSES or attempt >= retries:
+                    return response
+                response.close()
+                reason = 'HTTP {}'.format(response.status_code)
+
+            # "Full jitter", so clients that failed together don't retry
+            # together
+            delay = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+            _log.warning('%s %s failed (%s); retrying in %.2fs (%d of %d)', method, url, reason, delay, attempt, retries)
+            time.sleep(delay)
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        connections = 0
+        requests_ = 0
+
+        for adapter in {id(a): a for a in self.adapters.values()}.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                requests_ += pool.num_requests
+
+        return {
+            'connections_opened': connections,
+            'requests': requests_,
+            'reuse_ratio': round(1 - connections / requests_, 3) if requests_ else None,
+            'circuit': self.breaker.state if self.breaker else None,
+        }
+
+    def _request_once(self, method, url, kwargs):
+        if self.breaker and not self.breaker.allow():
+            raise CircuitOpen(self.name)
+
+        try:
+            response = super().request(method, url, **kwargs)
+        except BaseException:
+            # Whatever went wrong, a half-open trial has to be concluded or
+            # the circuit would never close again
+            if self.breaker:
+                self.breaker.record_failure()
+            raise
+
+        if self.breaker:
+            if response.status_code in UNAVAILABLE_STATUSES:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+        return response
+
+    def _request_hedged(self, method, url, kwargs, hedge_after):
+        primary = self._get_executor().submit(self._request_once, method, url, kwargs)
+
+        done, _ = concurrent.futures.wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        _log.info('"%s" has not answered %s %s within %.2fs; hedging', self.name, method, url, hedge_after)
+        futures = [primary, self._get_executor().submit(self._request_once, method, url, kwargs)]
+
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is None:
+                winner = future
+                break
+        else:
+            return primary.result()
+
+        for future in futures:
+            if future is not winner:
+                future.add_done_callback(_close_response)
+
+        return winner.result()
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(self._pool_size, thread_name_prefix=self.name)
+            return self._executor
+
+
+class CircuitBreaker:
+    """
+    Opens once an upstream has failed `failure_threshold` times in a row,
+    then lets a single trial request through every `reset_timeout` seconds
+    until one succeeds.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        """
+        :type failure_threshold: int
+        :type reset_timeout: float
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_on = None
+        self._trial_in_progress = False
+
+    @property
+    def state(self):
+        """
+        :rtype: unicode -- 'closed', 'open' or 'half-open'
+        """
+        with self._lock:
+            if self._opened_on is None:
+                return 'closed'
+            if self._trial_in_progress or time.monotonic() - self._opened_on >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def allow(self):
+        """
+        :rtype: bool
+        """
+        with self._lock:
+            if self._opened_on is None:
+                return True
+            if not self._trial_in_progress and time.monotonic() - self._opened_on >= self.reset_timeout:
+                self._trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_on is not None:
+                _log.info('Circuit closed after a successful trial request')
+            self._failures = 0
+            self._opened_on = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_progress = False
+            if self._opened_on is not None or self._failures >= self.failure_threshold:
+                if self._opened_on is None:
+                    _log.warning('Circuit opened after %d consecutive failures', self._failures)
+                self._opened_on = time.monotonic()
+
+
+class CircuitOpen(requests.ConnectionError):
+    def __init__(self, name):
+        requests.ConnectionError.__init__(self, 'circuit for "{}" is open after repeated failures'.format(name))
+
+
+def get_session(name, pool_size=10, keep_alive=True, connect_timeout=5, read_timeout=60, breaker=None):
+    """
+    Returns the shared session for upstream `name`, creating it on first use.
+
+    :type name: unicode
+    :type pool_size: int
+    :type keep_alive: bool
+    :type connect_timeout: float
+    :type read_timeout: float?
+    :type breaker: CircuitBreaker?
+    :rtype: PooledSession
+    """
+    with _sessions_lock:
+        session = _sessions.get(name)
+        if session is None:
+            _log.info('Creating connection pool for "%s" (size=%d, keep_alive=%s, timeouts=%s/%s)',
+                      name, pool_size, keep_alive, connect_timeout, read_timeout)
+            session = PooledSession(name, pool_size, keep_alive, connect_timeout, read_timeout, breaker)
+            _sessions[name] = session
+        return session
+
+
+def stats():
+    """
+    :rtype: dict
+    """
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+    return {s.name: s.stats() for s in sessions}
+
+
+#
+# Helpers
+#
+
+
+def _close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+def _collect_metrics():
+    stats_ = stats()
+    return [
+        ('upstream_requests_total', 'counter', 'Requests sent to each upstream',
+         [({'upstream': name}, s['requests']) for name, s in stats_.items()]),
+        ('upstream_connections_opened_total', 'counter', 'Connections opened to each upstream',
+         [({'upstream': name}, s['connections_opened']) for name, s in stats_.items()]),
+        ('upstream_circuit_open', 'gauge', 'Whether the circuit breaker for each upstream is failing requests fast',
+         [({'upstream': name}, int(s['circuit'] == 'open')) for name, s in stats_.items() if s['circuit']]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
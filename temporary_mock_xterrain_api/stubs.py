@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-ins for Legion and GeoServer, for running the mock API (and
+benchmarking it) without either.  Both answer only what `legion.py` and
+`geoserver.py` ask of them, after a configurable delay.
+"""
+
+import argparse
+import http.server
+import json
+import logging
+import random
+import re
+import struct
+import threading
+import time
+import urllib.parse
+
+
+DEFAULT_RASTER_SIZE = 512
+DEFAULT_SOURCES = 8
+READ_SIZE = 64 * 1024
+
+KML_NAMESPACE = 'http://www.opengis.net/kml/2.2'
+
+_PATTERN_WORKSPACE = re.compile(r'^/geoserver/rest/workspaces/([^/.]+)$')
+_PATTERN_STYLE = re.compile(r'^/geoserver/rest/styles/([^/.]+)$')
+_PATTERN_COVERAGE = re.compile(r'^/geoserver/rest/workspaces/([^/]+)/coveragestores/([^/]+)/external\.geotiff$')
+_PATTERN_LAYER = re.compile(r'^/geoserver/rest/layers/([^/:]+):(.+)\.json$')
+
+
+_log = logging.getLogger(__name__)
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """
+    Threaded HTTP server that runs in the background and sleeps for
+    `latency` (give or take `jitter`) seconds before answering.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler_class, host='127.0.0.1', port=0, latency=0.0, jitter=0.0):
+        super().__init__((host, port), handler_class)
+
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def address(self):
+        """
+        :rtype: unicode -- host:port
+        """
+        return '{}:{}'.format(*self.server_address[:2])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def delay(self):
+        with self._lock:
+            self.requests += 1
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+
+class LegionStub(StubServer):
+    """
+    Answers `Execute` with a synthetic 8-bit GeoTIFF (or a KML polygon)
+    covering the requested BBOX, `DataSources` with `sources` made-up
+    datasources and `Footprint` with a square around each of them.
+    """
+
+    def __init__(self, raster_size=DEFAULT_RASTER_SIZE, sources=DEFAULT_SOURCES, **kwargs):
+        super().__init__(_LegionHandler, **kwargs)
+
+        self.raster_size = raster_size
+        self.sources = [
+            {
+                'label': 'stub_source_{}'.format(i),
+                'description': 'Synthetic datasource {}'.format(i),
+                'bbox': '{},{},{},{}'.format(-120 + i, 30, -110 + i, 40),
+                'subtype': 'stub',
+            }
+            for i in range(sources)
+        ]
+
+        # Every raster has the same pixels; only the georeferencing varies
+        pixel_count = raster_size * raster_size
+        self._pixels = (bytes(range(256)) * (pixel_count // 256 + 1))[:pixel_count]
+
+
+class GeoServerStub(StubServer):
+    """
+    Keeps an in-memory catalog of workspaces, styles and layers and serves
+    the REST endpoints used to manage them.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(_GeoServerHandler, **kwargs)
+
+        self.workspaces = set()
+        self.styles = set()
+        self.layers = {}  # (workspace, layer_id) -> style
+        self.catalog_lock = threading.Lock()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run Legion and GeoServer stand-ins until interrupted')
+    parser.add_argument('--legion-port', default=3101, type=int)
+    parser.add_argument('--geoserver-port', default=3102, type=int)
+    parser.add_argument('--legion-latency', default=0.5, type=float, help='seconds before each Legion response')
+    parser.add_argument('--geoserver-latency', default=0.02, type=float, help='seconds before each GeoServer response')
+    parser.add_argument('--jitter', default=0.0, type=float, help='± seconds of random latency')
+    parser.add_argument('--raster-size', default=DEFAULT_RASTER_SIZE, type=int, help='width and height of GeoTIFFs')
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)s] %(levelname)-5s %(message)s')
+
+    legion = LegionStub(raster_size=opts.raster_size, port=opts.legion_port,
+                        latency=opts.legion_latency, jitter=opts.jitter).start()
+    geoserver = GeoServerStub(port=opts.geoserver_port, latency=opts.geoserver_latency, jitter=opts.jitter).start()
+
+    _log.info('Run the mock API against the stubs with:\n\n'
+              '    LEGION_SCHEME=http LEGION_HOST=%s LEGION_TOKEN=stub \\\n'
+              '    GEOSERVER_BASE_URL=http://%s/geoserver ./server.py\n',
+              legion.address, geoserver.address)
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        legion.stop()
+        geoserver.stop()
+
+
+#
+# Helpers
+#
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format_, *args):
+        _log.debug(format_, *args)
+
+    def send_body(self, status, body, content_type='application/json'):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+
+class _LegionHandler(_Handler):
+    def do_GET(self):
+        self.server.delay()
+
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        request_type = params.get('REQUEST')
+
+        if request_type == 'DataSources':
+            self.send_body(200, json.dumps({'DataSources': self.server.sources}))
+        elif request_type == 'Footprint':
+            source = next((s for s in self.server.sources if s['label'] == params.get('DATASOURCE')), None)
+            if source is None:
+                self.send_body(404, 'no such datasource', 'text/plain')
+            else:
+                self.send_body(200, _create_kml(*_parse_bbox(source['bbox'])), 'application/vnd.google-earth.kml+xml')
+        elif request_type == 'Execute':
+            bbox = _parse_bbox(params.get('BBOX')) or _bbox_around(params.get('PARAMETERS', ''))
+            if params.get('FORMAT') == 'KML':
+                self.send_body(200, _create_kml(*bbox), 'application/vnd.google-earth.kml+xml')
+            else:
+                self._send_geotiff(bbox)
+        else:
+            self.send_body(400, 'unknown REQUEST "{}"'.format(request_type), 'text/plain')
+
+    def _send_geotiff(self, bbox):
+        size = self.server.raster_size
+        header = _create_geotiff_header(size, size, bbox)
+        pixels = self.server._pixels
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/tiff')
+        self.send_header('Content-Length', str(len(header) + len(pixels)))
+        self.end_headers()
+
+        self.wfile.write(header)
+        for i in range(0, len(pixels), READ_SIZE):
+            self.wfile.write(pixels[i:i + READ_SIZE])
+
+
+class _GeoServerHandler(_Handler):
+    def do_GET(self):
+        self.server.delay()
+        path = urllib.parse.urlsplit(self.path).path
+
+        with self.server.catalog_lock:
+            workspaces = sorted(self.server.workspaces)
+            styles = sorted(self.server.styles)
+
+        if path == '/geoserver/rest/workspaces.json':
+            self.send_body(200, json.dumps({'workspaces': {'workspace': [{'name': n} for n in workspaces]} if workspaces else ''}))
+        elif path == '/geoserver/rest/styles.json':
+            self.send_body(200, json.dumps({'styles': {'style': [{'name': n} for n in styles]} if styles else ''}))
+        elif _PATTERN_WORKSPACE.match(path):
+            found = _PATTERN_WORKSPACE.match(path).group(1) in workspaces
+            self.send_body(200 if found else 404, '{}')
+        elif _PATTERN_STYLE.match(path):
+            found = _PATTERN_STYLE.match(path).group(1) in styles
+            self.send_body(200 if found else 404, '{}')
+        else:
+            self.send_body(404, 'not found', 'text/plain')
+
+    def do_POST(self):
+        self.server.delay()
+        url = urllib.parse.urlsplit(self.path)
+        body = self.read_body()
+
+        if url.path == '/geoserver/rest/workspaces':
+            self._create(self.server.workspaces, json.loads(body)['workspace']['name'])
+        elif url.path == '/geoserver/rest/styles':
+            self._create(self.server.styles, dict(urllib.parse.parse_qsl(url.query))['name'])
+        else:
+            self.send_body(404, 'not found', 'text/plain')
+
+    def do_PUT(self):
+        self.server.delay()
+        path = urllib.parse.urlsplit(self.path).path
+        body = self.read_body()
+
+        coverage = _PATTERN_COVERAGE.match(path)
+        layer = _PATTERN_LAYER.match(path)
+
+        if coverage:
+            workspace, layer_id = coverage.groups()
+            with self.server.catalog_lock:
+                if workspace not in self.server.workspaces:
+                    self.send_body(404, 'no such workspace', 'text/plain')
+                    return
+                created = (workspace, layer_id) not in self.server.layers
+                self.server.layers.setdefault((workspace, layer_id), None)
+            self.send_body(201 if created else 200, '')
+        elif layer:
+            key = layer.groups()
+            style = json.loads(body)['layer']['defaultStyle']['name']
+            with self.server.catalog_lock:
+                if key not in self.server.layers or style not in self.server.styles:
+                    self.send_body(404, 'no such layer or style', 'text/plain')
+                    return
+                self.server.layers[key] = style
+            self.send_body(200, '')
+        else:
+            self.send_body(404, 'not found', 'text/plain')
+
+    def _create(self, collection, name):
+        with self.server.catalog_lock:
+            exists = name in collection
+            collection.add(name)
+
+        if exists:
+            self.send_body(500, '"{}" already exists'.format(name), 'text/plain')
+        else:
+            self.send_body(201, name, 'text/plain')
+
+
+def _parse_bbox(value):
+    try:
+        west, south, east, north = (float(n) for n in value.split(','))
+    except (AttributeError, ValueError):
+        return None
+    return west, south, east, north
+
+
+def _bbox_around(serialized_params, radius=0.05):
+    """
+    Point operations (viewshed, GeoRing) pass their origin as a parameter
+    rather than a BBOX.
+    """
+    numbers = [float(n) for n in re.findall(r'-?\d+(?:\.\d+)?', serialized_params)]
+    longitude, latitude = (numbers[:2] + [0.0, 0.0])[:2] if len(numbers) >= 2 else (0.0, 0.0)
+    return longitude - radius, latitude - radius, longitude + radius, latitude + radius
+
+
+def _create_kml(west, south, east, north):
+    coordinates = ' '.join('{},{}'.format(x, y) for x, y in ((west, south), (east, south), (east, north),
+                                                            (west, north), (west, south)))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<kml xmlns="{}"><Placemark><Polygon><outerBoundaryIs><LinearRing>'
+            '<coordinates>{}</coordinates>'
+            '</LinearRing></outerBoundaryIs></Polygon></Placemark></kml>').format(KML_NAMESPACE, coordinates)
+
+
+def _create_geotiff_header(width, height, bbox):
+    """
+    Header and IFD of an uncompressed, single-strip, 8-bit GeoTIFF in
+    EPSG:4326, whose pixels follow immediately.
+    """
+    west, south, east, north = bbox
+
+    doubles = struct.pack('<9d',
+                          (east - west) / width, (north - south) / height, 0,  # ModelPixelScale
+                          0, 0, 0, west, north, 0)                            # ModelTiepoint
+    geo_keys = struct.pack('<16H',
+                           1, 1, 0, 3,
+                           1024, 0, 1, 2,     # GTModelType: geographic
+                           1025, 0, 1, 1,     # GTRasterType: PixelIsArea
+                           2048, 0, 1, 4326)  # GeographicType: WGS 84
+
+    entry_count = 13
+    ifd_offset = 8
+    doubles_offset = ifd_offset + 2 + entry_count * 12 + 4
+    geo_keys_offset = doubles_offset + len(doubles)
+    pixels_offset = geo_keys_offset + len(geo_keys)
+
+    entries = [
+        (256, 4, 1, width),                  # ImageWidth
+        (257, 4, 1, height),                 # ImageLength
+        (258, 3, 1, 8),                      # BitsPerSample
+        (259, 3, 1, 1),                      # Compression: none
+        (262, 3, 1, 1),                      # Photometric: min-is-black
+        (273, 4, 1, pixels_offset),          # StripOffsets
+        (277, 3, 1, 1),                      # SamplesPerPixel
+        (278, 4, 1, height),                 # RowsPerStrip
+        (279, 4, 1, width * height),         # StripByteCounts
+        (339, 3, 1, 1),                      # SampleFormat: unsigned
+        (33550, 12, 3, doubles_offset),      # ModelPixelScale
+        (33922, 12, 6, doubles_offset + 24), # ModelTiepoint
+        (34735, 3, 16, geo_keys_offset),     # GeoKeyDirectory
+    ]
+
+    ifd = struct.pack('<H', entry_count)
+    for tag, field_type, count, value in entries:
+        value_format = 'H2x' if field_type == 3 and count == 1 else 'I'
+        ifd += struct.pack('<HHI' + value_format, tag, field_type, count, value)
+    ifd += struct.pack('<I', 0)
+
+    return b'II' + struct.pack('<HI', 42, ifd_offset) + ifd + doubles + geo_keys
+
+
+if __name__ == '__main__':
+    main()
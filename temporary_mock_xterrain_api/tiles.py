@@ -0,0 +1,322 @@
+import collections
+import logging
+import math
+import os
+import struct
+import threading
+import zlib
+
+import metrics
+import rasters
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+TILE_SIZE = 256
+TILE_CACHE_MAX_BYTES = int(os.getenv('TILE_CACHE_MAX_BYTES', 64 * 1024 ** 2))
+MAX_ZOOM = 24
+PNG_COMPRESSION_LEVEL = 6
+
+# Mirrors the ColorMaps of the SLDs GeoServer renders these layers with:
+# (env variable, default quantity, colour, opacity)
+COLORMAPS = {
+    'binary': (
+        (None, 0, '#008000', 0.0),
+        (None, 1, '#00FF00', 0.5),
+    ),
+    'rainbow': (
+        ('red', -9999, '#FF0000', 0.0),
+        ('red', 0, '#FF0000', 0.5),
+        ('orange', 30, '#FF7F00', 0.5),
+        ('yellow', 120, '#FFFF00', 0.5),
+        ('green', 240, '#00FF00', 0.5),
+        ('blue', 480, '#0000FF', 0.5),
+        ('indigo', 960, '#4B0082', 0.5),
+        ('violet', 1920, '#8B00FF', 0.5),
+    ),
+    'greenscale': (
+        ('one', 0, '#008000', 0.1),
+        ('two', 64, '#008000', 0.3),
+        ('three', 128, '#008000', 0.5),
+        ('four', 192, '#008000', 0.7),
+        ('five', 255, '#008000', 0.9),
+    ),
+    'greyscale': (
+        ('low', 0, '#000000', 0.5),
+        ('high', 255, '#FFFFFF', 0.5),
+    ),
+}
+
+
+_log = logging.getLogger(__name__)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+_empty_tile = None
+
+
+class TileCache:
+    """
+    In-memory LRU cache of encoded tiles bounded by total size.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._tiles = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """
+        :rtype: bytes?
+        """
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self._misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self._hits += 1
+            return tile
+
+    def put(self, key, tile):
+        """
+        :type tile: bytes
+        """
+        if len(tile) > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._tiles.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+
+            self._tiles[key] = tile
+            self._bytes += len(tile)
+
+            while self._bytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'tiles': len(self._tiles),
+                'bytes': self._bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+            }
+
+
+def available():
+    """
+    :rtype: bool
+    """
+    return np is not None
+
+
+def get_tile(raster_path, style, z, x, y, env=None):
+    """
+    Returns an XYZ (Web Mercator) tile of a raster as a PNG, rendering it
+    only if it is not already cached.
+
+    :type raster_path: unicode
+    :type style: unicode
+    :type z: int
+    :type x: int
+    :type y: int
+    :type env: dict[unicode, float]?
+    :rtype: bytes
+    """
+    stats = os.stat(raster_path)
+    key = (raster_path, stats.st_mtime_ns, style, tuple(sorted((env or {}).items())), z, x, y)
+
+    tile = _get_cache().get(key)
+    if tile is None:
+        _log.debug('Rendering tile %d/%d/%d of "%s" (style=%s)', z, x, y, raster_path, style)
+        tile = render_tile(rasters.open_raster(raster_path), style, z, x, y, env)
+        _get_cache().put(key, tile)
+
+    return tile
+
+
+def render_tile(raster, style, z, x, y, env=None):
+    """
+    Renders an XYZ tile by nearest-neighbour sampling, reading only the
+    raster pixels that land on the tile's pixel centres, from the coarsest
+    overview that still has enough detail.
+
+    :type raster: rasters.GeoTiff
+    :type style: unicode
+    :type z: int
+    :type x: int
+    :type y: int
+    :type env: dict[unicode, float]?
+    :rtype: bytes
+    """
+    n = 2 ** z
+
+    # Pixel centres; longitude is linear across the tile, latitude isn't
+    offsets = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    longitudes = (x + offsets) / n * 360 - 180
+    latitudes = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * (y + offsets) / n))))
+
+    # Overviews are only as coarse as the tile's own pixels
+    level = raster.level_for(360 / n / TILE_SIZE)
+    width, height = raster.level_size(level)
+    x_resolution, y_resolution = raster.level_resolution(level)
+
+    cols = np.floor((longitudes - raster.west) / x_resolution).astype(np.int64)
+    rows = np.floor((raster.north - latitudes) / y_resolution).astype(np.int64)
+
+    col_mask = (cols >= 0) & (cols < width)
+    row_mask = (rows >= 0) & (rows < height)
+
+    if not col_mask.any() or not row_mask.any():
+        return _get_empty_tile()
+
+    values = raster.sample(rows[row_mask], cols[col_mask], level)
+
+    rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), np.uint8)
+    rgba[np.ix_(row_mask, col_mask)] = colorize(values, style, raster.nodata, env)
+
+    return encode_png(rgba)
+
+
+def colorize(values, style, nodata=None, env=None):
+    """
+    Maps raster values to RGBA the way a GeoServer `ramp` ColorMap does:
+    colours are interpolated between entries and clamped beyond them.
+    8-bit rasters go through a precomputed 256-entry lookup table.
+
+    :type values: numpy.ndarray
+    :type style: unicode
+    :type nodata: float?
+    :type env: dict[unicode, float]?
+    :rtype: numpy.ndarray -- uint8, with a trailing RGBA axis
+    """
+    quantities, colors = _colormap(style, env)
+
+    if values.dtype == np.uint8:
+        rgba = _ramp(np.arange(256), quantities, colors)[values]
+    else:
+        rgba = _ramp(values.astype(np.float64), quantities, colors)
+
+    invalid = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(values.shape, bool)
+    if nodata is not None:
+        invalid |= values == nodata
+    rgba[invalid] = 0
+
+    return rgba
+
+
+def encode_png(rgba):
+    """
+    :type rgba: numpy.ndarray -- (height, width, 4) uint8
+    :rtype: bytes
+    """
+    height, width = rgba.shape[:2]
+
+    # Each scanline is prefixed with its filter type (0, none)
+    scanlines = np.zeros((height, width * 4 + 1), np.uint8)
+    scanlines[:, 1:] = rgba.reshape(height, width * 4)
+
+    return b''.join((
+        b'\x89PNG\r\n\x1a\n',
+        _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        _png_chunk(b'IDAT', zlib.compress(scanlines.tobytes(), PNG_COMPRESSION_LEVEL)),
+        _png_chunk(b'IEND', b''),
+    ))
+
+
+def parse_env(value):
+    """
+    Parses a WMS-style `env` parameter, e.g., `red:0;orange:60`.
+
+    :type value: unicode
+    :rtype: dict[unicode, float]
+    """
+    env = {}
+    for pair in filter(None, value.split(';')):
+        name, _, quantity = pair.partition(':')
+        env[name.strip()] = float(quantity)
+    return env
+
+
+def stats():
+    """
+    :rtype: dict
+    """
+    return _get_cache().stats()
+
+
+#
+# Helpers
+#
+
+
+def _get_cache():
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = TileCache(TILE_CACHE_MAX_BYTES)
+        return _cache
+
+
+def _colormap(style, env):
+    entries = COLORMAPS[style]
+    env = env or {}
+
+    quantities = np.array([env.get(name, default) if name else default for name, default, _, _ in entries], np.float64)
+    colors = np.array([
+        (int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16), round(opacity * 255))
+        for _, _, color, opacity in entries
+    ], np.float64)
+
+    return quantities, colors
+
+
+def _ramp(values, quantities, colors):
+    rgba = np.empty(values.shape + (4,), np.uint8)
+    for channel in range(4):
+        rgba[..., channel] = np.interp(values, quantities, colors[:, channel])
+    return rgba
+
+
+def _get_empty_tile():
+    global _empty_tile
+
+    if _empty_tile is None:
+        _empty_tile = encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), np.uint8))
+    return _empty_tile
+
+
+def _png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def _collect_metrics():
+    stats = _get_cache().stats()
+    return [
+        ('tile_cache_requests_total', 'counter', 'Tile lookups in the rendered tile cache',
+         [({'result': 'hit'}, stats['hits']), ({'result': 'miss'}, stats['misses'])]),
+        ('tile_cache_tiles', 'gauge', 'Tiles in the rendered tile cache', [({}, stats['tiles'])]),
+        ('tile_cache_bytes', 'gauge', 'Size of the rendered tile cache', [({}, stats['bytes'])]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
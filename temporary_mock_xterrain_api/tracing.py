@@ -0,0 +1,113 @@
+import contextlib
+import threading
+import time
+
+
+_local = threading.local()
+
+
+class Trace:
+    """
+    Timeline of the stages some piece of work went through, e.g., an
+    analytic layer from payload validation to being styled in GeoServer.
+    Span offsets are relative to when the trace started.
+    """
+
+    def __init__(self, started=None):
+        """
+        :type started: float? -- `time.perf_counter()` value, to backdate
+                                  the trace, e.g., to when the request that
+                                  led to it came in
+        """
+        self.created = time.perf_counter()
+        self.started = self.created if started is None else started
+
+        self._lock = threading.Lock()
+        self._spans = []
+
+    def record(self, name, started, ended=None):
+        """
+        :type name: unicode
+        :type started: float -- `time.perf_counter()` value
+        :type ended: float? -- defaults to now
+        """
+        ended = time.perf_counter() if ended is None else ended
+        with self._lock:
+            self._spans.append((name, started, ended))
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Records how long the block takes, whether or not it raises.
+
+        :type name: unicode
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started)
+
+    def serialize(self):
+        """
+        :rtype: list[dict]
+        """
+        with self._lock:
+            spans = sorted(self._spans, key=lambda s: s[1])
+
+        return [
+            {
+                'name': name,
+                'start_ms': round((started - self.started) * 1000, 1),
+                'duration_ms': round((ended - started) * 1000, 1),
+            }
+            for name, started, ended in spans
+        ]
+
+
+@contextlib.contextmanager
+def activate(trace):
+    """
+    Makes `trace` the one `span()` and `record()` add to on this thread
+    for the duration of the block.
+
+    :type trace: Trace?
+    """
+    previous = getattr(_local, 'trace', None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def current():
+    """
+    :rtype: Trace?
+    """
+    return getattr(_local, 'trace', None)
+
+
+def span(name):
+    """
+    Times the block as a span of this thread's active trace, if any.
+
+    :type name: unicode
+    """
+    trace = current()
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.span(name)
+
+
+def record(name, started, ended=None):
+    """
+    Adds a span to this thread's active trace, if any.
+
+    :type name: unicode
+    :type started: float -- `time.perf_counter()` value
+    :type ended: float?
+    """
+    trace = current()
+    if trace is not None:
+        trace.record(name, started, ended)
@@ -0,0 +1,320 @@
+import email.message
+import email.utils
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+
+READ_SIZE = 64 * 1024
+PARTIAL_SUFFIX = '.part'
+PARTIAL_MAX_AGE = 24 * 3600
+HEADERS_MAX_BYTES = 16 * 1024
+
+_PATTERN_UPLOAD_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+_log = logging.getLogger(__name__)
+
+
+class Uploads:
+    """
+    Staging area for uploads that arrive in one or more chunks.
+
+    Each chunk is appended to a partial file and fed through SHA-256 as it
+    is written, so a finished upload's digest is ready without reading the
+    file back.  A client whose connection drops can ask for `offset()` and
+    resume from there.
+    """
+
+    def __init__(self, directory):
+        """
+        :type directory: unicode
+        """
+        self.directory = directory
+
+        self._lock = threading.Lock()
+        self._upload_locks = {}
+        self._hashers = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self._purge_partials()
+
+    def offset(self, upload_id):
+        """
+        :type upload_id: unicode
+        :rtype: int? -- None if no such upload is in progress
+        """
+        try:
+            return os.path.getsize(self._partial_path(upload_id))
+        except FileNotFoundError:
+            return None
+
+    def append(self, upload_id, chunks, offset=0):
+        """
+        Appends chunks to an upload, which must currently be exactly
+        `offset` bytes long.
+
+        :type upload_id: unicode
+        :type chunks: iterable[bytes]
+        :type offset: int
+        :rtype: int -- bytes received so far
+        """
+        filepath = self._partial_path(upload_id)
+
+        with self._get_upload_lock(upload_id):
+            current = self.offset(upload_id) or 0
+            if offset != current:
+                raise OffsetMismatch(current)
+
+            hasher = self._hashers.get(upload_id)
+            if hasher is None:
+                hasher = _hash_file(filepath) if current else hashlib.sha256()
+                self._hashers[upload_id] = hasher
+
+            with open(filepath, 'ab') as fp:
+                try:
+                    for chunk in chunks:
+                        fp.write(chunk)
+                        hasher.update(chunk)
+                except Exception:
+                    # Whatever made it to disk stays there to be resumed
+                    # from, but the digest no longer matches it
+                    fp.flush()
+                    self._hashers.pop(upload_id, None)
+                    raise
+                current = fp.tell()
+
+        return current
+
+    def finish(self, upload_id):
+        """
+        Closes out an upload, returning the path of the completed file and
+        its SHA-256 digest.  The caller owns the file from then on.
+
+        :type upload_id: unicode
+        :rtype: (unicode, unicode)
+        """
+        partial_path = self._partial_path(upload_id)
+        filepath = partial_path[:-len(PARTIAL_SUFFIX)]
+
+        with self._get_upload_lock(upload_id):
+            hasher = self._hashers.pop(upload_id, None) or _hash_file(partial_path)
+            os.replace(partial_path, filepath)
+
+        with self._lock:
+            self._upload_locks.pop(upload_id, None)
+
+        return filepath, hasher.hexdigest()
+
+    def discard(self, upload_id):
+        """
+        :type upload_id: unicode
+        """
+        with self._get_upload_lock(upload_id):
+            self._hashers.pop(upload_id, None)
+            try:
+                os.remove(self._partial_path(upload_id))
+            except FileNotFoundError:
+                pass
+
+        with self._lock:
+            self._upload_locks.pop(upload_id, None)
+
+    def _get_upload_lock(self, upload_id):
+        with self._lock:
+            return self._upload_locks.setdefault(upload_id, threading.Lock())
+
+    def _partial_path(self, upload_id):
+        if not is_valid_upload_id(upload_id):
+            raise ValueError('invalid upload ID "{}"'.format(upload_id))
+        return os.path.join(self.directory, upload_id + PARTIAL_SUFFIX)
+
+    def _purge_partials(self):
+        cutoff = time.time() - PARTIAL_MAX_AGE
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(PARTIAL_SUFFIX) and entry.stat().st_mtime < cutoff:
+                _log.info('Removing abandoned upload "%s"', entry.name)
+                os.remove(entry.path)
+
+
+class OffsetMismatch(Exception):
+    def __init__(self, offset):
+        Exception.__init__(self, 'upload is at offset {}'.format(offset))
+        self.offset = offset
+
+
+class MalformedBody(Exception):
+    pass
+
+
+def is_valid_upload_id(upload_id):
+    """
+    :type upload_id: unicode
+    :rtype: bool
+    """
+    return bool(_PATTERN_UPLOAD_ID.match(upload_id or ''))
+
+
+def read_body(stream, length):
+    """
+    Yields a request body chunk by chunk.
+
+    :type stream: file
+    :type length: int
+    """
+    while length > 0:
+        chunk = stream.read(min(READ_SIZE, length))
+        if not chunk:
+            raise MalformedBody('request body ended {} bytes short'.format(length))
+        length -= len(chunk)
+        yield chunk
+
+
+def read_multipart_file(stream, length, content_type):
+    """
+    Finds the first file in a `multipart/form-data` body, returning its
+    filename and an iterator over its content.  Nothing beyond a single
+    read's worth of the body is held in memory.
+
+    :type stream: file
+    :type length: int
+    :type content_type: unicode
+    :rtype: (unicode, iterator[bytes])
+    """
+    boundary = _header_param('Content-Type', content_type, 'boundary')
+    if not boundary:
+        raise MalformedBody('multipart body has no boundary')
+
+    reader = _MultipartReader(read_body(stream, length), boundary.encode('latin1'))
+
+    while reader.next_part():
+        headers = reader.read_headers()
+        filename = filename_from_disposition(headers.get('content-disposition'))
+        if filename is not None:
+            return filename, reader.read_part()
+        for _ in reader.read_part():
+            pass
+
+    raise MalformedBody('multipart body contains no file')
+
+
+def filename_from_disposition(value):
+    """
+    :type value: unicode?
+    :rtype: unicode?
+    """
+    filename = _header_param('Content-Disposition', value or '', 'filename')
+    if filename is None:
+        return None
+    return os.path.basename(filename.replace('\\', '/'))
+
+
+#
+# Helpers
+#
+
+
+def _hash_file(filepath):
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as fp:
+        while True:
+            chunk = fp.read(READ_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher
+
+
+def _header_param(name, value, param):
+    message = email.message.Message()
+    message[name] = value
+    result = message.get_param(param, header=name)
+    if isinstance(result, tuple):
+        result = email.utils.collapse_rfc2231_value(result)
+    return result
+
+
+class _MultipartReader:
+    """
+    Incremental `multipart/form-data` reader which only ever buffers one
+    chunk plus the length of the boundary.
+    """
+
+    def __init__(self, chunks, boundary):
+        self._chunks = chunks
+
+        # The opening boundary has no preceding line break; adding one lets
+        # every boundary be matched the same way
+        self._buffer = b'\r\n'
+        self._delimiter = b'\r\n--' + boundary
+        self._finished = False
+
+    def next_part(self):
+        """
+        Skips to the next part, returning False once the closing boundary
+        has been read.
+        """
+        if self._finished:
+            return False
+
+        while True:
+            index = self._buffer.find(self._delimiter)
+            if index >= 0:
+                self._buffer = self._buffer[index + len(self._delimiter):]
+                break
+            self._buffer = self._buffer[-(len(self._delimiter) - 1):]
+            self._fill()
+
+        while len(self._buffer) < 2:
+            self._fill()
+
+        if self._buffer.startswith(b'--'):
+            self._finished = True
+            return False
+
+        return True
+
+    def read_headers(self):
+        while True:
+            index = self._buffer.find(b'\r\n\r\n')
+            if index >= 0:
+                break
+            if len(self._buffer) > HEADERS_MAX_BYTES:
+                raise MalformedBody('multipart headers are too long')
+            self._fill()
+
+        lines = self._buffer[:index].decode('utf-8', 'replace').split('\r\n')
+        self._buffer = self._buffer[index + 4:]
+
+        headers = {}
+        for line in lines:
+            name, _, value = line.partition(':')
+            if value:
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def read_part(self):
+        keep = len(self._delimiter) - 1
+
+        while True:
+            index = self._buffer.find(self._delimiter)
+            if index >= 0:
+                if index:
+                    yield self._buffer[:index]
+                self._buffer = self._buffer[index:]
+                return
+
+            if len(self._buffer) > keep:
+                yield self._buffer[:-keep]
+                self._buffer = self._buffer[-keep:]
+
+            self._fill()
+
+    def _fill(self):
+        try:
+            self._buffer += next(self._chunks)
+        except StopIteration:
+            raise MalformedBody('multipart body ended before its closing boundary')